@@ -9,9 +9,10 @@ import os
 
 # Import per notifiche Telegram
 try:
-    from telegram_manager import send_alert_to_telegram
+    from telegram_manager import send_alert_to_telegram, aggiorna_stato_alert_telegram
 except ImportError:
     send_alert_to_telegram = None
+    aggiorna_stato_alert_telegram = None
 
 bp = Blueprint('alerts', __name__)
 DB_PATH = os.path.join(os.path.dirname(__file__), 'compilazioni.db')
@@ -44,7 +45,31 @@ def init_alert_db():
     except sqlite3.OperationalError:
         # La colonna esiste già
         pass
-    
+
+    # Origine strutturata degli alert automatici (es. scadenze) per la deduplica:
+    # origine_tipo = tipo di alert generato (preavviso, oggi, scaduta)
+    # origine_chiave = riferimento alla sorgente (es. "scadenza:12@2025-09-05")
+    # origine_giorno = giorno di generazione (YYYY-MM-DD)
+    for colonna in ('origine_tipo', 'origine_chiave', 'origine_giorno'):
+        try:
+            c.execute(f'ALTER TABLE alert ADD COLUMN {colonna} TEXT')
+        except sqlite3.OperationalError:
+            # La colonna esiste già
+            pass
+
+    # Indice univoco: un solo alert per origine/tipo/giorno, anche con più worker in parallelo.
+    # Gli alert manuali (origine NULL) non sono vincolati.
+    c.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_alert_origine
+        ON alert(origine_chiave, origine_tipo, origine_giorno)
+    ''')
+
+    # Indice per la timeline dell'asset: stessa espressione usata nella query (data ISO con 'T')
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS idx_alert_asset_data
+        ON alert(asset, replace(data_creazione, ' ', 'T'))
+    ''')
+
     conn.commit()
     conn.close()
 
@@ -92,10 +117,8 @@ def create_alert():
         ''', (tipo, titolo, descrizione, civico, asset, operatore, note))
         
         alert_id = c.lastrowid
-        conn.commit()
-        conn.close()
         
-        # Se è un ticket, invia notifica Telegram
+        # Se è un ticket, accoda la notifica Telegram nella stessa transazione dell'alert
         if tipo == 'Tickets' and send_alert_to_telegram:
             try:
                 # Recupera il tipo di asset dal database per le notifiche Telegram
@@ -122,10 +145,13 @@ def create_alert():
                     'asset_tipo': asset_tipo,  # Aggiunto il tipo di asset
                     'note': note
                 }
-                send_alert_to_telegram(alert_data)
-                print(f"[INFO] Notifica Telegram inviata per ticket ID {alert_id}")
+                send_alert_to_telegram(alert_data, cursor=c, alert_id=alert_id)
+                print(f"[INFO] Notifica Telegram accodata per ticket ID {alert_id}")
             except Exception as e:
-                print(f"[WARNING] Errore invio notifica Telegram per ticket: {e}")
+                print(f"[WARNING] Errore accodamento notifica Telegram per ticket: {e}")
+        
+        conn.commit()
+        conn.close()
         
         return jsonify({
             'success': True,
@@ -221,6 +247,11 @@ def close_alert(alert_id):
         if c.rowcount == 0:
             conn.close()
             return jsonify({'error': 'Alert non trovato'}), 404
+
+        # Aggiorna i messaggi Telegram già inviati, nella stessa transazione
+        if aggiorna_stato_alert_telegram:
+            operatore = (request.get_json(silent=True) or {}).get('operatore')
+            aggiorna_stato_alert_telegram(alert_id, 'chiuso', operatore, cursor=c)
             
         conn.commit()
         conn.close()
@@ -243,6 +274,11 @@ def take_alert(alert_id):
         if c.rowcount == 0:
             conn.close()
             return jsonify({'error': 'Ticket non trovato'}), 404
+
+        # Aggiorna i messaggi Telegram già inviati, nella stessa transazione
+        if aggiorna_stato_alert_telegram:
+            operatore = (request.get_json(silent=True) or {}).get('operatore')
+            aggiorna_stato_alert_telegram(alert_id, 'in_carico', operatore, cursor=c)
             
         conn.commit()
         conn.close()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+Benchmark della consegna Telegram (coda, routing, rate limiter, invii paralleli) contro il
+finto server di fake_telegram_api.py. Usa database temporanei: gestman.db e compilazioni.db
+del backend non vengono toccati.
+
+Esempi:
+    python benchmark_telegram.py --destinatari 50 --alert 10 --latenza-ms 100
+    python benchmark_telegram.py --destinatari 30 --alert 40 --limiti --prob-429 0.02
+    python benchmark_telegram.py --tipo scadenza --digest --alert 80   # riepiloghi attivi
+    python benchmark_telegram.py --url http://127.0.0.1:8081           # server già avviato
+"""
+import argparse
+import datetime
+import json
+import math
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+import requests
+
+import fake_telegram_api
+
+
+def percentile(valori, p):
+    """Percentile nearest-rank su una lista ordinata"""
+    if not valori:
+        return None
+    indice = max(0, min(len(valori) - 1, math.ceil(p / 100 * len(valori)) - 1))
+    return valori[indice]
+
+
+def prepara_database(tm, args):
+    """Bot configurato e chat destinatarie nei database temporanei (tabelle già create all'import)"""
+    adesso = datetime.datetime.now().isoformat()
+    conn = sqlite3.connect(tm.DB_PATH)
+    conn.execute("INSERT INTO telegram_config (bot_token, bot_name, active, created_at) VALUES (?, ?, 1, ?)",
+                 (args.token or 'BENCHMARK', 'Benchmark', adesso))
+    # Senza --digest ogni alert parte subito: si misura il fan-out puro
+    finestre = '' if args.digest else 'scadenze:0'
+    chats = []
+    for i in range(args.destinatari):
+        chat_id = f"-100{i + 1}" if i < args.gruppi else str(100000 + i)
+        chats.append((f"bench{i}", chat_id, 'non_conformita,scadenze,Tickets', finestre, adesso))
+    conn.executemany("""
+        INSERT INTO telegram_chats (name, chat_id, alert_types, digest_finestre, active, created_at)
+        VALUES (?, ?, ?, ?, 1, ?)
+    """, chats)
+    conn.commit()
+    conn.close()
+
+    tm.client_telegram.invalida_config()
+    tm.indice_routing.ricompila()
+
+
+def coda_vuota(tm):
+    conn = sqlite3.connect(tm.OUTBOX_DB_PATH)
+    eventi = conn.execute("SELECT COUNT(*) FROM telegram_outbox WHERE stato = 'in_coda'").fetchone()[0]
+    consegne = conn.execute("SELECT COUNT(*) FROM telegram_consegne WHERE stato IN ('in_coda', 'in_invio')").fetchone()[0]
+    conn.close()
+    return eventi == 0 and consegne == 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark della consegna Telegram contro il finto server Bot API')
+    parser.add_argument('--destinatari', type=int, default=50, help='Chat destinatarie di ogni alert')
+    parser.add_argument('--gruppi', type=int, default=0, help='Quante delle chat sono gruppi (limite 20/min)')
+    parser.add_argument('--alert', type=int, default=10, help='Alert accodati')
+    parser.add_argument('--tipo', default='Tickets', help='Tipo degli alert (Tickets, non_conformita, scadenza)')
+    parser.add_argument('--digest', action='store_true', help='Mantieni le finestre di riepilogo predefinite')
+    parser.add_argument('--url', help='URL di un finto server già avviato (predefinito: ne avvia uno interno)')
+    parser.add_argument('--timeout', type=float, default=600, help='Durata massima in secondi')
+    parser.add_argument('--json', action='store_true', help='Stampa il risultato in JSON')
+    fake_telegram_api.aggiungi_opzioni(parser)
+    args = parser.parse_args()
+
+    stato = None
+    if args.url:
+        url = args.url.rstrip('/')
+    else:
+        server, stato = fake_telegram_api.avvia_server(0, **fake_telegram_api.opzioni_da_args(args))
+        url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    # Da impostare prima dell'import, che crea subito le tabelle: database temporanei,
+    # URL del bot e nessun thread worker automatico
+    os.environ['GESTMAN_TELEGRAM_DB_DIR'] = tempfile.mkdtemp(prefix='gestman-benchmark-')
+    os.environ['GESTMAN_TELEGRAM_API_URL'] = url
+    os.environ['GESTMAN_TELEGRAM_WORKER'] = 'esterno'
+    import telegram_manager as tm
+
+    prepara_database(tm, args)
+
+    inizio = time.time()
+    for i in range(args.alert):
+        tm.send_alert_to_telegram({
+            'tipo': args.tipo,
+            'titolo': f"Benchmark {i}",
+            'descrizione': f"Alert di benchmark numero {i}",
+            'operazione': f"Verifica periodica {i}",
+            'operatore': 'benchmark',
+            'civico': str(i % 10),
+        })
+
+    while not coda_vuota(tm):
+        if time.time() - inizio > args.timeout:
+            print(f"[BENCHMARK] Timeout dopo {args.timeout}s: coda non svuotata")
+            break
+        if not tm.elabora_outbox():
+            time.sleep(tm.secondi_alla_prossima_consegna())
+    durata = time.time() - inizio
+
+    conn = sqlite3.connect(tm.OUTBOX_DB_PATH)
+    conn.row_factory = sqlite3.Row
+    stati = dict(conn.execute("SELECT stato, COUNT(*) FROM telegram_consegne GROUP BY stato").fetchall())
+    latenze = sorted(
+        (datetime.datetime.fromisoformat(riga['inviato_il']) - datetime.datetime.fromisoformat(riga['creato_il'])).total_seconds()
+        for riga in conn.execute("""
+            SELECT d.inviato_il, o.creato_il FROM telegram_consegne d JOIN telegram_outbox o ON o.id = d.outbox_id
+            WHERE d.stato = 'inviato'
+        """)
+    )
+    conn.close()
+
+    statistiche = stato.statistiche() if stato else requests.get(f"{url}/statistiche", timeout=10).json()
+    contatori = statistiche['contatori']
+    inviate = stati.get('inviato', 0)
+    risultato = {
+        'alert': args.alert,
+        'destinatari': args.destinatari,
+        'consegne': stati,
+        'durata_secondi': round(durata, 3),
+        'consegne_al_secondo': round(inviate / durata, 1) if durata else None,
+        'chiamate_send_message': contatori.get('sendMessage', 0),
+        'risposte_429': contatori.get('http_429', 0),
+        'risposte_errore': sum(valore for chiave, valore in contatori.items()
+                               if chiave.startswith('http_') and chiave != 'http_429'),
+        'latenza_secondi': {
+            'p50': percentile(latenze, 50),
+            'p95': percentile(latenze, 95),
+            'p99': percentile(latenze, 99),
+            'max': latenze[-1] if latenze else None,
+        },
+        'database': tm.DB_DIR,
+    }
+
+    if args.json:
+        print(json.dumps(risultato, indent=2))
+        return
+    print(f"[BENCHMARK] {args.alert} alert x {args.destinatari} destinatari in {risultato['durata_secondi']}s")
+    print(f"[BENCHMARK] Consegne: {stati}  ({risultato['consegne_al_secondo']}/s)")
+    print(f"[BENCHMARK] Chiamate sendMessage: {risultato['chiamate_send_message']}, "
+          f"429: {risultato['risposte_429']}, altri errori: {risultato['risposte_errore']}")
+    lat = risultato['latenza_secondi']
+    if latenze:
+        print(f"[BENCHMARK] Latenza accodamento->invio: p50 {lat['p50']:.2f}s  p95 {lat['p95']:.2f}s  "
+              f"p99 {lat['p99']:.2f}s  max {lat['max']:.2f}s")
+    print(f"[BENCHMARK] Database temporanei in {tm.DB_DIR}")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
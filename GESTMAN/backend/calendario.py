@@ -1,11 +1,20 @@
 # coding: utf-8
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, request, jsonify, Response, stream_with_context
 import sqlite3
 import os
 import datetime
+import calendar
 import json
+import base64
+import binascii
+import bisect
+import sys
+import threading
 import traceback
 from telegram_manager import send_alert_to_telegram
+from dynamic_forms import salva_submission, send_non_conformity_alerts
+from idempotenza import (OperazioneNonValida, chiave_valida, chiave_da_richiesta, init_sync_db, apri_operazione,
+                         carica_operazioni_sincronizzate, registra_operazioni_sincronizzate)
 
 # Prova a importare dateutil, con fallback se non disponibile
 try:
@@ -18,6 +27,86 @@ except ImportError:
 bp = Blueprint('calendario', __name__)
 DB_PATH = os.path.join(os.path.dirname(__file__), 'compilazioni.db')
 
+# Frequenze espresse in mesi (le frequenze settimanali sono gestite in giorni)
+FREQUENZE_MESI = {
+    'mensile': 1,
+    'bimestrale': 2,
+    'trimestrale': 3,
+    'semestrale': 6,
+    'annuale': 12,
+    'biennale': 24
+}
+FREQUENZE_SETTIMANE = {
+    'settimanale': 1,
+    'bisettimanale': 2
+}
+
+# --- UTILITY DATE ---
+# Formato canonico delle date di calendario (data_scadenza, data_prossima_scadenza,
+# data_scadenza_originale): ISO 'YYYY-MM-DD', ordinabile e indicizzabile come testo.
+COLONNE_DATE_CALENDARIO = [
+    ('scadenze_calendario', 'data_scadenza'),
+    ('scadenze_calendario', 'data_prossima_scadenza'),
+    ('scadenze_storico_esecuzioni', 'data_scadenza_originale'),
+]
+
+# Giorni mancanti alla data (negativo se passata), calcolati da SQLite sul giorno locale
+SQL_GIORNI_RIMANENTI = "CAST(julianday({col}) - julianday('now', 'localtime', 'start of day') AS INTEGER)"
+
+def data_canonica(valore):
+    """Converte date/datetime o stringhe (YYYY-MM-DD, ISO con 'T', dd/mm/yyyy) nel formato canonico YYYY-MM-DD"""
+    if valore is None or valore == '':
+        return None
+    if isinstance(valore, (datetime.date, datetime.datetime)):
+        return valore.strftime('%Y-%m-%d')
+    valore = str(valore).strip()
+    if '/' in valore:
+        return datetime.datetime.strptime(valore, '%d/%m/%Y').strftime('%Y-%m-%d')
+    return datetime.datetime.strptime(valore[:10], '%Y-%m-%d').strftime('%Y-%m-%d')
+
+def normalizza_date_calendario(c):
+    """Migrazione idempotente: porta tutte le date di calendario al formato canonico YYYY-MM-DD"""
+    for tabella, colonna in COLONNE_DATE_CALENDARIO:
+        # ISO completo con orario ('2025-09-05T00:00:00') -> solo data
+        c.execute(f"""
+            UPDATE {tabella} SET {colonna} = substr({colonna}, 1, 10)
+            WHERE length({colonna}) > 10
+              AND {colonna} GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]*'
+        """)
+        # Formato italiano dd/mm/yyyy -> ISO
+        c.execute(f"""
+            UPDATE {tabella}
+            SET {colonna} = substr({colonna}, 7, 4) || '-' || substr({colonna}, 4, 2) || '-' || substr({colonna}, 1, 2)
+            WHERE {colonna} GLOB '[0-9][0-9]/[0-9][0-9]/[0-9][0-9][0-9][0-9]'
+        """)
+
+def parse_data_scadenza(data_scadenza_str):
+    """Converte una data scadenza (YYYY-MM-DD o ISO completo) in date, fallback a oggi"""
+    try:
+        if 'T' in data_scadenza_str:
+            return datetime.datetime.fromisoformat(data_scadenza_str).date()
+        return datetime.datetime.strptime(data_scadenza_str, '%Y-%m-%d').date()
+    except (TypeError, ValueError):
+        print(f"[WARNING] Formato data non riconosciuto: {data_scadenza_str}, usando data odierna")
+        return datetime.date.today()
+
+def data_tra_mesi(data, mesi):
+    """Data spostata in avanti di un numero di mesi (fine mese se il giorno non esiste)"""
+    if HAS_DATEUTIL:
+        return data + relativedelta(months=mesi)
+    mese_totale = data.month - 1 + mesi
+    anno = data.year + mese_totale // 12
+    mese = mese_totale % 12 + 1
+    return data.replace(year=anno, month=mese, day=min(data.day, calendar.monthrange(anno, mese)[1]))
+
+def calcola_prossima_data(data_attuale, frequenza_tipo):
+    """Calcola la prossima data di scadenza a partire da data_attuale secondo la frequenza (default mensile)"""
+    frequenza_tipo = (frequenza_tipo or '').lower()
+    if frequenza_tipo in FREQUENZE_SETTIMANE:
+        return data_attuale + datetime.timedelta(weeks=FREQUENZE_SETTIMANE[frequenza_tipo])
+
+    return data_tra_mesi(data_attuale, FREQUENZE_MESI.get(frequenza_tipo, 1))
+
 # --- CREAZIONE TABELLE CALENDARIO ---
 def init_calendario_db():
     conn = sqlite3.connect(DB_PATH)
@@ -194,9 +283,50 @@ def init_calendario_db():
             """, tipologia + (datetime.datetime.now().isoformat(),))
         
         print("[DEBUG] Inserite tipologie di manutenzione iniziali per asset generici")
-    
+
+    # Date di calendario nel formato canonico YYYY-MM-DD
+    normalizza_date_calendario(c)
+
+    # Indici per filtri e ordinamenti sulle date e per la ricerca dei gruppi (civico/asset/data)
+    c.execute('CREATE INDEX IF NOT EXISTS idx_scadenze_stato_data ON scadenze_calendario(stato, data_scadenza)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_scadenze_gruppo ON scadenze_calendario(civico, asset, data_scadenza)')
+
+    # Vista di supporto con i giorni rimanenti calcolati in SQL (ricreata per includere eventuali nuove colonne)
+    c.execute('DROP VIEW IF EXISTS v_scadenze_calendario')
+    c.execute(f'''
+    CREATE VIEW v_scadenze_calendario AS
+    SELECT s.*,
+           {SQL_GIORNI_RIMANENTI.format(col='s.data_scadenza')} AS giorni_rimanenti,
+           strftime('%d/%m/%Y', s.data_scadenza) AS data_scadenza_formatted
+    FROM scadenze_calendario s
+    ''')
+
+    # Cache delle previsioni di carico: occorrenze future proiettate per ogni scadenza
+    init_previsioni_db(c)
+
+    # Contatori di modifica per ETag/Last-Modified dei feed ICS
+    init_modifiche_db(c)
+
+    # Rollup mensili e registro delle partizioni d'archivio dello storico esecuzioni
+    init_archivio_storico_db(c)
+
+    # KPI di puntualità aggiornati a ogni completamento
+    init_kpi_db(c)
+
+    # Indici per asset della timeline
+    init_timeline_indici(c)
+
+    # Registro delle operazioni sincronizzate dalla coda offline della PWA
+    init_sync_db(c)
+
+    # Indice del prossimo alert per scadenza: lo scheduler legge solo le righe in scadenza
+    init_prossimo_alert_db(c)
+
+    # Registro delle modifiche per l'indice calendario residente dei worker
+    init_indice_calendario_db(c)
+
     conn.commit()
-    
+
     # Inizializza voci frese se non esistono
     init_frese_checklist(conn)
     
@@ -274,6 +404,66 @@ def init_asset_checklist():
     conn.commit()
     conn.close()
 
+# --- CACHE FORM COMPILATI ---
+# Le definizioni delle voci checklist cambiano di rado: i form compilati (nomi, descrizioni e
+# template delle voci) sono tenuti in memoria per asset_tipo e insieme di voci. La cache è valida
+# finché non cambia il contatore 'voci' di calendario_modifiche (aggiornato dai trigger, quindi
+# visibile a tutti i worker) e viene svuotata subito dal CRUD delle voci nel worker corrente.
+CACHE_FORM_MAX_VOCI = 500
+_cache_form = {}
+_cache_form_versione = None
+
+def invalida_cache_form():
+    """Svuota la cache dei form compilati del processo corrente"""
+    global _cache_form_versione
+    _cache_form.clear()
+    _cache_form_versione = None
+
+# Versione corrente delle definizioni, letta nella stessa query delle scadenze del gruppo
+SQL_VERSIONE_VOCI = "(SELECT versione FROM calendario_modifiche WHERE ambito = 'voci')"
+
+def form_compilato(c, asset_tipo, voce_ids, manutenzione_ids, versione):
+    """
+    Definizione compilata del form per l'insieme di voci/tipologie indicato:
+    {'voci': {id: (nome, descrizione)}, 'tipologie': {id: (nome, descrizione)},
+     'template': {manutenzione_id: [(codice, voce, obbligatoria, ordine)]}}
+    """
+    global _cache_form_versione
+    if versione != _cache_form_versione or len(_cache_form) > CACHE_FORM_MAX_VOCI:
+        _cache_form.clear()
+        _cache_form_versione = versione
+
+    voce_ids = tuple(sorted({v for v in voce_ids if v}))
+    manutenzione_ids = tuple(sorted({m for m in manutenzione_ids if m and m > 0}))
+    chiave = (asset_tipo, voce_ids, manutenzione_ids)
+    form = _cache_form.get(chiave)
+    if form is not None:
+        return form
+
+    form = {'voci': {}, 'tipologie': {}, 'template': {}}
+    if voce_ids:
+        c.execute(f"""
+            SELECT id, nome_voce, descrizione FROM manutenzione_programmata_checklist
+            WHERE id IN ({','.join('?' * len(voce_ids))})
+        """, voce_ids)
+        form['voci'] = {r[0]: (r[1], r[2]) for r in c.fetchall()}
+    if manutenzione_ids:
+        segnaposto = ','.join('?' * len(manutenzione_ids))
+        c.execute(f"SELECT id, nome_manutenzione, descrizione FROM manutenzione_tipologie WHERE id IN ({segnaposto})",
+                  manutenzione_ids)
+        form['tipologie'] = {r[0]: (r[1], r[2]) for r in c.fetchall()}
+        c.execute(f"""
+            SELECT manutenzione_id, codice_voce, voce_checklist, obbligatoria, ordine_visualizzazione
+            FROM manutenzione_checklist_template
+            WHERE manutenzione_id IN ({segnaposto})
+            ORDER BY ordine_visualizzazione
+        """, manutenzione_ids)
+        for mid, codice, voce, obbligatoria, ordine in c.fetchall():
+            form['template'].setdefault(mid, []).append((codice, voce, bool(obbligatoria), ordine))
+
+    _cache_form[chiave] = form
+    return form
+
 # --- ENDPOINT PER FORM DINAMICI ---
 @bp.route('/form-scadenza/<int:scadenza_id>', methods=['GET'])
 def get_form_scadenza(scadenza_id):
@@ -282,102 +472,84 @@ def get_form_scadenza(scadenza_id):
         conn = sqlite3.connect(DB_PATH)
         c = conn.cursor()
         
-        # Prima ottieni i dettagli base della scadenza
-        c.execute("""
-            SELECT s.id, s.civico, s.asset, s.asset_tipo, s.data_scadenza, 
-                   s.manutenzione_id, s.checklist_voce_id, s.frequenza_tipo, c.nome_voce
-            FROM scadenze_calendario s
-            JOIN manutenzione_programmata_checklist c ON s.checklist_voce_id = c.id
-            WHERE s.id = ?
+        # Una sola query indicizzata: la scadenza richiesta e le altre scadenze programmate
+        # dello stesso asset nella stessa data (gruppo), più la versione delle definizioni voci
+        c.execute(f"""
+            SELECT s.id, s.civico, s.asset, s.asset_tipo, s.data_scadenza, s.manutenzione_id,
+                   s.checklist_voce_id, s.frequenza_tipo, s.giorni_preavviso, s.stato,
+                   {SQL_VERSIONE_VOCI}
+            FROM scadenze_calendario t
+            JOIN scadenze_calendario s
+              ON s.civico = t.civico AND s.asset = t.asset AND s.data_scadenza = t.data_scadenza
+             AND (s.stato = 'programmata' OR s.id = t.id)
+            WHERE t.id = ?
         """, (scadenza_id,))
+        righe = c.fetchall()
         
-        scadenza_row = c.fetchone()
+        scadenza_row = next((r for r in righe if r[0] == scadenza_id), None)
         if not scadenza_row:
+            conn.close()
             return jsonify({'error': 'Scadenza non trovata'}), 404
         
-        scadenza_id, civico, asset, asset_tipo, data_scadenza, manutenzione_id, checklist_voce_id, frequenza_tipo, nome_voce = scadenza_row
+        _, civico, asset, asset_tipo, data_scadenza, manutenzione_id, checklist_voce_id, frequenza_tipo, _, _, versione = scadenza_row
+        form = form_compilato(c, asset_tipo, [r[6] for r in righe], [r[5] for r in righe], versione)
+        conn.close()
         
-        # Verifica se ci sono altre scadenze dello stesso asset nella stessa data (gruppo)
-        c.execute("""
-            SELECT s.id, s.checklist_voce_id, s.frequenza_tipo, s.giorni_preavviso,
-                   COALESCE(mpc.nome_voce, mt.nome_manutenzione) as nome_voce,
-                   COALESCE(mpc.descrizione, mt.descrizione) as descrizione_voce
-            FROM scadenze_calendario s
-            LEFT JOIN manutenzione_programmata_checklist mpc ON s.checklist_voce_id = mpc.id
-            LEFT JOIN manutenzione_tipologie mt ON s.manutenzione_id = mt.id
-            WHERE s.civico = ? AND s.asset = ? AND s.data_scadenza = ? AND s.stato = 'programmata'
-            ORDER BY COALESCE(mpc.nome_voce, mt.nome_manutenzione)
-        """, (civico, asset, data_scadenza))
+        if checklist_voce_id not in form['voci']:
+            return jsonify({'error': 'Scadenza non trovata'}), 404
+        
+        def nome_descrizione(riga):
+            voce = form['voci'].get(riga[6]) or form['tipologie'].get(riga[5]) or (None, None)
+            return voce
         
-        scadenze_gruppo = c.fetchall()
+        scadenze_gruppo = sorted(
+            (r for r in righe if r[9] == 'programmata'),
+            key=lambda r: nome_descrizione(r)[0] or ''
+        )
         
         if len(scadenze_gruppo) > 1:
             # GRUPPO DI SCADENZE: crea form combinato
             nome_manutenzione = f"Manutenzione {asset_tipo} ({len(scadenze_gruppo)} voci)"
-            voci_nomi = [s[4] for s in scadenze_gruppo[:3]]
+            voci_nomi = [nome_descrizione(s)[0] for s in scadenze_gruppo[:3]]
             if len(scadenze_gruppo) > 3:
                 voci_nomi.append(f"... (+{len(scadenze_gruppo)-3} altre)")
             descrizione = f"Controlli programmati: {', '.join(voci_nomi)}"
             
             checklist_items = []
-            for i, (s_id, voce_id, freq_tipo, giorni_prev, nome_voce, desc_voce) in enumerate(scadenze_gruppo):
+            for i, riga in enumerate(scadenze_gruppo):
+                nome_voce, desc_voce = nome_descrizione(riga)
                 checklist_items.append({
-                    'scadenza_id': s_id,  # ID della scadenza individuale
-                    'codice': f'ITEM_{voce_id or s_id}',
+                    'scadenza_id': riga[0],  # ID della scadenza individuale
+                    'codice': f'ITEM_{riga[6] or riga[0]}',
                     'voce': nome_voce or f"Controllo {i+1}",
                     'descrizione': desc_voce,
-                    'frequenza_tipo': freq_tipo,
-                    'giorni_preavviso': giorni_prev,
+                    'frequenza_tipo': riga[7],
+                    'giorni_preavviso': riga[8],
                     'obbligatoria': True,
                     'ordine': i + 1
                 })
         
         elif manutenzione_id and manutenzione_id > 0:
             # Formato VECCHIO: usa manutenzione_tipologie
-            c.execute("""
-                SELECT nome_manutenzione, descrizione
-                FROM manutenzione_tipologie
-                WHERE id = ?
-            """, (manutenzione_id,))
-            
-            manutenzione_info = c.fetchone()
-            if not manutenzione_info:
+            if manutenzione_id not in form['tipologie']:
                 return jsonify({'error': 'Tipologia manutenzione non trovata'}), 404
             
-            nome_manutenzione, descrizione = manutenzione_info
-            
-            # Ottieni checklist template per il vecchio formato
-            c.execute("""
-                SELECT codice_voce, voce_checklist, obbligatoria, ordine_visualizzazione
-                FROM manutenzione_checklist_template
-                WHERE manutenzione_id = ?
-                ORDER BY ordine_visualizzazione
-            """, (manutenzione_id,))
+            nome_manutenzione, descrizione = form['tipologie'][manutenzione_id]
             
-            checklist = c.fetchall()
+            # Checklist template per il vecchio formato
             checklist_items = [
                 {
                     'scadenza_id': scadenza_id,
-                    'codice': row[0],
-                    'voce': row[1],
-                    'obbligatoria': bool(row[2]),
-                    'ordine': row[3]
-                } for row in checklist
+                    'codice': codice,
+                    'voce': voce,
+                    'obbligatoria': obbligatoria,
+                    'ordine': ordine
+                } for codice, voce, obbligatoria, ordine in form['template'].get(manutenzione_id, [])
             ]
             
         elif checklist_voce_id:
             # Formato NUOVO: singola voce checklist
-            c.execute("""
-                SELECT nome_voce, descrizione
-                FROM manutenzione_programmata_checklist
-                WHERE id = ?
-            """, (checklist_voce_id,))
-            
-            voce_info = c.fetchone()
-            if not voce_info:
-                return jsonify({'error': 'Voce checklist non trovata'}), 404
-            
-            nome_voce, descrizione_voce = voce_info
+            nome_voce, descrizione_voce = form['voci'][checklist_voce_id]
             nome_manutenzione = nome_voce or f"Manutenzione ({frequenza_tipo})"
             descrizione = descrizione_voce or f"Controllo {nome_voce} con frequenza {frequenza_tipo}"
             
@@ -397,8 +569,6 @@ def get_form_scadenza(scadenza_id):
         else:
             return jsonify({'error': 'Scadenza malformata: manca manutenzione_id e checklist_voce_id'}), 400
         
-        conn.close()
-        
         return jsonify({
             'scadenza': {
                 'id': scadenza_id,
@@ -418,187 +588,186 @@ def get_form_scadenza(scadenza_id):
         traceback.print_exc()
         return jsonify({'error': f'Errore recupero form: {e}'}), 500
 
-@bp.route('/completa-scadenza', methods=['POST'])
-def completa_scadenza_con_checklist():
-    """Completa una scadenza con i risultati della checklist"""
+def prossima_data_ricorrenza(data_scadenza_str, frequenza_tipo):
+    """
+    Prossima data di una scadenza completata (senza frequenza: mensile).
+    Solleva OperazioneNonValida se la frequenza è sconosciuta o la data non è utilizzabile.
+    """
+    frequenza = (frequenza_tipo or '').lower()
+    if frequenza and frequenza not in FREQUENZE_MESI and frequenza not in FREQUENZE_SETTIMANE:
+        raise OperazioneNonValida(f"Frequenza '{frequenza_tipo}' non valida")
     try:
-        data = request.get_json()
-        if not data:
-            return jsonify({'error': 'Dati mancanti'}), 400
-        
-        scadenza_id = data.get('scadenza_id')
-        operatore = data.get('operatore')
-        note_generali = data.get('note', '')
-        checklist_risultati = data.get('checklist', [])
-        
-        if not scadenza_id or not operatore:
-            return jsonify({'error': 'scadenza_id e operatore sono obbligatori'}), 400
-        
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        
-        # Aggiorna scadenza come completata
+        return calcola_prossima_data(parse_data_scadenza(data_scadenza_str), frequenza)
+    except (TypeError, ValueError, OverflowError) as e:
+        raise OperazioneNonValida(f"Data scadenza '{data_scadenza_str}' non valida: {e}")
+
+def esegui_completa_scadenza(c, data):
+    """
+    Completa una scadenza con i risultati della checklist usando il cursore del chiamante.
+    Non esegue commit: l'eventuale alert Telegram è accodato nella stessa transazione.
+    Solleva OperazioneNonValida se i dati non sono validi o la scadenza non esiste più.
+    """
+    scadenza_id = data.get('scadenza_id')
+    operatore = data.get('operatore')
+    note_generali = data.get('note', '') or ''
+    checklist_risultati = data.get('checklist', []) or []
+
+    if not scadenza_id or not operatore:
+        raise OperazioneNonValida('scadenza_id e operatore sono obbligatori')
+    if not str(scadenza_id).isdigit():
+        raise OperazioneNonValida(f'Scadenza {scadenza_id} non trovata')
+    if not isinstance(note_generali, str):
+        raise OperazioneNonValida('note deve essere un testo')
+    if not isinstance(checklist_risultati, list) or not all(isinstance(r, dict) for r in checklist_risultati):
+        raise OperazioneNonValida('checklist deve essere una lista di oggetti')
+
+    # Aggiorna scadenza come completata
+    c.execute("""
+        UPDATE scadenze_calendario 
+        SET stato = 'completata', 
+            data_completamento = ?, 
+            operatore_completamento = ?,
+            note_completamento = ?,
+            updated_at = ?
+        WHERE id = ?
+    """, (
+        datetime.datetime.now().isoformat(),
+        operatore,
+        note_generali,
+        datetime.datetime.now().isoformat(),
+        scadenza_id
+    ))
+    # Scadenza eliminata mentre il dispositivo era offline: rifiuto definitivo, non errore del server
+    if c.rowcount == 0:
+        raise OperazioneNonValida(f'Scadenza {scadenza_id} non trovata')
+    
+    # Salva risultati checklist
+    for risultato in checklist_risultati:
         c.execute("""
-            UPDATE scadenze_calendario 
-            SET stato = 'completata', 
-                data_completamento = ?, 
-                operatore_completamento = ?,
-                note_completamento = ?,
-                updated_at = ?
-            WHERE id = ?
+            INSERT INTO manutenzione_checklist_risultati
+            (scadenza_id, codice_voce, esito, note_voce, created_at)
+            VALUES (?, ?, ?, ?, ?)
+        """, (
+            scadenza_id,
+            risultato.get('codice'),
+            risultato.get('esito', 'eseguito'),
+            risultato.get('note', ''),
+            datetime.datetime.now().isoformat()
+        ))
+    
+    # Ottieni dettagli scadenza completata per creare la prossima
+    c.execute("""
+        SELECT s.civico, s.asset, s.asset_tipo, s.data_scadenza, s.checklist_voce_id, 
+               s.frequenza_tipo, s.giorni_preavviso, 
+               COALESCE(mpc.nome_voce, 'Manutenzione') as nome_manutenzione,
+               COALESCE(mpc.descrizione, '') as descrizione
+        FROM scadenze_calendario s
+        LEFT JOIN manutenzione_programmata_checklist mpc ON s.checklist_voce_id = mpc.id
+        WHERE s.id = ?
+    """, (scadenza_id,))
+    
+    scadenza_completata = c.fetchone()
+    
+    # Genera alert se ci sono note generali
+    if note_generali.strip() and scadenza_completata:
+        c.execute("""
+            INSERT INTO alert (tipo, titolo, descrizione, data_creazione, civico, asset, stato, note, operatore)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
         """, (
+            'non_conformita',
+            f"Note manutenzione programmata: {scadenza_completata[1]}",
+            f"Manutenzione programmata {scadenza_completata[2]}",
             datetime.datetime.now().isoformat(),
-            operatore,
+            scadenza_completata[0],
+            scadenza_completata[1],
+            'aperto',
             note_generali,
-            datetime.datetime.now().isoformat(),
-            scadenza_id
+            operatore
         ))
         
-        # Salva risultati checklist
-        for risultato in checklist_risultati:
-            c.execute("""
-                INSERT INTO manutenzione_checklist_risultati
-                (scadenza_id, codice_voce, esito, note_voce, created_at)
-                VALUES (?, ?, ?, ?, ?)
-            """, (
-                scadenza_id,
-                risultato.get('codice'),
-                risultato.get('esito', 'eseguito'),
-                risultato.get('note', ''),
-                datetime.datetime.now().isoformat()
-            ))
+        alert_id = c.lastrowid
+
+        # Accoda l'alert su Telegram nella transazione della scadenza
+        alert_data = {
+            'tipo': 'non_conformita',
+            'titolo': f"Note manutenzione programmata: {scadenza_completata[1]}",
+            'descrizione': f"Manutenzione programmata {scadenza_completata[2]}",
+            'civico': scadenza_completata[0],
+            'asset': scadenza_completata[1],
+            'note': note_generali,
+            'operatore': operatore
+        }
+        send_alert_to_telegram(alert_data, cursor=c, alert_id=alert_id)
+    
+    # Crea la prossima scadenza ricorrente
+    if scadenza_completata:
+        civico, asset, asset_tipo, data_scadenza_str, checklist_voce_id, frequenza_tipo, giorni_preavviso, nome_manutenzione, descrizione = scadenza_completata
         
-        # Ottieni dettagli scadenza completata per creare la prossima
-        c.execute("""
-            SELECT s.civico, s.asset, s.asset_tipo, s.data_scadenza, s.checklist_voce_id, 
-                   s.frequenza_tipo, s.giorni_preavviso, 
-                   COALESCE(mpc.nome_voce, 'Manutenzione') as nome_manutenzione,
-                   COALESCE(mpc.descrizione, '') as descrizione
-            FROM scadenze_calendario s
-            LEFT JOIN manutenzione_programmata_checklist mpc ON s.checklist_voce_id = mpc.id
-            WHERE s.id = ?
-        """, (scadenza_id,))
+        # Calcola la prossima data di scadenza - gestisce diversi formati di data
+        prossima_data = prossima_data_ricorrenza(data_scadenza_str, frequenza_tipo)
         
-        scadenza_completata = c.fetchone()
+        # Crea la nuova scadenza ricorrente
+        c.execute("""
+            INSERT INTO scadenze_calendario 
+            (manutenzione_id, civico, asset, asset_tipo, data_scadenza, checklist_voce_id, 
+             frequenza_tipo, giorni_preavviso, 
+             stato, created_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (
+            -1,  # Placeholder per compatibilità con constraint NOT NULL
+            civico,
+            asset,
+            asset_tipo,
+            prossima_data.isoformat(),
+            checklist_voce_id,
+            frequenza_tipo,
+            giorni_preavviso,
+            'programmata',
+            datetime.datetime.now().isoformat(),
+            datetime.datetime.now().isoformat()
+        ))
         
-        # Genera alert se ci sono note generali
-        if note_generali.strip() and scadenza_completata:
-            c.execute("""
-                INSERT INTO alert (tipo, titolo, descrizione, data_creazione, civico, asset, stato, note, operatore)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
-                'non_conformita',
-                f"Note manutenzione programmata: {scadenza_completata[1]}",
-                f"Manutenzione programmata {scadenza_completata[2]}",
-                datetime.datetime.now().isoformat(),
-                scadenza_completata[0],
-                scadenza_completata[1],
-                'aperto',
-                note_generali,
-                operatore
-            ))
-            
-            # Invia alert su Telegram
-            alert_data = {
-                'tipo': 'non_conformita',
-                'titolo': f"Note manutenzione programmata: {scadenza_completata[1]}",
-                'descrizione': f"Manutenzione programmata {scadenza_completata[2]}",
-                'civico': scadenza_completata[0],
-                'asset': scadenza_completata[1],
-                'note': note_generali,
-                'operatore': operatore
-            }
-            send_alert_to_telegram(alert_data)
+        print(f"[DEBUG] Creata nuova scadenza ricorrente per {asset} - prossima data: {prossima_data}")
+
+@bp.route('/completa-scadenza', methods=['POST'])
+def completa_scadenza_con_checklist():
+    """Completa una scadenza con i risultati della checklist"""
+    try:
+        data = request.get_json()
+        if not data:
+            return jsonify({'error': 'Dati mancanti'}), 400
+
+        if not data.get('scadenza_id') or not data.get('operatore'):
+            return jsonify({'error': 'scadenza_id e operatore sono obbligatori'}), 400
+
+        try:
+            chiave = chiave_da_richiesta()
+        except OperazioneNonValida as e:
+            return jsonify({'error': str(e)}), 400
         
-        # Crea la prossima scadenza ricorrente
-        if scadenza_completata:
-            civico, asset, asset_tipo, data_scadenza_str, checklist_voce_id, frequenza_tipo, giorni_preavviso, nome_manutenzione, descrizione = scadenza_completata
-            
-            # Calcola la prossima data di scadenza - gestisce diversi formati di data
-            try:
-                # Prova prima con formato ISO completo
-                if 'T' in data_scadenza_str:
-                    data_attuale = datetime.datetime.fromisoformat(data_scadenza_str).date()
-                else:
-                    # Formato solo data
-                    data_attuale = datetime.datetime.strptime(data_scadenza_str, '%Y-%m-%d').date()
-            except ValueError:
-                # Fallback: usa data odierna
-                data_attuale = datetime.date.today()
-                print(f"[WARNING] Formato data non riconosciuto: {data_scadenza_str}, usando data odierna")
-            
-            if frequenza_tipo == "settimanale":
-                prossima_data = data_attuale + datetime.timedelta(weeks=1)
-            elif frequenza_tipo == "bisettimanale":
-                prossima_data = data_attuale + datetime.timedelta(weeks=2)
-            elif frequenza_tipo == "mensile":
-                # Aggiungi un mese
-                if data_attuale.month == 12:
-                    prossima_data = data_attuale.replace(year=data_attuale.year + 1, month=1)
-                else:
-                    prossima_data = data_attuale.replace(month=data_attuale.month + 1)
-            elif frequenza_tipo == "bimestrale":
-                # Aggiungi 2 mesi
-                new_month = data_attuale.month + 2
-                new_year = data_attuale.year
-                if new_month > 12:
-                    new_month -= 12
-                    new_year += 1
-                prossima_data = data_attuale.replace(year=new_year, month=new_month)
-            elif frequenza_tipo == "trimestrale":
-                # Aggiungi 3 mesi
-                new_month = data_attuale.month + 3
-                new_year = data_attuale.year
-                if new_month > 12:
-                    new_month -= 12
-                    new_year += 1
-                prossima_data = data_attuale.replace(year=new_year, month=new_month)
-            elif frequenza_tipo == "semestrale":
-                # Aggiungi 6 mesi
-                new_month = data_attuale.month + 6
-                new_year = data_attuale.year
-                if new_month > 12:
-                    new_month -= 12
-                    new_year += 1
-                prossima_data = data_attuale.replace(year=new_year, month=new_month)
-            elif frequenza_tipo == "annuale":
-                prossima_data = data_attuale.replace(year=data_attuale.year + 1)
-            elif frequenza_tipo == "biennale":
-                prossima_data = data_attuale.replace(year=data_attuale.year + 2)
-            else:
-                # Default mensile
-                if data_attuale.month == 12:
-                    prossima_data = data_attuale.replace(year=data_attuale.year + 1, month=1)
-                else:
-                    prossima_data = data_attuale.replace(month=data_attuale.month + 1)
-            
-            # Crea la nuova scadenza ricorrente
-            c.execute("""
-                INSERT INTO scadenze_calendario 
-                (manutenzione_id, civico, asset, asset_tipo, data_scadenza, checklist_voce_id, 
-                 frequenza_tipo, giorni_preavviso, 
-                 stato, created_at, updated_at)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
-                -1,  # Placeholder per compatibilità con constraint NOT NULL
-                civico,
-                asset,
-                asset_tipo,
-                prossima_data.isoformat(),
-                checklist_voce_id,
-                frequenza_tipo,
-                giorni_preavviso,
-                'programmata',
-                datetime.datetime.now().isoformat(),
-                datetime.datetime.now().isoformat()
-            ))
-            
-            print(f"[DEBUG] Creata nuova scadenza ricorrente per {asset} - prossima data: {prossima_data}")
+        conn = sqlite3.connect(DB_PATH)
+        c = conn.cursor()
+
+        # Reinvio dalla coda offline di un completamento già applicato: stessa risposta, nessuna modifica
+        gia_applicata = apri_operazione(conn, chiave)
+        if gia_applicata:
+            conn.close()
+            stato_http, risposta = gia_applicata
+            return jsonify(risposta), stato_http
+
+        try:
+            esegui_completa_scadenza(c, data)
+        except OperazioneNonValida as e:
+            conn.close()
+            return jsonify({'error': str(e)}), 400
+        risposta = {'ok': True, 'message': 'Manutenzione completata con successo'}
+        if chiave:
+            registra_operazioni_sincronizzate(c, [(chiave, 'completa-scadenza', 200, risposta, data.get('operatore'))])
         
         conn.commit()
         conn.close()
         
-        return jsonify({'ok': True, 'message': 'Manutenzione completata con successo'})
+        return jsonify(risposta)
         
     except Exception as e:
         if 'conn' in locals():
@@ -886,6 +1055,7 @@ def add_checklist_item():
         item_id = c.lastrowid
         conn.commit()
         conn.close()
+        invalida_cache_form()
         
         return jsonify({'id': item_id, 'message': 'Voce checklist aggiunta con successo'})
         
@@ -917,6 +1087,7 @@ def delete_checklist_item(item_id):
         
         conn.commit()
         conn.close()
+        invalida_cache_form()
         
         return jsonify({'message': 'Voce checklist eliminata con successo'})
         
@@ -973,6 +1144,7 @@ def update_checklist_item(item_id):
         
         conn.commit()
         conn.close()
+        invalida_cache_form()
         
         return jsonify({'message': 'Voce checklist aggiornata con successo'})
         
@@ -982,18 +1154,168 @@ def update_checklist_item(item_id):
         traceback.print_exc()
         return jsonify({'error': f'Errore aggiornamento voce checklist: {e}'}), 500
 
+@bp.route('/manutenzioni/checklist-items/<int:item_id>/ripianifica', methods=['POST'])
+def ripianifica_voce_checklist(item_id):
+    """
+    Ricalcola in un'unica transazione frequenza, preavviso e date di tutte le scadenze programmate
+    di una voce checklist.
+    Payload: frequenza_tipo (opzionale), giorni_preavviso (opzionale), civico (filtro opzionale),
+    dry_run (default true: restituisce solo il diff).
+    Con una nuova frequenza la prossima data è ricalcolata a partire dall'ultima esecuzione
+    registrata nello storico per lo stesso asset; senza esecuzioni la data attuale viene mantenuta.
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        dry_run = data.get('dry_run', True) is not False
+
+        frequenza_nuova = (data.get('frequenza_tipo') or '').lower() or None
+        if frequenza_nuova and frequenza_nuova not in FREQUENZE_MESI and frequenza_nuova not in FREQUENZE_SETTIMANE:
+            return jsonify({'error': f'Tipo frequenza non valido: {frequenza_nuova}'}), 400
+        preavviso_nuovo = data.get('giorni_preavviso')
+        if preavviso_nuovo is not None:
+            try:
+                preavviso_nuovo = int(preavviso_nuovo)
+            except (TypeError, ValueError):
+                return jsonify({'error': 'giorni_preavviso deve essere numerico'}), 400
+            if preavviso_nuovo < 0:
+                return jsonify({'error': 'giorni_preavviso non può essere negativo'}), 400
+        if frequenza_nuova is None and preavviso_nuovo is None:
+            return jsonify({'error': 'Indicare frequenza_tipo e/o giorni_preavviso'}), 400
+
+        conn = sqlite3.connect(DB_PATH)
+        c = conn.cursor()
+
+        c.execute("SELECT nome_voce FROM manutenzione_programmata_checklist WHERE id = ?", (item_id,))
+        voce = c.fetchone()
+        if not voce:
+            conn.close()
+            return jsonify({'error': 'Voce checklist non trovata'}), 404
+
+        query = """
+            SELECT id, civico, asset, data_scadenza, data_prossima_scadenza, frequenza_tipo, giorni_preavviso
+            FROM scadenze_calendario
+            WHERE checklist_voce_id = ? AND stato = 'programmata'
+        """
+        params = [item_id]
+        if data.get('civico'):
+            query += " AND civico = ?"
+            params.append(str(data['civico']))
+        c.execute(query + " ORDER BY civico, asset", params)
+        righe = c.fetchall()
+
+        # Ultima scadenza eseguita per asset, in una sola query raggruppata
+        ultime_esecuzioni = {}
+        if frequenza_nuova:
+            c.execute("""
+                SELECT civico, asset, MAX(data_scadenza_originale)
+                FROM scadenze_storico_esecuzioni
+                WHERE checklist_voce_id = ?
+                GROUP BY civico, asset
+            """, (item_id,))
+            ultime_esecuzioni = {(r[0], r[1]): r[2] for r in c.fetchall()}
+
+        diff = []
+        aggiornamenti = []
+        adesso = datetime.datetime.now().isoformat()
+        for sid, civico, asset, data_scadenza, data_prossima, frequenza, preavviso in righe:
+            nuova_frequenza = frequenza_nuova or frequenza
+            nuovo_preavviso = preavviso if preavviso_nuovo is None else preavviso_nuovo
+            nuova_data = data_scadenza
+            if frequenza_nuova and frequenza_nuova != (frequenza or '').lower():
+                ultima = ultime_esecuzioni.get((civico, asset))
+                if ultima:
+                    nuova_data = data_canonica(calcola_prossima_data(parse_data_scadenza(ultima), frequenza_nuova))
+            nuova_prossima = data_canonica(calcola_prossima_data(parse_data_scadenza(nuova_data), nuova_frequenza))
+
+            if (nuova_frequenza, nuovo_preavviso, nuova_data, nuova_prossima) == (frequenza, preavviso, data_scadenza, data_prossima):
+                continue
+            diff.append({
+                'scadenza_id': sid,
+                'civico': civico,
+                'asset': asset,
+                'prima': {'frequenza_tipo': frequenza, 'giorni_preavviso': preavviso,
+                          'data_scadenza': data_scadenza, 'data_prossima_scadenza': data_prossima},
+                'dopo': {'frequenza_tipo': nuova_frequenza, 'giorni_preavviso': nuovo_preavviso,
+                         'data_scadenza': nuova_data, 'data_prossima_scadenza': nuova_prossima}
+            })
+            # La condizione sulla data letta evita di sovrascrivere completamenti concorrenti
+            aggiornamenti.append((nuova_frequenza, nuovo_preavviso, nuova_data, nuova_prossima, adesso, sid, data_scadenza))
+
+        aggiornate = 0
+        if not dry_run and aggiornamenti:
+            c.executemany("""
+                UPDATE scadenze_calendario
+                SET frequenza_tipo = ?, giorni_preavviso = ?, data_scadenza = ?,
+                    data_prossima_scadenza = ?, updated_at = ?
+                WHERE id = ? AND data_scadenza = ? AND stato = 'programmata'
+            """, aggiornamenti)
+            aggiornate = c.rowcount
+            conn.commit()
+        conn.close()
+
+        print(f"[DEBUG] Ripianificazione voce {item_id}: {len(righe)} scadenze, {len(diff)} modificate, dry_run={dry_run}")
+
+        return jsonify({
+            'ok': True,
+            'dry_run': dry_run,
+            'voce': voce[0],
+            'scadenze_analizzate': len(righe),
+            'scadenze_modificate': len(diff),
+            'scadenze_aggiornate': aggiornate,
+            'diff': diff
+        })
+
+    except Exception as e:
+        print("[DEBUG][ERRORE RIPIANIFICA VOCE]", e)
+        traceback.print_exc()
+        return jsonify({'error': f'Errore ripianificazione voce checklist: {e}'}), 500
+
 # --- API SCADENZE CALENDARIO ---
 
+# Colonne di /scadenze, nello stesso ordine della query SQL (usate anche dall'indice residente)
+COLONNE_SCADENZE = ('id', 'civico', 'asset', 'asset_tipo', 'data_scadenza', 'stato',
+                    'data_completamento', 'operatore_completamento', 'note_completamento',
+                    'data_prossima_scadenza', 'frequenza_tipo', 'giorni_preavviso',
+                    'nome_manutenzione', 'descrizione', 'giorni_preavviso_final',
+                    'giorni_rimanenti', 'data_scadenza_formatted')
+
+def formatta_scadenza_calendario(row):
+    return {
+        'id': row[0],
+        'civico': row[1],
+        'asset': row[2],
+        'asset_tipo': row[3],
+        'data_scadenza': row[16] or row[4],
+        'giorni_rimanenti': row[15],
+        'stato': row[5],
+        'data_completamento': row[6],
+        'operatore_completamento': row[7],
+        'note_completamento': row[8],
+        'data_prossima_scadenza': row[9],
+        'frequenza_tipo': row[10],
+        'giorni_preavviso': row[11],
+        'nome_manutenzione': row[12],
+        'descrizione': row[13],
+        'giorni_preavviso_final': row[14]
+    }
+
 @bp.route('/scadenze', methods=['GET'])
 def get_scadenze_calendario():
     """Ottiene tutte le scadenze programmate"""
     try:
         civico = request.args.get('civico')
+        asset = request.args.get('asset')
         asset_tipo = request.args.get('asset_tipo')
         stato = request.args.get('stato', 'programmata')
         
         conn = sqlite3.connect(DB_PATH)
         c = conn.cursor()
+
+        rows = righe_indice_calendario(c, COLONNE_SCADENZE, civico=civico, asset=asset,
+                                       asset_tipo=asset_tipo, stato=stato)
+        if rows is not None:
+            conn.close()
+            return jsonify({'scadenze': [formatta_scadenza_calendario(row) for row in rows]})
         
         # Query per formato nuovo con fallback per compatibilità
         query = """
@@ -1002,8 +1324,9 @@ def get_scadenze_calendario():
                    s.data_prossima_scadenza, s.frequenza_tipo, s.giorni_preavviso,
                    COALESCE(c.nome_voce, m.nome_manutenzione) as nome_manutenzione,
                    COALESCE(c.descrizione, m.descrizione) as descrizione,
-                   COALESCE(s.giorni_preavviso, m.giorni_preavviso) as giorni_preavviso_final
-            FROM scadenze_calendario s
+                   COALESCE(s.giorni_preavviso, m.giorni_preavviso) as giorni_preavviso_final,
+                   s.giorni_rimanenti, s.data_scadenza_formatted
+            FROM v_scadenze_calendario s
             LEFT JOIN manutenzione_programmata_checklist c ON s.checklist_voce_id = c.id
             LEFT JOIN manutenzione_tipologie m ON s.manutenzione_id = m.id
             WHERE 1=1
@@ -1014,6 +1337,10 @@ def get_scadenze_calendario():
             query += " AND s.civico = ?"
             params.append(civico)
         
+        if asset:
+            query += " AND s.asset = ?"
+            params.append(asset)
+        
         if asset_tipo:
             query += " AND s.asset_tipo = ?"
             params.append(asset_tipo)
@@ -1028,35 +1355,7 @@ def get_scadenze_calendario():
         rows = c.fetchall()
         conn.close()
         
-        scadenze = []
-        for row in rows:
-            # Calcola giorni rimanenti
-            try:
-                data_scadenza = datetime.datetime.fromisoformat(row[4])
-                giorni_rimanenti = (data_scadenza - datetime.datetime.now()).days
-                data_scadenza_formatted = data_scadenza.strftime('%d/%m/%Y')
-            except:
-                giorni_rimanenti = None
-                data_scadenza_formatted = row[4]
-            
-            scadenze.append({
-                'id': row[0],
-                'civico': row[1],
-                'asset': row[2],
-                'asset_tipo': row[3],
-                'data_scadenza': data_scadenza_formatted,
-                'giorni_rimanenti': giorni_rimanenti,
-                'stato': row[5],
-                'data_completamento': row[6],
-                'operatore_completamento': row[7],
-                'note_completamento': row[8],
-                'data_prossima_scadenza': row[9],
-                'frequenza_tipo': row[10],
-                'giorni_preavviso': row[11],
-                'nome_manutenzione': row[12],
-                'descrizione': row[13],
-                'giorni_preavviso_final': row[14]
-            })
+        scadenze = [formatta_scadenza_calendario(row) for row in rows]
         
         print(f"[DEBUG] Trovate {len(scadenze)} scadenze")
         return jsonify({'scadenze': scadenze})
@@ -1103,44 +1402,14 @@ def add_scadenza_calendario():
         
         print(f"[DEBUG] Voce checklist trovata: {voce_checklist[0]}")
         
-        # Calcola frequenza in mesi basata sul tipo
-        frequenza_mesi_map = {
-            'settimanale': 0.25,  # ~1 settimana = 1/4 di mese
-            'bisettimanale': 0.5,  # 2 settimane = 1/2 mese
-            'mensile': 1,
-            'bimestrale': 2,
-            'trimestrale': 3,
-            'semestrale': 6,
-            'annuale': 12,
-            'biennale': 24
-        }
-        
         frequenza_tipo = data['frequenza_tipo'].lower()
-        if frequenza_tipo not in frequenza_mesi_map:
+        if frequenza_tipo not in FREQUENZE_MESI and frequenza_tipo not in FREQUENZE_SETTIMANE:
             conn.close()
             print(f"[DEBUG] Tipo frequenza non valido: {frequenza_tipo}")
             return jsonify({'error': f'Tipo frequenza non valido: {frequenza_tipo}'}), 400
         
-        frequenza_mesi = frequenza_mesi_map[frequenza_tipo]
-        print(f"[DEBUG] Frequenza calcolata: {frequenza_mesi} mesi per tipo '{frequenza_tipo}'")
-        
-        # Calcola data prossima scadenza con fallback robusto
-        if HAS_DATEUTIL:
-            if frequenza_mesi < 1:
-                # Per frequenze sotto il mese, usa giorni
-                giorni = int(frequenza_mesi * 30)
-                prossima_scadenza = data_scadenza + datetime.timedelta(days=giorni)
-            else:
-                prossima_scadenza = data_scadenza + relativedelta(months=int(frequenza_mesi))
-            data_prossima = prossima_scadenza.isoformat()
-            print(f"[DEBUG] Prossima scadenza calcolata con dateutil: {data_prossima}")
-        else:
-            print("[DEBUG] Dateutil non disponibile, uso fallback")
-            # Fallback - approssimazione con 30 giorni per mese
-            giorni_da_aggiungere = int(frequenza_mesi * 30)
-            prossima_scadenza = data_scadenza + datetime.timedelta(days=giorni_da_aggiungere)
-            data_prossima = prossima_scadenza.isoformat()
-            print(f"[DEBUG] Prossima scadenza calcolata con fallback: {data_prossima}")
+        data_prossima = data_canonica(calcola_prossima_data(data_scadenza.date(), frequenza_tipo))
+        print(f"[DEBUG] Prossima scadenza calcolata: {data_prossima}")
         
         print(f"[DEBUG] Inserendo scadenza nel database...")
         # Aggiornamento query per nuovo formato - salvo i nuovi campi + manutenzione_id placeholder
@@ -1156,7 +1425,7 @@ def add_scadenza_calendario():
             data['civico'],
             data['asset'],
             data['asset_tipo'],
-            data_scadenza.isoformat(),
+            data_canonica(data_scadenza),
             data_prossima,
             datetime.datetime.now().isoformat()
         ))
@@ -1174,9 +1443,168 @@ def add_scadenza_calendario():
         traceback.print_exc()
         return jsonify({'error': f'Errore creazione scadenza: {e}'}), 500
 
-@bp.route('/scadenze-raggruppate', methods=['GET'])
-def get_scadenze_raggruppate():
-    """Ottiene le scadenze raggruppate per asset e data per la visualizzazione"""
+@bp.route('/scadenze/bulk', methods=['POST'])
+def add_scadenze_bulk():
+    """
+    Programma in blocco le scadenze per tutti gli asset di un tipo (o per una lista di asset).
+    Payload:
+      asset_tipo (obbligatorio), assets (lista id_aziendale, opzionale), civico (filtro opzionale),
+      checklist_voce_ids (opzionale, default tutte le voci attive del tipo),
+      frequenza_tipo, giorni_preavviso, data_inizio (YYYY-MM-DD),
+      scaglionamento: {'tipo': 'nessuno'|'giornaliero', 'asset_per_giorno': 1, 'intervallo_giorni': 1},
+      dry_run (opzionale)
+    Le scadenze già programmate per la stessa coppia asset/voce vengono saltate.
+    """
+    try:
+        data = request.get_json()
+        if not data:
+            return jsonify({'error': 'Dati mancanti'}), 400
+
+        for field in ['asset_tipo', 'frequenza_tipo', 'giorni_preavviso', 'data_inizio']:
+            if not data.get(field):
+                return jsonify({'error': f'Campo richiesto mancante: {field}'}), 400
+
+        asset_tipo = data['asset_tipo']
+        frequenza_tipo = data['frequenza_tipo'].lower()
+        if frequenza_tipo not in FREQUENZE_MESI and frequenza_tipo not in FREQUENZE_SETTIMANE:
+            return jsonify({'error': f'Tipo frequenza non valido: {frequenza_tipo}'}), 400
+
+        try:
+            giorni_preavviso = int(data['giorni_preavviso'])
+            data_inizio = datetime.datetime.strptime(data['data_inizio'], '%Y-%m-%d')
+        except ValueError:
+            return jsonify({'error': 'giorni_preavviso deve essere numerico e data_inizio nel formato YYYY-MM-DD'}), 400
+
+        scaglionamento = data.get('scaglionamento') or {}
+        tipo_scaglionamento = scaglionamento.get('tipo', 'nessuno')
+        if tipo_scaglionamento not in ('nessuno', 'giornaliero'):
+            return jsonify({'error': f'Scaglionamento non valido: {tipo_scaglionamento}'}), 400
+        try:
+            asset_per_giorno = max(int(scaglionamento.get('asset_per_giorno', 1)), 1)
+            intervallo_giorni = max(int(scaglionamento.get('intervallo_giorni', 1)), 1)
+            voce_ids_richieste = [int(v) for v in data.get('checklist_voce_ids') or []]
+        except (TypeError, ValueError):
+            return jsonify({'error': 'Parametri di scaglionamento o checklist_voce_ids non validi'}), 400
+
+        # 1. Asset coinvolti (da gestman.db)
+        gestman_db_path = os.path.join(os.path.dirname(__file__), 'gestman.db')
+        gestman_conn = sqlite3.connect(gestman_db_path)
+        gestman_c = gestman_conn.cursor()
+
+        query_assets = "SELECT id_aziendale, civico_numero, tipo FROM assets WHERE tipo = ?"
+        params_assets = [asset_tipo]
+        if data.get('civico'):
+            query_assets += " AND civico_numero = ?"
+            params_assets.append(data['civico'])
+        query_assets += " ORDER BY civico_numero, id_aziendale"
+        gestman_c.execute(query_assets, params_assets)
+        assets = gestman_c.fetchall()
+        gestman_conn.close()
+
+        assets_richiesti = data.get('assets')
+        assets_non_trovati = []
+        if assets_richiesti:
+            richiesti = set(assets_richiesti)
+            assets = [a for a in assets if a[0] in richiesti]
+            assets_non_trovati = sorted(richiesti - {a[0] for a in assets})
+
+        if not assets:
+            return jsonify({'error': f'Nessun asset di tipo "{asset_tipo}" trovato'}), 404
+
+        conn = sqlite3.connect(DB_PATH)
+        c = conn.cursor()
+
+        # 2. Validazione voci checklist (una sola query)
+        c.execute("""
+            SELECT id, nome_voce FROM manutenzione_programmata_checklist
+            WHERE asset_tipo = ? AND attiva = 1
+            ORDER BY ordine_visualizzazione
+        """, (asset_tipo,))
+        voci_attive = dict(c.fetchall())
+
+        voce_ids = voce_ids_richieste or list(voci_attive.keys())
+        voci_non_valide = [v for v in voce_ids if v not in voci_attive]
+        if voci_non_valide:
+            conn.close()
+            return jsonify({'error': f'Voci checklist non valide per {asset_tipo}: {voci_non_valide}'}), 400
+        if not voce_ids:
+            conn.close()
+            return jsonify({'error': f'Nessuna voce checklist attiva per {asset_tipo}'}), 400
+
+        # 3. Coppie asset/voce già programmate (da saltare)
+        c.execute("""
+            SELECT asset, checklist_voce_id FROM scadenze_calendario
+            WHERE asset_tipo = ? AND stato = 'programmata' AND checklist_voce_id IS NOT NULL
+        """, (asset_tipo,))
+        esistenti = set(c.fetchall())
+
+        # 4. Calcolo date: una sola data per slot di scaglionamento
+        date_per_slot = {}
+        now = datetime.datetime.now().isoformat()
+        righe = []
+        saltate = 0
+
+        for posizione, (id_aziendale, civico_numero, _) in enumerate(assets):
+            slot = posizione // asset_per_giorno if tipo_scaglionamento == 'giornaliero' else 0
+            if slot not in date_per_slot:
+                data_scadenza = data_inizio + datetime.timedelta(days=slot * intervallo_giorni)
+                date_per_slot[slot] = (
+                    data_canonica(data_scadenza),
+                    data_canonica(calcola_prossima_data(data_scadenza.date(), frequenza_tipo))
+                )
+            data_scadenza_iso, data_prossima_iso = date_per_slot[slot]
+
+            for voce_id in voce_ids:
+                if (id_aziendale, voce_id) in esistenti:
+                    saltate += 1
+                    continue
+                righe.append((
+                    -1,  # Placeholder per compatibilità con constraint NOT NULL
+                    voce_id, frequenza_tipo, giorni_preavviso,
+                    civico_numero, id_aziendale, asset_tipo,
+                    data_scadenza_iso, data_prossima_iso, now
+                ))
+
+        if not data.get('dry_run'):
+            c.executemany("""
+                INSERT INTO scadenze_calendario
+                (manutenzione_id, checklist_voce_id, frequenza_tipo, giorni_preavviso, civico, asset, asset_tipo,
+                 data_scadenza, data_prossima_scadenza, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, righe)
+            conn.commit()
+        conn.close()
+
+        date_usate = sorted(d[0] for d in date_per_slot.values())
+        print(f"[DEBUG] Programmazione bulk {asset_tipo}: {len(righe)} scadenze, {saltate} saltate, dry_run={bool(data.get('dry_run'))}")
+
+        return jsonify({
+            'ok': True,
+            'dry_run': bool(data.get('dry_run')),
+            'asset_tipo': asset_tipo,
+            'asset_coinvolti': len(assets),
+            'voci': len(voce_ids),
+            'scadenze_create': len(righe),
+            'scadenze_saltate': saltate,
+            'assets_non_trovati': assets_non_trovati,
+            'prima_data': date_usate[0],
+            'ultima_data': date_usate[-1]
+        })
+
+    except Exception as e:
+        print("[DEBUG][ERRORE ADD SCADENZE BULK]", e)
+        traceback.print_exc()
+        return jsonify({'error': f'Errore programmazione bulk: {e}'}), 500
+
+COLONNE_SCADENZE_RAGGRUPPATE = ('id', 'civico', 'asset', 'asset_tipo', 'data_scadenza', 'stato',
+                                'data_completamento', 'operatore_completamento', 'note_completamento',
+                                'data_prossima_scadenza', 'frequenza_tipo', 'giorni_preavviso',
+                                'checklist_voce_id', 'nome_manutenzione', 'descrizione',
+                                'giorni_preavviso_final', 'giorni_rimanenti', 'data_scadenza_formatted')
+
+@bp.route('/scadenze-raggruppate', methods=['GET'])
+def get_scadenze_raggruppate():
+    """Ottiene le scadenze raggruppate per asset e data per la visualizzazione"""
     try:
         civico = request.args.get('civico')
         asset_tipo = request.args.get('asset_tipo')
@@ -1185,38 +1613,43 @@ def get_scadenze_raggruppate():
         conn = sqlite3.connect(DB_PATH)
         c = conn.cursor()
         
-        # Query per ottenere tutte le scadenze
-        query = """
-            SELECT s.id, s.civico, s.asset, s.asset_tipo, s.data_scadenza, s.stato, 
-                   s.data_completamento, s.operatore_completamento, s.note_completamento,
-                   s.data_prossima_scadenza, s.frequenza_tipo, s.giorni_preavviso,
-                   s.checklist_voce_id,
-                   COALESCE(c.nome_voce, m.nome_manutenzione) as nome_manutenzione,
-                   COALESCE(c.descrizione, m.descrizione) as descrizione,
-                   COALESCE(s.giorni_preavviso, m.giorni_preavviso) as giorni_preavviso_final
-            FROM scadenze_calendario s
-            LEFT JOIN manutenzione_programmata_checklist c ON s.checklist_voce_id = c.id
-            LEFT JOIN manutenzione_tipologie m ON s.manutenzione_id = m.id
-            WHERE 1=1
-        """
-        params = []
-        
-        if civico:
-            query += " AND s.civico = ?"
-            params.append(civico)
-        
-        if asset_tipo:
-            query += " AND s.asset_tipo = ?"
-            params.append(asset_tipo)
+        # Dall'indice residente se disponibile, altrimenti query SQLite
+        rows = righe_indice_calendario(c, COLONNE_SCADENZE_RAGGRUPPATE, civico=civico,
+                                       asset_tipo=asset_tipo, stato=stato)
+        if rows is None:
+            # Query per ottenere tutte le scadenze
+            query = """
+                SELECT s.id, s.civico, s.asset, s.asset_tipo, s.data_scadenza, s.stato, 
+                       s.data_completamento, s.operatore_completamento, s.note_completamento,
+                       s.data_prossima_scadenza, s.frequenza_tipo, s.giorni_preavviso,
+                       s.checklist_voce_id,
+                       COALESCE(c.nome_voce, m.nome_manutenzione) as nome_manutenzione,
+                       COALESCE(c.descrizione, m.descrizione) as descrizione,
+                       COALESCE(s.giorni_preavviso, m.giorni_preavviso) as giorni_preavviso_final,
+                       s.giorni_rimanenti, s.data_scadenza_formatted
+                FROM v_scadenze_calendario s
+                LEFT JOIN manutenzione_programmata_checklist c ON s.checklist_voce_id = c.id
+                LEFT JOIN manutenzione_tipologie m ON s.manutenzione_id = m.id
+                WHERE 1=1
+            """
+            params = []
+        
+            if civico:
+                query += " AND s.civico = ?"
+                params.append(civico)
+        
+            if asset_tipo:
+                query += " AND s.asset_tipo = ?"
+                params.append(asset_tipo)
             
-        if stato:
-            query += " AND s.stato = ?"
-            params.append(stato)
+            if stato:
+                query += " AND s.stato = ?"
+                params.append(stato)
         
-        query += " ORDER BY s.data_scadenza ASC, s.asset ASC"
+            query += " ORDER BY s.data_scadenza ASC, s.asset ASC"
         
-        c.execute(query, params)
-        rows = c.fetchall()
+            c.execute(query, params)
+            rows = c.fetchall()
         conn.close()
         
         # Raggruppa le scadenze per (civico, asset, data_scadenza)
@@ -1232,20 +1665,11 @@ def get_scadenze_raggruppate():
                     'data_scadenza': row[4],
                     'stato': row[5],  # Prende lo stato della prima scadenza
                     'scadenze_individuali': [],
-                    'giorni_rimanenti': None,
+                    'giorni_rimanenti': row[16],
+                    'data_scadenza_formatted': row[17] or row[4],
                     'giorni_preavviso': row[11] or 7
                 }
             
-            # Calcola giorni rimanenti
-            try:
-                data_scadenza = datetime.datetime.fromisoformat(row[4])
-                giorni_rimanenti = (data_scadenza - datetime.datetime.now()).days
-                data_scadenza_formatted = data_scadenza.strftime('%d/%m/%Y')
-                gruppi[chiave_gruppo]['giorni_rimanenti'] = giorni_rimanenti
-                gruppi[chiave_gruppo]['data_scadenza_formatted'] = data_scadenza_formatted
-            except:
-                gruppi[chiave_gruppo]['data_scadenza_formatted'] = row[4]
-            
             # Aggiungi la scadenza individuale al gruppo
             gruppi[chiave_gruppo]['scadenze_individuali'].append({
                 'id': row[0],
@@ -1401,37 +1825,15 @@ def completa_scadenza(scadenza_id):
                 
                 # Calcola prossima scadenza secondo la periodicità specifica di questa voce
                 if frequenza_tipo:
-                    frequenza_mesi_map = {
-                        'settimanale': 0.25, 'bisettimanale': 0.5, 'mensile': 1,
-                        'bimestrale': 2, 'trimestrale': 3, 'semestrale': 6, 'annuale': 12, 'biennale': 24
-                    }
-                    frequenza_mesi = frequenza_mesi_map.get(frequenza_tipo.lower(), 1)
-                    
                     try:
                         data_scadenza_dt = datetime.datetime.fromisoformat(data_scadenza)
                     except:
                         data_scadenza_dt = now
                     
-                    if HAS_DATEUTIL:
-                        if frequenza_mesi < 1:
-                            giorni = int(frequenza_mesi * 30)
-                            prossima_scadenza = data_scadenza_dt + datetime.timedelta(days=giorni)
-                        else:
-                            prossima_scadenza = data_scadenza_dt + relativedelta(months=int(frequenza_mesi))
-                    else:
-                        giorni_da_aggiungere = int(frequenza_mesi * 30)
-                        prossima_scadenza = data_scadenza_dt + datetime.timedelta(days=giorni_da_aggiungere)
+                    prossima_scadenza = calcola_prossima_data(data_scadenza_dt.date(), frequenza_tipo)
                     
                     # Calcola scadenza successiva
-                    if HAS_DATEUTIL:
-                        if frequenza_mesi < 1:
-                            giorni = int(frequenza_mesi * 30)
-                            data_successiva = prossima_scadenza + datetime.timedelta(days=giorni)
-                        else:
-                            data_successiva = prossima_scadenza + relativedelta(months=int(frequenza_mesi))
-                    else:
-                        giorni_da_aggiungere = int(frequenza_mesi * 30)
-                        data_successiva = prossima_scadenza + datetime.timedelta(days=giorni_da_aggiungere)
+                    data_successiva = calcola_prossima_data(prossima_scadenza, frequenza_tipo)
                     
                     # Crea nuova scadenza individuale
                     c.execute("""
@@ -1443,14 +1845,14 @@ def completa_scadenza(scadenza_id):
                     """, (
                         manutenzione_id or -1, checklist_voce_id,
                         civico, asset, asset_tipo,
-                        prossima_scadenza.isoformat(), data_successiva.isoformat(),
+                        data_canonica(prossima_scadenza), data_canonica(data_successiva),
                         frequenza_tipo, giorni_preavviso or 7, now.isoformat()
                     ))
                     
                     nuova_scadenza_id = c.lastrowid
                     nuove_scadenze.append({
                         'id': nuova_scadenza_id,
-                        'data_scadenza': prossima_scadenza.isoformat(),
+                        'data_scadenza': data_canonica(prossima_scadenza),
                         'frequenza_tipo': frequenza_tipo
                     })
             
@@ -1503,25 +1905,8 @@ def completa_scadenza(scadenza_id):
             else:
                 data_prossima = now + datetime.timedelta(days=30)
             
-            # Calcola frequenza per la scadenza successiva
-            if frequenza_tipo:
-                frequenza_mesi_map = {
-                    'settimanale': 0.25, 'bisettimanale': 0.5, 'mensile': 1,
-                    'bimestrale': 2, 'trimestrale': 3, 'semestrale': 6, 'annuale': 12, 'biennale': 24
-                }
-                frequenza_mesi = frequenza_mesi_map.get(frequenza_tipo.lower(), 1)
-                
-                if HAS_DATEUTIL:
-                    if frequenza_mesi < 1:
-                        giorni = int(frequenza_mesi * 30)
-                        data_successiva = data_prossima + datetime.timedelta(days=giorni)
-                    else:
-                        data_successiva = data_prossima + relativedelta(months=int(frequenza_mesi))
-                else:
-                    giorni_da_aggiungere = int(frequenza_mesi * 30)
-                    data_successiva = data_prossima + datetime.timedelta(days=giorni_da_aggiungere)
-            else:
-                data_successiva = data_prossima + datetime.timedelta(days=30)
+            # Calcola la scadenza successiva (senza frequenza: mensile)
+            data_successiva = calcola_prossima_data(data_prossima.date(), frequenza_tipo)
             
             # Crea nuova scadenza
             c.execute("""
@@ -1533,7 +1918,7 @@ def completa_scadenza(scadenza_id):
             """, (
                 manutenzione_id or -1, checklist_voce_id_legacy,
                 civico, asset, asset_tipo,
-                data_prossima.isoformat(), data_successiva.isoformat(),
+                data_canonica(data_prossima), data_canonica(data_successiva),
                 frequenza_tipo, giorni_preavviso, nome_manutenzione,
                 now.isoformat()
             ))
@@ -1554,6 +1939,85 @@ def completa_scadenza(scadenza_id):
 
 # --- SISTEMA ALERT AUTOMATICI ---
 
+def chiave_origine_alert(scadenza_id, data_scadenza):
+    """Chiave di origine di un alert scadenza: id della scadenza + data della scadenza (YYYY-MM-DD)"""
+    return f"scadenza:{scadenza_id}@{str(data_scadenza)[:10]}"
+
+# Indice "next-fire": per ogni scadenza programmata il giorno (YYYY-MM-DD) da cui deve
+# essere riesaminata dallo scheduler. All'ingresso nella finestra di preavviso vale
+# data_scadenza - giorni_preavviso; dopo ogni esame passa al giorno successivo, perché
+# finché resta programmata la scadenza genera un alert al giorno (preavviso/oggi/scaduta).
+# I trigger lo tengono allineato a inserimenti, modifiche, completamenti ed eliminazioni
+# da qualunque modulo, quindi ogni esecuzione costa quanto le sole righe dovute.
+
+SQL_GIORNI_PREAVVISO_SCADENZA = """COALESCE({s}.giorni_preavviso,
+        (SELECT m.giorni_preavviso FROM manutenzione_tipologie m WHERE m.id = {s}.manutenzione_id), 7)"""
+
+def sql_inserisci_prossimo_alert(s, sorgente=''):
+    """INSERT del primo giorno di alert per la riga {s}: NEW nei trigger, oppure alias di {sorgente}"""
+    giorni = SQL_GIORNI_PREAVVISO_SCADENZA.format(s=s)
+    return f"""
+        INSERT OR REPLACE INTO scadenze_prossimo_alert (scadenza_id, prossimo_alert)
+        SELECT {s}.id, date({s}.data_scadenza, '-' || {giorni} || ' days')
+        {sorgente}
+        WHERE {s}.stato = 'programmata'
+          AND ({s}.checklist_voce_id IS NOT NULL OR {s}.manutenzione_id IS NOT NULL)
+          AND date({s}.data_scadenza, '-' || {giorni} || ' days') IS NOT NULL"""
+
+def init_prossimo_alert_db(c):
+    """Crea l'indice del prossimo alert e i trigger che lo mantengono"""
+    c.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'scadenze_prossimo_alert'")
+    indice_esistente = c.fetchone() is not None
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS scadenze_prossimo_alert (
+        scadenza_id INTEGER PRIMARY KEY,
+        prossimo_alert TEXT NOT NULL
+    )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_prossimo_alert ON scadenze_prossimo_alert(prossimo_alert)')
+
+    c.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS trg_prossimo_alert_insert
+    AFTER INSERT ON scadenze_calendario
+    BEGIN{sql_inserisci_prossimo_alert('NEW')};
+    END
+    ''')
+    # Nuova data, preavviso o stato (completata/programmata): si riparte dalla finestra di preavviso
+    c.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS trg_prossimo_alert_update
+    AFTER UPDATE OF data_scadenza, giorni_preavviso, stato, checklist_voce_id, manutenzione_id ON scadenze_calendario
+    BEGIN
+        DELETE FROM scadenze_prossimo_alert WHERE scadenza_id = OLD.id;{sql_inserisci_prossimo_alert('NEW')};
+    END
+    ''')
+    c.execute('''
+    CREATE TRIGGER IF NOT EXISTS trg_prossimo_alert_delete
+    AFTER DELETE ON scadenze_calendario
+    BEGIN
+        DELETE FROM scadenze_prossimo_alert WHERE scadenza_id = OLD.id;
+    END
+    ''')
+    # Il preavviso della tipologia vale per le scadenze che non ne hanno uno proprio
+    c.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS trg_prossimo_alert_tipologia
+    AFTER UPDATE OF giorni_preavviso ON manutenzione_tipologie
+    BEGIN
+        DELETE FROM scadenze_prossimo_alert WHERE scadenza_id IN (
+            SELECT id FROM scadenze_calendario WHERE manutenzione_id = NEW.id AND giorni_preavviso IS NULL
+        );{sql_inserisci_prossimo_alert('s', 'FROM scadenze_calendario s')}
+          AND s.manutenzione_id = NEW.id AND s.giorni_preavviso IS NULL;
+    END
+    ''')
+
+    if not indice_esistente:
+        ricostruisci_prossimi_alert(c)
+
+def ricostruisci_prossimi_alert(c):
+    """Ricalcola l'indice da zero: ogni scadenza riparte dall'inizio della sua finestra di preavviso"""
+    c.execute('DELETE FROM scadenze_prossimo_alert')
+    c.execute(sql_inserisci_prossimo_alert('s', 'FROM scadenze_calendario s'))
+    return c.rowcount
+
 def genera_alert_scadenze():
     """
     Funzione che controlla le scadenze in avvicinamento e genera alert.
@@ -1565,32 +2029,37 @@ def genera_alert_scadenze():
         c = conn.cursor()
         
         now = datetime.datetime.now()
+        oggi = now.date()
         
-        # Trova scadenze che necessitano alert (formato nuovo con checklist_voce_id)
+        # Trova scadenze che necessitano alert (formato nuovo con checklist_voce_id):
+        # solo quelle con il prossimo alert dovuto secondo idx_prossimo_alert, quindi il costo
+        # dipende dalle righe in finestra di preavviso e non dalla dimensione del calendario
         c.execute("""
             SELECT s.id, s.civico, s.asset, s.asset_tipo, s.data_scadenza,
                    COALESCE(cl.nome_voce, m.nome_manutenzione) as nome_manutenzione,
                    COALESCE(cl.descrizione, m.descrizione) as descrizione,
                    COALESCE(s.giorni_preavviso, m.giorni_preavviso, 7) as giorni_preavviso,
-                   s.frequenza_tipo
-            FROM scadenze_calendario s
+                   s.frequenza_tipo, s.giorni_rimanenti, s.data_scadenza_formatted
+            FROM scadenze_prossimo_alert pa
+            JOIN v_scadenze_calendario s ON s.id = pa.scadenza_id
             LEFT JOIN manutenzione_programmata_checklist cl ON s.checklist_voce_id = cl.id
             LEFT JOIN manutenzione_tipologie m ON s.manutenzione_id = m.id
-            WHERE s.stato = 'programmata'
+            WHERE pa.prossimo_alert <= ?
+              AND s.stato = 'programmata'
               AND (s.checklist_voce_id IS NOT NULL OR s.manutenzione_id IS NOT NULL)
-        """)
+              AND s.giorni_rimanenti <= COALESCE(s.giorni_preavviso, m.giorni_preavviso, 7)
+        """, (oggi.isoformat(),))
         
         scadenze = c.fetchall()
+        scadenze_con_errori = set()
         alert_generati = 0
         
         print(f"[DEBUG] Controllo alert per {len(scadenze)} scadenze programmate")
         
         for scadenza in scadenze:
-            scadenza_id, civico, asset, asset_tipo, data_scadenza_str, nome_manutenzione, descrizione, giorni_preavviso, frequenza_tipo = scadenza
+            scadenza_id, civico, asset, asset_tipo, data_scadenza_str, nome_manutenzione, descrizione, giorni_preavviso, frequenza_tipo, giorni_rimanenti, data_scadenza_formatted = scadenza
             
             try:
-                data_scadenza = datetime.datetime.fromisoformat(data_scadenza_str)
-                giorni_rimanenti = (data_scadenza - now).days
                 
                 print(f"[DEBUG] Scadenza {scadenza_id}: {nome_manutenzione} per {asset} - giorni rimanenti: {giorni_rimanenti}, preavviso: {giorni_preavviso}")
                 
@@ -1617,38 +2086,19 @@ def genera_alert_scadenze():
                     print(f"[DEBUG] -> NO ALERT: {giorni_rimanenti} giorni > {giorni_preavviso} (preavviso)")
                 
                 if deve_generare_alert:
-                    # Controlla se esiste già un alert attivo per questa scadenza
-                    # Usa un controllo più specifico per prevenire duplicati
-                    c.execute("""
-                        SELECT COUNT(*) FROM alert 
-                        WHERE tipo = 'scadenza' 
-                        AND civico = ? AND asset = ? 
-                        AND titolo LIKE ?
-                        AND stato = 'aperto'
-                        AND date(data_creazione) = date('now')
-                    """, (
-                        civico, asset, f'%{nome_manutenzione}%'
-                    ))
-                    
-                    alert_oggi = c.fetchone()[0]
-                    
-                    # Controllo aggiuntivo per alert nelle ultime ore
+                    # Chiave di origine: la deduplica è garantita dall'indice univoco
+                    # idx_alert_origine (origine_chiave, origine_tipo, origine_giorno)
+                    origine_chiave = chiave_origine_alert(scadenza_id, data_scadenza_str)
+                    origine_giorno = now.date().isoformat()
+
                     c.execute("""
-                        SELECT COUNT(*) FROM alert 
-                        WHERE tipo = 'scadenza' 
-                        AND civico = ? AND asset = ? 
-                        AND titolo LIKE ?
-                        AND stato = 'aperto'
-                        AND datetime(data_creazione) > datetime('now', '-2 hours')
-                    """, (
-                        civico, asset, f'%{nome_manutenzione}%'
-                    ))
-                    
-                    alert_recenti = c.fetchone()[0]
-                    
-                    print(f"[DEBUG] Controllo duplicati per {asset}/{nome_manutenzione}: trovati {alert_oggi} alert oggi, {alert_recenti} alert recenti")
-                    
-                    if alert_oggi == 0 and alert_recenti == 0:  # Nessun alert duplicato
+                        SELECT 1 FROM alert
+                        WHERE origine_chiave = ? AND origine_tipo = ? AND origine_giorno = ?
+                    """, (origine_chiave, tipo_alert, origine_giorno))
+
+                    if c.fetchone():
+                        print(f"[DEBUG] Alert già presente per {origine_chiave} ({tipo_alert}) del {origine_giorno}")
+                    else:
                         # Crea un titolo semplificato e uniforme
                         titolo = f"Manutenzione {asset_tipo} programmata"
                         
@@ -1690,16 +2140,25 @@ def genera_alert_scadenze():
                         
                         note_alert = "\n\n".join(note_parts) if note_parts else ""
                         
-                        # Inserisci alert nel database
+                        # Inserisci alert nel database (ignorato se un altro worker l'ha già creato)
                         c.execute("""
-                            INSERT INTO alert (tipo, titolo, descrizione, data_creazione, civico, asset, stato, note)
-                            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                            INSERT OR IGNORE INTO alert
+                            (tipo, titolo, descrizione, data_creazione, civico, asset, stato, note,
+                             origine_tipo, origine_chiave, origine_giorno)
+                            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
                         """, (
                             'scadenza', titolo, desc_alert, now.isoformat(),
-                            civico, asset, 'aperto', note_alert
+                            civico, asset, 'aperto', note_alert,
+                            tipo_alert, origine_chiave, origine_giorno
                         ))
-                        
-                        # Invia alert su Telegram con dati strutturati
+
+                        if c.rowcount == 0:
+                            print(f"[DEBUG] Alert {origine_chiave} ({tipo_alert}) già generato da un'altra esecuzione")
+                            continue
+
+                        alert_id = c.lastrowid
+
+                        # Accoda l'alert su Telegram con dati strutturati, nella stessa transazione dell'alert
                         alert_data = {
                             'tipo': 'scadenza',
                             'titolo': titolo,
@@ -1708,21 +2167,28 @@ def genera_alert_scadenze():
                             'civico': civico,
                             'asset': asset,
                             'asset_tipo': asset_tipo,  # Aggiungiamo il tipo di asset dal database
-                            'note': f'Scadenza: {data_scadenza.strftime("%d/%m/%Y")} - Frequenza: {frequenza_tipo or "Non specificata"}',
+                            'note': f'Scadenza: {data_scadenza_formatted} - Frequenza: {frequenza_tipo or "Non specificata"}',
                             'giorni_rimanenti': giorni_rimanenti,
                             'tipo_alert': tipo_alert
                         }
-                        print(f"[DEBUG] Inviando dati Telegram: {alert_data}")
-                        telegram_result = send_alert_to_telegram(alert_data)
-                        print(f"[DEBUG] Risultato invio Telegram: {telegram_result}")
+                        send_alert_to_telegram(alert_data, cursor=c, alert_id=alert_id)
+                        conn.commit()
                         
                         alert_generati += 1
                         print(f"[DEBUG] Generato alert scadenza ({tipo_alert}) per {asset} - {nome_manutenzione}")
                         
             except Exception as e:
                 print(f"[DEBUG] Errore elaborazione scadenza {scadenza_id}: {e}")
+                scadenze_con_errori.add(scadenza_id)
                 continue
         
+        # Le scadenze esaminate tornano dovute domani; quelle in errore restano dovute e vengono ritentate
+        domani = (oggi + datetime.timedelta(days=1)).isoformat()
+        c.executemany(
+            'UPDATE scadenze_prossimo_alert SET prossimo_alert = ? WHERE scadenza_id = ?',
+            [(domani, row[0]) for row in scadenze if row[0] not in scadenze_con_errori]
+        )
+        
         conn.commit()
         conn.close()
         
@@ -1743,68 +2209,1762 @@ def trigger_genera_alert():
     except Exception as e:
         return jsonify({'error': f'Errore generazione alert: {e}'}), 500
 
-# --- INIZIALIZZAZIONE ---
-init_calendario_db()
+@bp.route('/alert/prossimi/ricostruisci', methods=['POST'])
+def ricostruisci_prossimi_alert_endpoint():
+    """Ricalcola da zero l'indice del prossimo alert (le scadenze in finestra vengono riesaminate)"""
+    try:
+        conn = sqlite3.connect(DB_PATH)
+        c = conn.cursor()
+        righe = ricostruisci_prossimi_alert(c)
+        conn.commit()
+        conn.close()
+        return jsonify({'ok': True, 'righe': righe})
+    except Exception as e:
+        print(f"[ERROR] ricostruisci_prossimi_alert: {e}")
+        return jsonify({'error': str(e)}), 500
 
-# --- ENDPOINT DEBUG ---
-@bp.route('/debug/tipologie', methods=['GET'])
-def debug_tipologie():
-    """Endpoint di debug per controllare le tipologie presenti"""
+# --- PREVISIONI CARICO DI LAVORO ---
+# Le occorrenze future di ogni scadenza programmata vengono proiettate una volta e salvate in
+# previsioni_occorrenze. I trigger su scadenze_calendario segnano come "da aggiornare" solo le
+# scadenze modificate (inserimento, completamento, eliminazione, modifica da qualsiasi modulo):
+# alla lettura successiva vengono riproiettate soltanto quelle, il resto della cache resta valido.
+PREVISIONI_MESI_DEFAULT = 12
+PREVISIONI_MESI_MAX = 24
+PREVISIONI_RAGGRUPPAMENTI = {
+    'civico': 'o.civico',
+    'asset_tipo': 'o.asset_tipo',
+    'voce': 'o.checklist_voce_id',
+}
+
+def init_previsioni_db(c):
+    """Crea le tabelle della cache previsioni e i trigger di invalidazione"""
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS previsioni_occorrenze (
+        scadenza_id INTEGER NOT NULL,
+        data TEXT NOT NULL,
+        settimana TEXT NOT NULL,
+        mese TEXT NOT NULL,
+        civico TEXT,
+        asset_tipo TEXT,
+        checklist_voce_id INTEGER,
+        manutenzione_id INTEGER
+    )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_previsioni_data ON previsioni_occorrenze(data)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_previsioni_scadenza ON previsioni_occorrenze(scadenza_id)')
+
+    # Scadenze da riproiettare alla prossima lettura
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS previsioni_da_aggiornare (
+        scadenza_id INTEGER PRIMARY KEY
+    )
+    ''')
+
+    # Stato della cache (orizzonte proiettato)
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS previsioni_stato (
+        chiave TEXT PRIMARY KEY,
+        valore TEXT
+    )
+    ''')
+
+    c.execute('''
+    CREATE TRIGGER IF NOT EXISTS trg_previsioni_insert
+    AFTER INSERT ON scadenze_calendario
+    BEGIN
+        INSERT OR IGNORE INTO previsioni_da_aggiornare (scadenza_id) VALUES (NEW.id);
+    END
+    ''')
+    c.execute('''
+    CREATE TRIGGER IF NOT EXISTS trg_previsioni_update
+    AFTER UPDATE OF data_scadenza, stato, frequenza_tipo, civico, asset_tipo, checklist_voce_id, manutenzione_id
+    ON scadenze_calendario
+    BEGIN
+        INSERT OR IGNORE INTO previsioni_da_aggiornare (scadenza_id) VALUES (NEW.id);
+    END
+    ''')
+    c.execute('''
+    CREATE TRIGGER IF NOT EXISTS trg_previsioni_delete
+    AFTER DELETE ON scadenze_calendario
+    BEGIN
+        INSERT OR IGNORE INTO previsioni_da_aggiornare (scadenza_id) VALUES (OLD.id);
+    END
+    ''')
+
+def frequenza_da_mesi(frequenza_mesi):
+    """Ricava il tipo frequenza dai mesi della tipologia (scadenze legacy senza frequenza_tipo)"""
+    for tipo, mesi in FREQUENZE_MESI.items():
+        if mesi == frequenza_mesi:
+            return tipo
+    return 'mensile'
+
+def proietta_occorrenze(righe, data_fine):
+    """Genera le tuple di previsioni_occorrenze per le scadenze indicate, fino a data_fine inclusa"""
+    occorrenze = []
+    for scadenza_id, data_scadenza, frequenza_tipo, frequenza_mesi, civico, asset_tipo, voce_id, manutenzione_id in righe:
+        try:
+            data = datetime.datetime.strptime(str(data_scadenza)[:10], '%Y-%m-%d').date()
+        except (TypeError, ValueError):
+            print(f"[WARNING] Previsioni: data non valida per scadenza {scadenza_id}: {data_scadenza}")
+            continue
+        frequenza = frequenza_tipo or frequenza_da_mesi(frequenza_mesi)
+        while data <= data_fine:
+            lunedi = data - datetime.timedelta(days=data.weekday())
+            occorrenze.append((
+                scadenza_id, data.isoformat(), lunedi.isoformat(), data.strftime('%Y-%m'),
+                civico, asset_tipo, voce_id, manutenzione_id
+            ))
+            data = calcola_prossima_data(data, frequenza)
+    return occorrenze
+
+def carica_scadenze_da_proiettare(cursor, scadenza_ids=None):
+    """Legge le scadenze programmate da proiettare (tutte o solo quelle indicate)"""
+    query = """
+        SELECT s.id, s.data_scadenza, s.frequenza_tipo, m.frequenza_mesi,
+               s.civico, s.asset_tipo, s.checklist_voce_id, s.manutenzione_id
+        FROM scadenze_calendario s
+        LEFT JOIN manutenzione_tipologie m ON s.manutenzione_id = m.id
+        WHERE s.stato = 'programmata'
+    """
+    if scadenza_ids is None:
+        cursor.execute(query)
+        return cursor.fetchall()
+    righe = []
+    for i in range(0, len(scadenza_ids), SQLITE_MAX_PARAMS):
+        blocco = scadenza_ids[i:i + SQLITE_MAX_PARAMS]
+        cursor.execute(query + f" AND s.id IN ({','.join('?' * len(blocco))})", blocco)
+        righe.extend(cursor.fetchall())
+    return righe
+
+def aggiorna_previsioni(conn, data_fine):
+    """
+    Porta la cache previsioni allo stato corrente.
+    Se l'orizzonte salvato non copre data_fine ricostruisce tutto, altrimenti riproietta
+    solo le scadenze segnate dai trigger. Restituisce il numero di scadenze riproiettate.
+    """
+    c = conn.cursor()
+    # Caso normale: cache già aggiornata, basta una lettura senza prendere il lock in scrittura
+    # (che serializzerebbe la richiesta con completamenti, /sync e scheduler degli alert)
+    c.execute("""
+        SELECT (SELECT valore FROM previsioni_stato WHERE chiave = 'orizzonte'),
+               EXISTS (SELECT 1 FROM previsioni_da_aggiornare)
+    """)
+    orizzonte, sporche = c.fetchone()
+    if orizzonte is not None and orizzonte >= data_fine.isoformat() and not sporche:
+        return 0
+
+    # Lock in scrittura: con più worker solo uno aggiorna la cache alla volta; stato riletto sotto lock
+    c.execute('BEGIN IMMEDIATE')
+    try:
+        c.execute("SELECT valore FROM previsioni_stato WHERE chiave = 'orizzonte'")
+        row = c.fetchone()
+        orizzonte = row[0] if row else None
+
+        if orizzonte is None or orizzonte < data_fine.isoformat():
+            # Ricostruzione completa con il massimo orizzonte, così le richieste successive restano incrementali
+            nuovo_orizzonte = max(data_fine, data_tra_mesi(datetime.date.today(), PREVISIONI_MESI_MAX))
+            righe = carica_scadenze_da_proiettare(c)
+            c.execute('DELETE FROM previsioni_occorrenze')
+            c.execute('DELETE FROM previsioni_da_aggiornare')
+            c.executemany('INSERT INTO previsioni_occorrenze VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                          proietta_occorrenze(righe, nuovo_orizzonte))
+            c.execute("INSERT OR REPLACE INTO previsioni_stato (chiave, valore) VALUES ('orizzonte', ?)",
+                      (nuovo_orizzonte.isoformat(),))
+            conn.commit()
+            print(f"[DEBUG] Previsioni ricostruite: {len(righe)} scadenze fino al {nuovo_orizzonte}")
+            return len(righe)
+
+        c.execute('SELECT scadenza_id FROM previsioni_da_aggiornare')
+        da_aggiornare = [r[0] for r in c.fetchall()]
+        if da_aggiornare:
+            data_orizzonte = datetime.datetime.strptime(orizzonte, '%Y-%m-%d').date()
+            c.executemany('DELETE FROM previsioni_occorrenze WHERE scadenza_id = ?', [(i,) for i in da_aggiornare])
+            righe = carica_scadenze_da_proiettare(c, da_aggiornare)
+            c.executemany('INSERT INTO previsioni_occorrenze VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                          proietta_occorrenze(righe, data_orizzonte))
+            c.execute('DELETE FROM previsioni_da_aggiornare')
+            print(f"[DEBUG] Previsioni aggiornate per {len(da_aggiornare)} scadenze")
+        conn.commit()
+        return len(da_aggiornare)
+    except Exception:
+        conn.rollback()
+        raise
+
+@bp.route('/previsioni', methods=['GET'])
+def get_previsioni():
+    """
+    Previsione del carico di manutenzione per i prossimi mesi.
+    Parametri: mesi (default 12, max 24), periodo (settimana|mese),
+    raggruppa (lista separata da virgole tra civico, asset_tipo, voce), civico, asset_tipo.
+    Le manutenzioni già scadute e non eseguite sono conteggiate a parte in 'arretrate'.
+    """
     try:
+        try:
+            mesi = int(request.args.get('mesi', PREVISIONI_MESI_DEFAULT))
+        except ValueError:
+            return jsonify({'error': 'Parametro mesi non valido'}), 400
+        if mesi < 1 or mesi > PREVISIONI_MESI_MAX:
+            return jsonify({'error': f'Il parametro mesi deve essere tra 1 e {PREVISIONI_MESI_MAX}'}), 400
+
+        periodo = request.args.get('periodo', 'mese')
+        if periodo not in ('settimana', 'mese'):
+            return jsonify({'error': 'Parametro periodo non valido (settimana|mese)'}), 400
+
+        raggruppa = [r.strip() for r in request.args.get('raggruppa', 'civico,asset_tipo').split(',') if r.strip()]
+        for r in raggruppa:
+            if r not in PREVISIONI_RAGGRUPPAMENTI:
+                return jsonify({'error': f'Raggruppamento non valido: {r}'}), 400
+
+        oggi = datetime.date.today()
+        data_fine = data_tra_mesi(oggi, mesi)
+
         conn = sqlite3.connect(DB_PATH)
+        aggiorna_previsioni(conn, data_fine)
         c = conn.cursor()
-        
-        c.execute("SELECT asset_tipo, nome_manutenzione, id FROM manutenzione_tipologie ORDER BY asset_tipo, nome_manutenzione")
-        tipologie = c.fetchall()
+
+        filtri = ''
+        filtri_params = []
+        if request.args.get('civico'):
+            filtri += ' AND o.civico = ?'
+            filtri_params.append(request.args.get('civico'))
+        if request.args.get('asset_tipo'):
+            filtri += ' AND o.asset_tipo = ?'
+            filtri_params.append(request.args.get('asset_tipo'))
+
+        colonne = [PREVISIONI_RAGGRUPPAMENTI[r] for r in raggruppa]
+        select_extra = ''.join(f', {col}' for col in colonne)
+        if 'voce' in raggruppa:
+            select_extra += ', MAX(COALESCE(v.nome_voce, m.nome_manutenzione))'
+
+        c.execute(f"""
+            SELECT o.{periodo}{select_extra}, COUNT(*)
+            FROM previsioni_occorrenze o
+            LEFT JOIN manutenzione_programmata_checklist v ON o.checklist_voce_id = v.id
+            LEFT JOIN manutenzione_tipologie m ON o.manutenzione_id = m.id
+            WHERE o.data >= ? AND o.data <= ?{filtri}
+            GROUP BY o.{periodo}{''.join(f', {col}' for col in colonne)}
+            ORDER BY o.{periodo}
+        """, [oggi.isoformat(), data_fine.isoformat()] + filtri_params)
+
+        righe = []
+        totali_periodo = {}
+        for row in c.fetchall():
+            riga = {'periodo': row[0]}
+            for i, r in enumerate(raggruppa):
+                riga['checklist_voce_id' if r == 'voce' else r] = row[1 + i]
+            if 'voce' in raggruppa:
+                riga['nome_voce'] = row[1 + len(raggruppa)]
+            riga['totale'] = row[-1]
+            righe.append(riga)
+            totali_periodo[row[0]] = totali_periodo.get(row[0], 0) + row[-1]
+
+        # Arretrate: scadenze programmate con data passata (conteggiate una sola volta)
+        c.execute(f"""
+            SELECT COUNT(DISTINCT o.scadenza_id)
+            FROM previsioni_occorrenze o
+            WHERE o.data < ?{filtri}
+        """, [oggi.isoformat()] + filtri_params)
+        arretrate = c.fetchone()[0]
         conn.close()
-        
+
         return jsonify({
-            'count': len(tipologie),
-            'tipologie': [{'id': t[2], 'asset_tipo': t[0], 'nome_manutenzione': t[1]} for t in tipologie]
+            'da': oggi.isoformat(),
+            'a': data_fine.isoformat(),
+            'periodo': periodo,
+            'raggruppa': raggruppa,
+            'righe': righe,
+            'totali_per_periodo': [{'periodo': p, 'totale': t} for p, t in sorted(totali_periodo.items())],
+            'totale': sum(totali_periodo.values()),
+            'arretrate': arretrate
         })
+
     except Exception as e:
+        print(f"[ERROR] get_previsioni: {e}")
+        traceback.print_exc()
         return jsonify({'error': str(e)}), 500
 
-# --- ENDPOINT SCADENZE IN ARRIVO ---
-@bp.route('/scadenze-prossime', methods=['GET'])
-def get_scadenze_prossime():
-    """Ottieni scadenze in arrivo nei prossimi giorni (sia vecchio che nuovo formato)"""
+@bp.route('/previsioni/ricostruisci', methods=['POST'])
+def ricostruisci_previsioni():
+    """Forza la ricostruzione completa della cache previsioni"""
     try:
-        giorni_anticipo = request.args.get('giorni', 30, type=int)
-        
         conn = sqlite3.connect(DB_PATH)
         c = conn.cursor()
-        
-        data_limite = (datetime.datetime.now() + datetime.timedelta(days=giorni_anticipo)).isoformat()
-        
-        # Query aggiornata per gestire sia nuovo che vecchio formato
-        c.execute("""
-            SELECT s.id, s.civico, s.asset, s.asset_tipo, s.data_scadenza,
-                   COALESCE(c.nome_voce, m.nome_manutenzione) as nome_manutenzione,
-                   COALESCE(c.descrizione, m.descrizione) as descrizione,
-                   COALESCE(s.giorni_preavviso, m.giorni_preavviso) as giorni_preavviso,
-                   s.stato, s.frequenza_tipo
+        c.execute("DELETE FROM previsioni_stato WHERE chiave = 'orizzonte'")
+        conn.commit()
+        oggi = datetime.date.today()
+        scadenze = aggiorna_previsioni(conn, oggi)
+        conn.close()
+        return jsonify({'ok': True, 'scadenze_proiettate': scadenze})
+    except Exception as e:
+        print(f"[ERROR] ricostruisci_previsioni: {e}")
+        return jsonify({'error': str(e)}), 500
+
+# --- LIVELLAMENTO CARICO ---
+# Le date ricorrenti sono calcolate solo dalla data precedente, quindi le manutenzioni tendono ad
+# accumularsi sugli stessi giorni. Il pianificatore anticipa i gruppi (civico/asset/data) entro il
+# loro giorni_preavviso per livellare il numero di interventi giornalieri per civico.
+LIVELLAMENTO_GIORNI_DEFAULT = 60
+LIVELLAMENTO_CAPACITA_DEFAULT = 8
+
+def pianifica_livellamento(gruppi, capacita_per_civico, capacita_default, oggi, escludi_weekend=True):
+    """
+    Euristica greedy "earliest deadline first": i gruppi sono assegnati in ordine di scadenza
+    (a parità, prima i più pesanti) al giorno meno carico della loro finestra
+    [data - preavviso, data], senza mai posticipare la scadenza né anticiparla a prima di oggi.
+    A parità di carico si preferisce il giorno più vicino alla data originale.
+    Restituisce {indice_gruppo: nuova_data}.
+    """
+    carico = {}  # (civico, data) -> interventi assegnati
+    assegnazioni = {}
+    ordine = sorted(range(len(gruppi)), key=lambda i: (gruppi[i]['data'], -gruppi[i]['peso']))
+    for i in ordine:
+        g = gruppi[i]
+        capacita = capacita_per_civico.get(g['civico'], capacita_default)
+        inizio = max(g['data'] - datetime.timedelta(days=g['preavviso']), oggi)
+        candidati = []
+        giorno = inizio
+        while giorno <= g['data']:
+            if not escludi_weekend or giorno.weekday() < 5 or giorno == g['data']:
+                candidati.append(giorno)
+            giorno += datetime.timedelta(days=1)
+        if not candidati:
+            candidati = [g['data']]
+
+        def costo(d):
+            dopo = carico.get((g['civico'], d), 0) + g['peso']
+            # Prima i giorni che restano entro la capacità, poi il carico minore, poi la vicinanza alla scadenza
+            return (dopo > capacita, dopo, (g['data'] - d).days)
+
+        scelto = min(candidati, key=costo)
+        carico[(g['civico'], scelto)] = carico.get((g['civico'], scelto), 0) + g['peso']
+        assegnazioni[i] = scelto
+    return assegnazioni
+
+def statistiche_carico(gruppi, date_per_gruppo, capacita_per_civico, capacita_default):
+    """Carico giornaliero per civico, picco massimo e giorni oltre capacità per la distribuzione indicata"""
+    carico = {}
+    for g, d in zip(gruppi, date_per_gruppo):
+        carico[(g['civico'], d)] = carico.get((g['civico'], d), 0) + g['peso']
+    per_civico = {}
+    for (civico, d), n in carico.items():
+        per_civico.setdefault(civico, {})[d.isoformat()] = n
+    return {
+        'picco': max(carico.values()) if carico else 0,
+        'giorni_oltre_capacita': sum(
+            1 for (civico, d), n in carico.items() if n > capacita_per_civico.get(civico, capacita_default)
+        ),
+        'per_civico': {civico: dict(sorted(giorni.items())) for civico, giorni in per_civico.items()}
+    }
+
+@bp.route('/livellamento', methods=['POST'])
+def livella_scadenze():
+    """
+    Ridistribuisce le scadenze programmate per livellare il carico giornaliero.
+    Payload (tutti opzionali):
+      giorni (orizzonte da oggi, default 60), civico, asset_tipo,
+      capacita_giornaliera (interventi/giorno per civico, default 8),
+      capacita_civico ({civico: interventi/giorno}),
+      escludi_weekend (default true), dry_run (default true)
+    Con dry_run restituisce solo l'anteprima degli spostamenti; altrimenti li applica in un'unica transazione.
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        try:
+            giorni = int(data.get('giorni', LIVELLAMENTO_GIORNI_DEFAULT))
+            capacita_default = max(int(data.get('capacita_giornaliera', LIVELLAMENTO_CAPACITA_DEFAULT)), 1)
+            capacita_per_civico = {str(k): max(int(v), 1) for k, v in (data.get('capacita_civico') or {}).items()}
+        except (TypeError, ValueError, AttributeError):
+            return jsonify({'error': 'giorni e capacità devono essere numerici'}), 400
+        if giorni < 1 or giorni > 366:
+            return jsonify({'error': 'Il parametro giorni deve essere tra 1 e 366'}), 400
+        dry_run = data.get('dry_run', True) is not False
+        escludi_weekend = data.get('escludi_weekend', True) is not False
+
+        oggi = datetime.date.today()
+        data_fine = oggi + datetime.timedelta(days=giorni)
+
+        conn = sqlite3.connect(DB_PATH)
+        c = conn.cursor()
+
+        # Unità di pianificazione: il gruppo civico/asset/data, che viene compilato con un unico form
+        query = """
+            SELECT s.civico, s.asset, s.data_scadenza,
+                   MIN(COALESCE(s.giorni_preavviso, m.giorni_preavviso, 7)),
+                   GROUP_CONCAT(s.id)
             FROM scadenze_calendario s
-            LEFT JOIN manutenzione_programmata_checklist c ON s.checklist_voce_id = c.id
             LEFT JOIN manutenzione_tipologie m ON s.manutenzione_id = m.id
-            WHERE s.stato = 'programmata' 
-              AND s.data_scadenza <= ?
-              AND (s.checklist_voce_id IS NOT NULL OR s.manutenzione_id IS NOT NULL)
-            ORDER BY s.data_scadenza ASC
-        """, (data_limite,))
-        
-        scadenze = c.fetchall()
-        conn.close()
-        
-        print(f"[DEBUG] Scadenze prossime trovate: {len(scadenze)}")
-        for scadenza in scadenze:
-            print(f"[DEBUG] Scadenza: ID={scadenza[0]}, Asset={scadenza[2]}, Nome={scadenza[5]}")
-        
-        scadenze_list = []
-        for row in scadenze:
-            try:
-                data_scadenza = datetime.datetime.fromisoformat(row[4])
-                giorni_rimanenti = (data_scadenza - datetime.datetime.now()).days
+            WHERE s.stato = 'programmata' AND s.data_scadenza >= ? AND s.data_scadenza <= ?
+        """
+        params = [data_canonica(oggi), data_canonica(data_fine)]
+        if data.get('civico'):
+            query += " AND s.civico = ?"
+            params.append(str(data['civico']))
+        if data.get('asset_tipo'):
+            query += " AND s.asset_tipo = ?"
+            params.append(data['asset_tipo'])
+        query += " GROUP BY s.civico, s.asset, s.data_scadenza"
+        c.execute(query, params)
+
+        gruppi = []
+        for civico, asset, data_scadenza, preavviso, ids in c.fetchall():
+            scadenza_ids = [int(i) for i in ids.split(',')]
+            gruppi.append({
+                'civico': civico,
+                'asset': asset,
+                'data': datetime.datetime.strptime(data_scadenza, '%Y-%m-%d').date(),
+                'preavviso': max(int(preavviso or 0), 0),
+                'peso': len(scadenza_ids),
+                'scadenza_ids': scadenza_ids
+            })
+
+        assegnazioni = pianifica_livellamento(gruppi, capacita_per_civico, capacita_default, oggi, escludi_weekend)
+        nuove_date = [assegnazioni[i] for i in range(len(gruppi))]
+
+        prima = statistiche_carico(gruppi, [g['data'] for g in gruppi], capacita_per_civico, capacita_default)
+        dopo = statistiche_carico(gruppi, nuove_date, capacita_per_civico, capacita_default)
+
+        spostamenti = []
+        aggiornamenti = []
+        adesso = datetime.datetime.now().isoformat()
+        for g, nuova in zip(gruppi, nuove_date):
+            if nuova == g['data']:
+                continue
+            spostamenti.append({
+                'civico': g['civico'],
+                'asset': g['asset'],
+                'data_originale': g['data'].isoformat(),
+                'nuova_data': nuova.isoformat(),
+                'scadenza_ids': g['scadenza_ids']
+            })
+            # La condizione sulla data originale evita di sovrascrivere modifiche concorrenti
+            aggiornamenti.extend(
+                (nuova.isoformat(), adesso, sid, g['data'].isoformat()) for sid in g['scadenza_ids']
+            )
+
+        aggiornate = 0
+        if not dry_run and aggiornamenti:
+            c.executemany("""
+                UPDATE scadenze_calendario
+                SET data_scadenza = ?, updated_at = ?
+                WHERE id = ? AND data_scadenza = ? AND stato = 'programmata'
+            """, aggiornamenti)
+            aggiornate = c.rowcount
+            conn.commit()
+        conn.close()
+
+        print(f"[DEBUG] Livellamento: {len(gruppi)} gruppi, {len(spostamenti)} spostati, picco {prima['picco']} -> {dopo['picco']}, dry_run={dry_run}")
+
+        return jsonify({
+            'ok': True,
+            'dry_run': dry_run,
+            'da': oggi.isoformat(),
+            'a': data_fine.isoformat(),
+            'gruppi_analizzati': len(gruppi),
+            'gruppi_spostati': len(spostamenti),
+            'scadenze_aggiornate': aggiornate,
+            'spostamenti': spostamenti,
+            'prima': prima,
+            'dopo': dopo
+        })
+
+    except Exception as e:
+        print(f"[ERROR] livella_scadenze: {e}")
+        traceback.print_exc()
+        return jsonify({'error': str(e)}), 500
+
+# --- FEED ICALENDAR (ICS) ---
+# I feed sono generati in streaming da scadenze_calendario. ETag e Last-Modified derivano dai
+# contatori di modifica in calendario_modifiche, aggiornati dai trigger a ogni scrittura: i client
+# che interrogano il feed ogni pochi minuti ricevono un 304 senza che il calendario venga riletto.
+ICS_PRODID = '-//GESTMAN//Calendario manutenzioni//IT'
+ICS_BATCH_RIGHE = 200
+
+def sql_incrementa_modifica(ambito):
+    """Statement (per i trigger) che incrementa il contatore di modifica dell'ambito indicato"""
+    return f"""
+        INSERT INTO calendario_modifiche (ambito, versione, modificato_il)
+        VALUES ({ambito}, 1, datetime('now'))
+        ON CONFLICT(ambito) DO UPDATE SET versione = versione + 1, modificato_il = excluded.modificato_il;"""
+
+def init_modifiche_db(c):
+    """Crea la tabella dei contatori di modifica del calendario e i trigger che la aggiornano"""
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS calendario_modifiche (
+        ambito TEXT PRIMARY KEY,
+        versione INTEGER NOT NULL DEFAULT 0,
+        modificato_il TEXT NOT NULL
+    )
+    ''')
+    c.execute("INSERT OR IGNORE INTO calendario_modifiche (ambito, versione, modificato_il) VALUES ('scadenze', 0, datetime('now'))")
+
+    # Scadenze: contatore globale più contatori per civico e per tipo asset (vecchi e nuovi valori)
+    ambiti_scadenza = lambda r: [f"'civico:' || {r}.civico", f"'asset_tipo:' || {r}.asset_tipo"]
+    trigger_scadenze = {
+        'INSERT': ["'scadenze'"] + ambiti_scadenza('NEW'),
+        'UPDATE': ["'scadenze'"] + ambiti_scadenza('NEW') + ambiti_scadenza('OLD'),
+        'DELETE': ["'scadenze'"] + ambiti_scadenza('OLD'),
+    }
+    for evento, ambiti in trigger_scadenze.items():
+        c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_modifiche_scadenze_{evento.lower()}
+        AFTER {evento} ON scadenze_calendario
+        BEGIN{''.join(sql_incrementa_modifica(a) for a in ambiti)}
+        END
+        ''')
+
+    # Nomi di voci e tipologie compaiono nei titoli degli eventi; lo storico serve ai feed per operatore
+    for tabella, ambito in (('manutenzione_programmata_checklist', 'voci'),
+                            ('manutenzione_tipologie', 'voci'),
+                            ('manutenzione_checklist_template', 'voci'),
+                            ('scadenze_storico_esecuzioni', 'storico')):
+        for evento in ('INSERT', 'UPDATE', 'DELETE'):
+            c.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_modifiche_{tabella}_{evento.lower()}
+            AFTER {evento} ON {tabella}
+            BEGIN{sql_incrementa_modifica(f"'{ambito}'")}
+            END
+            ''')
+
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS idx_storico_operatore
+        ON scadenze_storico_esecuzioni(operatore_esecuzione, civico, asset)
+    ''')
+
+def ics_testo(valore):
+    """Escape dei valori testuali secondo RFC 5545"""
+    return (str(valore or '').replace('\\', '\\\\').replace(';', '\\;')
+            .replace(',', '\\,').replace('\r\n', '\\n').replace('\n', '\\n'))
+
+def ics_riga(riga):
+    """Piega le righe oltre 75 ottetti (RFC 5545 §3.1) e aggiunge il CRLF"""
+    dati = riga.encode('utf-8')
+    if len(dati) <= 75:
+        return riga + '\r\n'
+    parti = []
+    corrente = ''
+    limite = 75
+    for ch in riga:
+        if len((corrente + ch).encode('utf-8')) > limite:
+            parti.append(corrente)
+            corrente = ''
+            limite = 74  # le righe di continuazione iniziano con uno spazio
+        corrente += ch
+    parti.append(corrente)
+    return '\r\n '.join(parti) + '\r\n'
+
+def ics_regola_ricorrenza(frequenza_tipo, frequenza_mesi):
+    """RRULE corrispondente alla frequenza della scadenza"""
+    frequenza = (frequenza_tipo or frequenza_da_mesi(frequenza_mesi)).lower()
+    if frequenza in FREQUENZE_SETTIMANE:
+        return f'FREQ=WEEKLY;INTERVAL={FREQUENZE_SETTIMANE[frequenza]}'
+    return f'FREQ=MONTHLY;INTERVAL={FREQUENZE_MESI.get(frequenza, 1)}'
+
+def stato_modifiche(ambiti):
+    """Versioni e ultima modifica degli ambiti indicati: (etag, last_modified)"""
+    conn = sqlite3.connect(DB_PATH)
+    c = conn.cursor()
+    c.execute(f"""
+        SELECT ambito, versione, modificato_il FROM calendario_modifiche
+        WHERE ambito IN ({','.join('?' * len(ambiti))}) OR ambito = 'scadenze'
+    """, ambiti)
+    righe = {r[0]: (r[1], r[2]) for r in c.fetchall()}
+    conn.close()
+
+    # Un ambito mai modificato ha versione 0 e la data del contatore globale
+    base = righe.get('scadenze', (0, '1970-01-01 00:00:00'))[1]
+    versioni = [righe.get(a, (0, base)) for a in ambiti]
+    etag = '-'.join(str(v[0]) for v in versioni)
+    ultima = max(v[1] for v in versioni)
+    return etag, datetime.datetime.strptime(ultima, '%Y-%m-%d %H:%M:%S').replace(tzinfo=datetime.timezone.utc)
+
+def genera_ics(nome_calendario, filtro_sql, filtro_params, dtstamp):
+    """Generatore delle righe del feed: legge le scadenze a blocchi senza costruire il calendario in memoria"""
+    conn = sqlite3.connect(DB_PATH)
+    try:
+        c = conn.cursor()
+        c.execute(f"""
+            SELECT s.id, s.civico, s.asset, s.asset_tipo, s.data_scadenza, s.frequenza_tipo,
+                   m.frequenza_mesi, COALESCE(s.giorni_preavviso, m.giorni_preavviso, 7),
+                   COALESCE(v.nome_voce, m.nome_manutenzione, 'Manutenzione'),
+                   COALESCE(v.descrizione, m.descrizione, '')
+            FROM scadenze_calendario s
+            LEFT JOIN manutenzione_programmata_checklist v ON s.checklist_voce_id = v.id
+            LEFT JOIN manutenzione_tipologie m ON s.manutenzione_id = m.id
+            WHERE s.stato = 'programmata'{filtro_sql}
+            ORDER BY s.data_scadenza, s.civico, s.asset
+        """, filtro_params)
+
+        yield ics_riga('BEGIN:VCALENDAR')
+        yield ics_riga('VERSION:2.0')
+        yield ics_riga(f'PRODID:{ICS_PRODID}')
+        yield ics_riga('CALSCALE:GREGORIAN')
+        yield ics_riga('METHOD:PUBLISH')
+        yield ics_riga(f'X-WR-CALNAME:{ics_testo(nome_calendario)}')
+
+        while True:
+            righe = c.fetchmany(ICS_BATCH_RIGHE)
+            if not righe:
+                break
+            blocco = []
+            for (sid, civico, asset, asset_tipo, data_scadenza, frequenza_tipo, frequenza_mesi,
+                 preavviso, nome_voce, descrizione) in righe:
+                inizio = str(data_scadenza)[:10].replace('-', '')
+                blocco.extend([
+                    'BEGIN:VEVENT',
+                    f'UID:scadenza-{sid}@gestman',
+                    f'DTSTAMP:{dtstamp}',
+                    f'DTSTART;VALUE=DATE:{inizio}',
+                    f'RRULE:{ics_regola_ricorrenza(frequenza_tipo, frequenza_mesi)}',
+                    f'SUMMARY:{ics_testo(f"{nome_voce} - {asset} (civico {civico})")}',
+                    f'DESCRIPTION:{ics_testo(descrizione)}',
+                    f'LOCATION:{ics_testo(f"Civico {civico}")}',
+                    f'CATEGORIES:{ics_testo(asset_tipo)}',
+                    'TRANSP:TRANSPARENT',
+                    'BEGIN:VALARM',
+                    'ACTION:DISPLAY',
+                    f'DESCRIPTION:{ics_testo(nome_voce)}',
+                    f'TRIGGER:-P{max(int(preavviso or 0), 0)}D',
+                    'END:VALARM',
+                    'END:VEVENT',
+                ])
+            yield ''.join(ics_riga(r) for r in blocco)
+
+        yield ics_riga('END:VCALENDAR')
+    finally:
+        conn.close()
+
+def risposta_ics(nome_file, nome_calendario, ambiti, filtro_sql='', filtro_params=()):
+    """Risposta condizionale: 304 se il client ha già la versione corrente, altrimenti feed in streaming"""
+    versione, ultima_modifica = stato_modifiche(ambiti)
+    etag = f'{nome_file}-{versione}'
+
+    if request.if_none_match:
+        non_modificato = request.if_none_match.contains(etag)
+    else:
+        non_modificato = bool(request.if_modified_since and request.if_modified_since >= ultima_modifica)
+
+    if non_modificato:
+        risposta = Response(status=304)
+    else:
+        dtstamp = ultima_modifica.strftime('%Y%m%dT%H%M%SZ')
+        risposta = Response(
+            stream_with_context(genera_ics(nome_calendario, filtro_sql, list(filtro_params), dtstamp)),
+            mimetype='text/calendar'
+        )
+        risposta.headers['Content-Disposition'] = f'inline; filename="{nome_file}.ics"'
+    risposta.set_etag(etag)
+    risposta.last_modified = ultima_modifica
+    risposta.headers['Cache-Control'] = 'no-cache'
+    return risposta
+
+@bp.route('/ics/scadenze.ics', methods=['GET'])
+def ics_tutte():
+    """Feed ICS di tutte le scadenze programmate"""
+    return risposta_ics('scadenze', 'GESTMAN - Manutenzioni', ['scadenze', 'voci'])
+
+@bp.route('/ics/civico/<civico>.ics', methods=['GET'])
+def ics_civico(civico):
+    """Feed ICS delle scadenze di un civico"""
+    return risposta_ics(f'civico-{civico}', f'GESTMAN - Civico {civico}',
+                        [f'civico:{civico}', 'voci'], ' AND s.civico = ?', [civico])
+
+@bp.route('/ics/asset-tipo/<asset_tipo>.ics', methods=['GET'])
+def ics_asset_tipo(asset_tipo):
+    """Feed ICS delle scadenze di un tipo di asset"""
+    return risposta_ics(f'asset-tipo-{asset_tipo}', f'GESTMAN - {asset_tipo}',
+                        [f'asset_tipo:{asset_tipo}', 'voci'], ' AND s.asset_tipo = ?', [asset_tipo])
+
+@bp.route('/ics/operatore/<operatore>.ics', methods=['GET'])
+def ics_operatore(operatore):
+    """
+    Feed ICS per operatore: le scadenze non hanno un tecnico assegnato, quindi il feed contiene
+    le scadenze degli asset su cui l'operatore ha già eseguito manutenzioni (storico esecuzioni).
+    """
+    return risposta_ics(f'operatore-{operatore}', f'GESTMAN - {operatore}',
+                        ['scadenze', 'voci', 'storico'],
+                        """ AND EXISTS (
+                            SELECT 1 FROM scadenze_storico_esecuzioni e
+                            WHERE e.operatore_esecuzione = ? AND e.civico = s.civico AND e.asset = s.asset
+                        )""", [operatore])
+
+# --- ARCHIVIO STORICO ESECUZIONI ---
+# scadenze_storico_esecuzioni cresce senza limiti. Le esecuzioni più vecchie dell'orizzonte "caldo"
+# vengono spostate in tabelle annuali (storico_esecuzioni_YYYY) nel database allegato
+# compilazioni_archivio.db; i conteggi mensili restano in storico_rollup_mensile, aggiornata dai
+# trigger, così docs legge solo la partizione calda più i rollup e resta veloce negli anni.
+ARCHIVIO_DB_PATH = os.path.join(os.path.dirname(__file__), 'compilazioni_archivio.db')
+STORICO_MESI_CALDI = 24
+COLONNE_STORICO = ('id, civico, asset, asset_tipo, checklist_voce_id, nome_voce, data_scadenza_originale, '
+                   'data_esecuzione, operatore_esecuzione, note_esecuzione, esito, created_at')
+
+def init_archivio_storico_db(c):
+    """Crea rollup, registro delle partizioni d'archivio e trigger di aggiornamento dei rollup"""
+    c.execute('CREATE INDEX IF NOT EXISTS idx_storico_data_esecuzione ON scadenze_storico_esecuzioni(data_esecuzione)')
+
+    c.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'storico_rollup_mensile'")
+    rollup_esistente = c.fetchone() is not None
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS storico_rollup_mensile (
+        mese TEXT NOT NULL,
+        civico TEXT NOT NULL,
+        asset TEXT NOT NULL,
+        asset_tipo TEXT NOT NULL,
+        checklist_voce_id INTEGER NOT NULL,
+        nome_voce TEXT NOT NULL,
+        operatore TEXT NOT NULL,
+        esito TEXT NOT NULL,
+        esecuzioni INTEGER NOT NULL DEFAULT 0,
+        UNIQUE (mese, civico, asset, asset_tipo, checklist_voce_id, nome_voce, operatore, esito)
+    )
+    ''')
+
+    # Partizioni annuali presenti nell'archivio
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS storico_archivio (
+        anno TEXT PRIMARY KEY,
+        tabella TEXT NOT NULL,
+        righe INTEGER NOT NULL DEFAULT 0,
+        archiviato_il TEXT
+    )
+    ''')
+
+    # Riga presente solo durante l'archiviazione: le cancellazioni fatte per spostare le righe
+    # nell'archivio non devono decrementare i rollup
+    c.execute('CREATE TABLE IF NOT EXISTS storico_archiviazione_attiva (attiva INTEGER)')
+
+    chiave_rollup = 'mese, civico, asset, asset_tipo, checklist_voce_id, nome_voce, operatore, esito'
+    c.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS trg_rollup_storico_insert
+    AFTER INSERT ON scadenze_storico_esecuzioni
+    BEGIN
+        INSERT INTO storico_rollup_mensile ({chiave_rollup}, esecuzioni)
+        VALUES (substr(NEW.data_esecuzione, 1, 7), NEW.civico, NEW.asset, NEW.asset_tipo, NEW.checklist_voce_id,
+                NEW.nome_voce, NEW.operatore_esecuzione, NEW.esito, 1)
+        ON CONFLICT ({chiave_rollup}) DO UPDATE SET esecuzioni = esecuzioni + 1;
+    END
+    ''')
+    c.execute('''
+    CREATE TRIGGER IF NOT EXISTS trg_rollup_storico_delete
+    AFTER DELETE ON scadenze_storico_esecuzioni
+    WHEN NOT EXISTS (SELECT 1 FROM storico_archiviazione_attiva)
+    BEGIN
+        UPDATE storico_rollup_mensile SET esecuzioni = esecuzioni - 1
+        WHERE mese = substr(OLD.data_esecuzione, 1, 7) AND civico = OLD.civico AND asset = OLD.asset
+          AND asset_tipo = OLD.asset_tipo AND checklist_voce_id = OLD.checklist_voce_id
+          AND nome_voce = OLD.nome_voce AND operatore = OLD.operatore_esecuzione AND esito = OLD.esito;
+        DELETE FROM storico_rollup_mensile WHERE esecuzioni <= 0;
+    END
+    ''')
+
+    if not rollup_esistente:
+        ricostruisci_rollup_storico(c)
+
+def tabelle_archivio_storico(c):
+    """Elenco (anno, tabella) delle partizioni annuali registrate"""
+    c.execute('SELECT anno, tabella FROM storico_archivio ORDER BY anno')
+    return c.fetchall()
+
+def ricostruisci_rollup_storico(c):
+    """Ricalcola i rollup mensili dalla partizione calda e da tutte le partizioni d'archivio"""
+    sorgenti = ['main.scadenze_storico_esecuzioni']
+    partizioni = tabelle_archivio_storico(c)
+    if partizioni:
+        # ATTACH non è ammesso dentro una transazione aperta
+        c.connection.commit()
+        c.execute('ATTACH DATABASE ? AS archivio', (ARCHIVIO_DB_PATH,))
+        sorgenti.extend(f'archivio.{tabella}' for _, tabella in partizioni)
+
+    c.execute('DELETE FROM storico_rollup_mensile')
+    for sorgente in sorgenti:
+        c.execute(f'''
+            INSERT INTO storico_rollup_mensile
+                (mese, civico, asset, asset_tipo, checklist_voce_id, nome_voce, operatore, esito, esecuzioni)
+            SELECT substr(data_esecuzione, 1, 7), civico, asset, asset_tipo, checklist_voce_id,
+                   nome_voce, operatore_esecuzione, esito, COUNT(*)
+            FROM {sorgente}
+            GROUP BY 1, 2, 3, 4, 5, 6, 7, 8
+            ON CONFLICT (mese, civico, asset, asset_tipo, checklist_voce_id, nome_voce, operatore, esito)
+            DO UPDATE SET esecuzioni = esecuzioni + excluded.esecuzioni
+        ''')
+
+    if partizioni:
+        c.connection.commit()
+        c.execute('DETACH DATABASE archivio')
+    print(f"[DEBUG] Rollup storico ricostruiti da {len(sorgenti)} partizioni")
+
+def archivia_storico(mesi_caldi=STORICO_MESI_CALDI, dry_run=False):
+    """
+    Sposta nell'archivio (una tabella per anno) le esecuzioni con data_esecuzione precedente
+    all'orizzonte caldo. Copia e cancellazione avvengono nella stessa transazione.
+    """
+    limite = data_tra_mesi(datetime.date.today(), -mesi_caldi).isoformat()
+    conn = sqlite3.connect(DB_PATH)
+    c = conn.cursor()
+    try:
+        c.execute("""
+            SELECT substr(data_esecuzione, 1, 4), COUNT(*)
+            FROM scadenze_storico_esecuzioni
+            WHERE data_esecuzione < ?
+            GROUP BY 1 ORDER BY 1
+        """, (limite,))
+        per_anno = c.fetchall()
+        risultato = {'limite': limite, 'anni': {anno: n for anno, n in per_anno}, 'righe': sum(n for _, n in per_anno)}
+        if dry_run or not per_anno:
+            return risultato
+
+        c.execute('ATTACH DATABASE ? AS archivio', (ARCHIVIO_DB_PATH,))
+        c.execute('BEGIN IMMEDIATE')
+        c.execute('INSERT INTO storico_archiviazione_attiva (attiva) VALUES (1)')
+        adesso = datetime.datetime.now().isoformat()
+        for anno, righe in per_anno:
+            if not anno.isdigit():
+                print(f"[WARNING] Archivio storico: anno non valido '{anno}', righe lasciate nella partizione calda")
+                continue
+            tabella = f'storico_esecuzioni_{anno}'
+            c.execute(f'CREATE TABLE IF NOT EXISTS archivio.{tabella} AS SELECT {COLONNE_STORICO} FROM main.scadenze_storico_esecuzioni WHERE 0')
+            c.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS archivio.idx_{tabella}_id ON {tabella}(id)')
+            c.execute(f'CREATE INDEX IF NOT EXISTS archivio.idx_{tabella}_data ON {tabella}(data_esecuzione)')
+            c.execute(f'''
+                INSERT OR IGNORE INTO archivio.{tabella} ({COLONNE_STORICO})
+                SELECT {COLONNE_STORICO} FROM main.scadenze_storico_esecuzioni
+                WHERE data_esecuzione < ? AND substr(data_esecuzione, 1, 4) = ?
+            ''', (limite, anno))
+            c.execute('''
+                DELETE FROM main.scadenze_storico_esecuzioni
+                WHERE data_esecuzione < ? AND substr(data_esecuzione, 1, 4) = ?
+            ''', (limite, anno))
+            c.execute('''
+                INSERT INTO storico_archivio (anno, tabella, righe, archiviato_il) VALUES (?, ?, ?, ?)
+                ON CONFLICT(anno) DO UPDATE SET righe = righe + excluded.righe, archiviato_il = excluded.archiviato_il
+            ''', (anno, tabella, righe, adesso))
+        c.execute('DELETE FROM storico_archiviazione_attiva')
+        conn.commit()
+        print(f"[DEBUG] Archiviate {risultato['righe']} esecuzioni precedenti al {limite}")
+        return risultato
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+@bp.route('/storico/archivia', methods=['POST'])
+def archivia_storico_endpoint():
+    """Archivia le esecuzioni più vecchie di 'mesi' (default 24). Con dry_run restituisce solo i conteggi."""
+    try:
+        data = request.get_json(silent=True) or {}
+        try:
+            mesi = int(data.get('mesi', STORICO_MESI_CALDI))
+        except (TypeError, ValueError):
+            return jsonify({'error': 'Il parametro mesi deve essere numerico'}), 400
+        if mesi < 1:
+            return jsonify({'error': 'Il parametro mesi deve essere almeno 1'}), 400
+        risultato = archivia_storico(mesi, dry_run=bool(data.get('dry_run')))
+        return jsonify(dict(risultato, ok=True, dry_run=bool(data.get('dry_run'))))
+    except Exception as e:
+        print(f"[ERROR] archivia_storico: {e}")
+        traceback.print_exc()
+        return jsonify({'error': str(e)}), 500
+
+@bp.route('/storico/archivio', methods=['GET'])
+def get_archivio_storico():
+    """Partizioni d'archivio presenti e dimensione della partizione calda"""
+    try:
+        conn = sqlite3.connect(DB_PATH)
+        c = conn.cursor()
+        c.execute('SELECT anno, tabella, righe, archiviato_il FROM storico_archivio ORDER BY anno')
+        partizioni = [{'anno': r[0], 'tabella': r[1], 'righe': r[2], 'archiviato_il': r[3]} for r in c.fetchall()]
+        c.execute('SELECT COUNT(*), MIN(data_esecuzione) FROM scadenze_storico_esecuzioni')
+        righe_calde, prima_data = c.fetchone()
+        conn.close()
+        return jsonify({'partizioni': partizioni, 'righe_calde': righe_calde, 'prima_esecuzione_calda': prima_data})
+    except Exception as e:
+        print(f"[ERROR] get_archivio_storico: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@bp.route('/storico/rollup/ricostruisci', methods=['POST'])
+def ricostruisci_rollup_endpoint():
+    """Ricalcola i rollup mensili dello storico (partizione calda + archivio)"""
+    try:
+        conn = sqlite3.connect(DB_PATH)
+        c = conn.cursor()
+        ricostruisci_rollup_storico(c)
+        conn.commit()
+        c.execute('SELECT COUNT(*), COALESCE(SUM(esecuzioni), 0) FROM storico_rollup_mensile')
+        righe, esecuzioni = c.fetchone()
+        conn.close()
+        return jsonify({'ok': True, 'righe_rollup': righe, 'esecuzioni': esecuzioni})
+    except Exception as e:
+        print(f"[ERROR] ricostruisci_rollup: {e}")
+        return jsonify({'error': str(e)}), 500
+
+# --- KPI CONFORMITÀ ---
+# Contatori precalcolati di puntualità per asset, civico, tipo asset e totale. Sono aggiornati dai
+# trigger nella stessa transazione di ogni completamento: inserimento nello storico
+# (crea_nuova_scadenza_ricorrente, completa-gruppi) o passaggio a stato 'completata'
+# (completa_scadenza_internal, completa-scadenza, PATCH completa). I cruscotti leggono una riga per entità.
+KPI_LIVELLI = ('asset', 'civico', 'asset_tipo', 'totale')
+
+def sql_ritardo_giorni(data_scadenza, data_esecuzione):
+    """Giorni di ritardo dell'esecuzione rispetto alla scadenza (0 se eseguita in tempo)"""
+    return (f"MAX(CAST(julianday(substr({data_esecuzione}, 1, 10)) - "
+            f"julianday(substr({data_scadenza}, 1, 10)) AS INTEGER), 0)")
+
+def sql_chiavi_kpi(civico, asset, asset_tipo):
+    """(livello, chiave, civico, asset, asset_tipo) per ciascun livello KPI"""
+    return [
+        ("'asset'", f"{civico} || '|' || {asset}", civico, asset, asset_tipo),
+        ("'civico'", civico, civico, 'NULL', 'NULL'),
+        ("'asset_tipo'", asset_tipo, 'NULL', 'NULL', asset_tipo),
+        ("'totale'", "'*'", 'NULL', 'NULL', 'NULL'),
+    ]
+
+def sql_registra_kpi(civico, asset, asset_tipo, data_scadenza, data_esecuzione):
+    """Statement (per i trigger) che registra un'esecuzione in tutti i livelli KPI"""
+    ritardo = sql_ritardo_giorni(data_scadenza, data_esecuzione)
+    statements = []
+    for livello, chiave, col_civico, col_asset, col_tipo in sql_chiavi_kpi(civico, asset, asset_tipo):
+        statements.append(f"""
+        INSERT INTO kpi_conformita (livello, chiave, civico, asset, asset_tipo, esecuzioni, puntuali,
+                                    ritardo_totale_giorni, ritardo_massimo_giorni, ultima_esecuzione, aggiornato_il)
+        VALUES ({livello}, {chiave}, {col_civico}, {col_asset}, {col_tipo}, 1, {ritardo} = 0,
+                {ritardo}, {ritardo}, substr({data_esecuzione}, 1, 10), datetime('now', 'localtime'))
+        ON CONFLICT(livello, chiave) DO UPDATE SET
+            esecuzioni = esecuzioni + 1,
+            puntuali = puntuali + excluded.puntuali,
+            ritardo_totale_giorni = ritardo_totale_giorni + excluded.ritardo_totale_giorni,
+            ritardo_massimo_giorni = MAX(ritardo_massimo_giorni, excluded.ritardo_massimo_giorni),
+            ultima_esecuzione = MAX(COALESCE(ultima_esecuzione, ''), excluded.ultima_esecuzione),
+            aggiornato_il = excluded.aggiornato_il;""")
+    return ''.join(statements)
+
+def sql_annulla_kpi(civico, asset, asset_tipo, data_scadenza, data_esecuzione):
+    """
+    Statement (per i trigger) che toglie un'esecuzione eliminata da tutti i livelli KPI.
+    Ritardo massimo e ultima esecuzione restano quelli registrati (limite superiore) fino a
+    ricostruisci_kpi; le chiavi senza più esecuzioni vengono rimosse.
+    """
+    ritardo = sql_ritardo_giorni(data_scadenza, data_esecuzione)
+    statements = []
+    for livello, chiave, _, _, _ in sql_chiavi_kpi(civico, asset, asset_tipo):
+        statements.append(f"""
+        UPDATE kpi_conformita SET
+            esecuzioni = esecuzioni - 1,
+            puntuali = puntuali - ({ritardo} = 0),
+            ritardo_totale_giorni = ritardo_totale_giorni - {ritardo},
+            aggiornato_il = datetime('now', 'localtime')
+        WHERE livello = {livello} AND chiave = {chiave};
+        DELETE FROM kpi_conformita WHERE livello = {livello} AND chiave = {chiave} AND esecuzioni <= 0;""")
+    return ''.join(statements)
+
+def init_kpi_db(c):
+    """Crea la tabella KPI e i trigger che la aggiornano a ogni completamento o eliminazione"""
+    c.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'kpi_conformita'")
+    kpi_esistenti = c.fetchone() is not None
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS kpi_conformita (
+        livello TEXT NOT NULL,
+        chiave TEXT NOT NULL,
+        civico TEXT,
+        asset TEXT,
+        asset_tipo TEXT,
+        esecuzioni INTEGER NOT NULL DEFAULT 0,
+        puntuali INTEGER NOT NULL DEFAULT 0,
+        ritardo_totale_giorni INTEGER NOT NULL DEFAULT 0,
+        ritardo_massimo_giorni INTEGER NOT NULL DEFAULT 0,
+        ultima_esecuzione TEXT,
+        aggiornato_il TEXT,
+        PRIMARY KEY (livello, chiave)
+    )
+    ''')
+
+    c.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS trg_kpi_storico_insert
+    AFTER INSERT ON scadenze_storico_esecuzioni
+    BEGIN{sql_registra_kpi('NEW.civico', 'NEW.asset', 'NEW.asset_tipo', 'NEW.data_scadenza_originale', 'NEW.data_esecuzione')}
+    END
+    ''')
+    # Come trg_rollup_storico_delete: lo spostamento in archivio non è un'eliminazione
+    # (i KPI contano anche le partizioni archiviate)
+    c.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS trg_kpi_storico_delete
+    AFTER DELETE ON scadenze_storico_esecuzioni
+    WHEN NOT EXISTS (SELECT 1 FROM storico_archiviazione_attiva)
+    BEGIN{sql_annulla_kpi('OLD.civico', 'OLD.asset', 'OLD.asset_tipo', 'OLD.data_scadenza_originale', 'OLD.data_esecuzione')}
+    END
+    ''')
+    c.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS trg_kpi_scadenza_completata
+    AFTER UPDATE OF stato ON scadenze_calendario
+    WHEN NEW.stato = 'completata' AND COALESCE(OLD.stato, '') != 'completata'
+    BEGIN{sql_registra_kpi('NEW.civico', 'NEW.asset', 'NEW.asset_tipo', 'NEW.data_scadenza',
+                           "COALESCE(NEW.data_completamento, datetime('now', 'localtime'))")}
+    END
+    ''')
+
+    if not kpi_esistenti:
+        ricostruisci_kpi(c)
+
+def ricostruisci_kpi(c):
+    """Ricalcola i KPI da storico (partizione calda e archivio) e scadenze completate"""
+    partizioni = tabelle_archivio_storico(c)
+    if partizioni:
+        c.connection.commit()
+        c.execute('ATTACH DATABASE ? AS archivio', (ARCHIVIO_DB_PATH,))
+
+    sorgenti = [
+        "SELECT civico, asset, asset_tipo, data_scadenza_originale AS data_scadenza, data_esecuzione "
+        "FROM main.scadenze_storico_esecuzioni",
+        "SELECT civico, asset, asset_tipo, data_scadenza, COALESCE(data_completamento, updated_at) "
+        "FROM main.scadenze_calendario WHERE stato = 'completata'",
+    ]
+    sorgenti.extend(
+        f"SELECT civico, asset, asset_tipo, data_scadenza_originale, data_esecuzione FROM archivio.{tabella}"
+        for _, tabella in partizioni
+    )
+    eventi = f"""
+        SELECT civico, asset, asset_tipo, data_esecuzione,
+               {sql_ritardo_giorni('data_scadenza', 'data_esecuzione')} AS ritardo
+        FROM ({' UNION ALL '.join(sorgenti)})
+        WHERE data_esecuzione IS NOT NULL
+    """
+
+    c.execute('DELETE FROM kpi_conformita')
+    for livello, chiave, col_civico, col_asset, col_tipo in sql_chiavi_kpi('civico', 'asset', 'asset_tipo'):
+        c.execute(f"""
+            INSERT INTO kpi_conformita (livello, chiave, civico, asset, asset_tipo, esecuzioni, puntuali,
+                                        ritardo_totale_giorni, ritardo_massimo_giorni, ultima_esecuzione, aggiornato_il)
+            SELECT {livello}, {chiave}, MAX({col_civico}), MAX({col_asset}), MAX({col_tipo}), COUNT(*),
+                   SUM(ritardo = 0), SUM(ritardo), MAX(ritardo), MAX(substr(data_esecuzione, 1, 10)),
+                   datetime('now', 'localtime')
+            FROM ({eventi})
+            GROUP BY {chiave}
+        """)
+
+    if partizioni:
+        c.connection.commit()
+        c.execute('DETACH DATABASE archivio')
+    print("[DEBUG] KPI conformità ricostruiti")
+
+@bp.route('/kpi', methods=['GET'])
+def get_kpi_conformita():
+    """
+    KPI di puntualità precalcolati.
+    Parametri: livello (asset|civico|asset_tipo|totale, default civico), civico, asset_tipo.
+    Le scadenze attualmente scadute sono contate sull'indice (stato, data_scadenza).
+    """
+    try:
+        livello = request.args.get('livello', 'civico')
+        if livello not in KPI_LIVELLI:
+            return jsonify({'error': f'Livello non valido: {livello}'}), 400
+
+        query = """
+            SELECT chiave, civico, asset, asset_tipo, esecuzioni, puntuali, ritardo_totale_giorni,
+                   ritardo_massimo_giorni, ultima_esecuzione, aggiornato_il
+            FROM kpi_conformita WHERE livello = ?
+        """
+        params = [livello]
+        if request.args.get('civico') and livello in ('asset', 'civico'):
+            query += " AND civico = ?"
+            params.append(request.args.get('civico'))
+        if request.args.get('asset_tipo') and livello in ('asset', 'asset_tipo'):
+            query += " AND asset_tipo = ?"
+            params.append(request.args.get('asset_tipo'))
+
+        conn = sqlite3.connect(DB_PATH)
+        c = conn.cursor()
+        c.execute(query + " ORDER BY chiave", params)
+        righe = c.fetchall()
+
+        # Scadute ora: intervallo dell'indice limitato alle sole scadenze passate
+        chiave_scadute = {
+            'asset': "civico || '|' || asset",
+            'civico': 'civico',
+            'asset_tipo': 'asset_tipo',
+            'totale': "'*'",
+        }[livello]
+        c.execute(f"""
+            SELECT {chiave_scadute}, COUNT(*)
+            FROM scadenze_calendario
+            WHERE stato = 'programmata' AND data_scadenza < ?
+            GROUP BY 1
+        """, (data_canonica(datetime.date.today()),))
+        scadute = dict(c.fetchall())
+        conn.close()
+
+        kpi = []
+        for chiave, civico, asset, asset_tipo, esecuzioni, puntuali, ritardo_totale, ritardo_massimo, ultima, aggiornato in righe:
+            in_ritardo = esecuzioni - puntuali
+            kpi.append({
+                'chiave': chiave,
+                'civico': civico,
+                'asset': asset,
+                'asset_tipo': asset_tipo,
+                'esecuzioni': esecuzioni,
+                'puntuali': puntuali,
+                'in_ritardo': in_ritardo,
+                'percentuale_puntuali': round(puntuali * 100.0 / esecuzioni, 1) if esecuzioni else None,
+                'ritardo_medio_giorni': round(ritardo_totale / esecuzioni, 1) if esecuzioni else None,
+                'ritardo_medio_in_ritardo_giorni': round(ritardo_totale / in_ritardo, 1) if in_ritardo else 0,
+                'ritardo_massimo_giorni': ritardo_massimo,
+                'scadute': scadute.get(chiave, 0),
+                'ultima_esecuzione': ultima,
+                'aggiornato_il': aggiornato
+            })
+
+        return jsonify({'livello': livello, 'kpi': kpi})
+
+    except Exception as e:
+        print(f"[ERROR] get_kpi_conformita: {e}")
+        traceback.print_exc()
+        return jsonify({'error': str(e)}), 500
+
+@bp.route('/kpi/ricostruisci', methods=['POST'])
+def ricostruisci_kpi_endpoint():
+    """Ricalcola da zero i KPI di conformità"""
+    try:
+        conn = sqlite3.connect(DB_PATH)
+        c = conn.cursor()
+        ricostruisci_kpi(c)
+        conn.commit()
+        c.execute("SELECT livello, COUNT(*) FROM kpi_conformita GROUP BY livello")
+        righe = dict(c.fetchall())
+        conn.close()
+        return jsonify({'ok': True, 'righe': righe})
+    except Exception as e:
+        print(f"[ERROR] ricostruisci_kpi: {e}")
+        return jsonify({'error': str(e)}), 500
+
+# --- TIMELINE ASSET ---
+# Storia completa di un asset (esecuzioni, compilazioni form, alert, scadenze programmate) in un
+# unico flusso ordinato dal più recente, paginato con un cursore (chiave temporale, tipo, id).
+# Ogni sorgente è letta con un indice (asset, chiave temporale) e l'unione avviene in una sola query.
+TIMELINE_LIMITE_DEFAULT = 50
+TIMELINE_LIMITE_MAX = 200
+TIMELINE_SORGENTI = {
+    'alert': {
+        'chiave': "replace(a.data_creazione, ' ', 'T')",
+        'select': """a.id, a.titolo, a.operatore, a.stato, a.descrizione, a.data_chiusura, a.tipo
+                     FROM alert a""",
+        'alias': 'a',
+        'asset': 'a.asset',
+    },
+    'esecuzione': {
+        'chiave': 'e.data_esecuzione',
+        'select': """e.id, e.nome_voce, e.operatore_esecuzione, e.esito, e.note_esecuzione,
+                     e.data_scadenza_originale, NULL
+                     FROM scadenze_storico_esecuzioni e""",
+        'alias': 'e',
+        'asset': 'e.asset',
+    },
+    'form': {
+        'chiave': 'f.created_at',
+        'select': """f.id, (SELECT t.nome FROM form_templates t WHERE t.id = f.template_id), f.operatore,
+                     NULL, NULL, f.data_intervento, NULL
+                     FROM form_submissions f""",
+        'alias': 'f',
+        'asset': 'f.asset_id',
+    },
+    'scadenza': {
+        'chiave': 's.data_scadenza',
+        'select': """s.id, COALESCE(v.nome_voce, m.nome_manutenzione), NULL, s.stato,
+                     COALESCE(v.descrizione, m.descrizione), s.data_scadenza, s.frequenza_tipo
+                     FROM scadenze_calendario s
+                     LEFT JOIN manutenzione_programmata_checklist v ON s.checklist_voce_id = v.id
+                     LEFT JOIN manutenzione_tipologie m ON s.manutenzione_id = m.id""",
+        'alias': 's',
+        'asset': 's.asset',
+        'filtro': "s.stato = 'programmata'",
+    },
+}
+
+def init_timeline_indici(c):
+    """Indici (asset, chiave temporale) usati dalla timeline; form_submissions può non esistere ancora"""
+    c.execute('CREATE INDEX IF NOT EXISTS idx_storico_asset_data ON scadenze_storico_esecuzioni(asset, data_esecuzione)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_scadenze_asset_data ON scadenze_calendario(asset, data_scadenza)')
+    try:
+        c.execute('CREATE INDEX IF NOT EXISTS idx_form_submissions_asset ON form_submissions(asset_id, created_at)')
+    except sqlite3.OperationalError as e:
+        print(f"[DEBUG] Indice timeline form_submissions non creato: {e}")
+
+def codifica_cursore_timeline(chiave, tipo, evento_id):
+    return base64.urlsafe_b64encode(json.dumps([chiave, tipo, evento_id]).encode('utf-8')).decode('ascii')
+
+def decodifica_cursore_timeline(cursore):
+    chiave, tipo, evento_id = json.loads(base64.urlsafe_b64decode(cursore.encode('ascii')).decode('utf-8'))
+    if tipo not in TIMELINE_SORGENTI:
+        raise ValueError('tipo non valido')
+    return str(chiave), tipo, int(evento_id)
+
+@bp.route('/asset/<path:asset_id>/timeline', methods=['GET'])
+def get_timeline_asset(asset_id):
+    """
+    Timeline di un asset (id_aziendale): esecuzioni, compilazioni form, alert e scadenze programmate
+    in ordine cronologico inverso. Parametri: limit (default 50, max 200), cursor (dal campo
+    next_cursor della pagina precedente), tipi (sottoinsieme separato da virgole di
+    alert, esecuzione, form, scadenza). La prima pagina include i dati anagrafici dell'asset.
+    """
+    try:
+        try:
+            limite = min(max(int(request.args.get('limit', TIMELINE_LIMITE_DEFAULT)), 1), TIMELINE_LIMITE_MAX)
+        except ValueError:
+            return jsonify({'error': 'Parametro limit non valido'}), 400
+
+        tipi = [t.strip() for t in request.args.get('tipi', ','.join(TIMELINE_SORGENTI)).split(',') if t.strip()]
+        for tipo in tipi:
+            if tipo not in TIMELINE_SORGENTI:
+                return jsonify({'error': f'Tipo non valido: {tipo}'}), 400
+
+        cursore = None
+        if request.args.get('cursor'):
+            try:
+                cursore = decodifica_cursore_timeline(request.args.get('cursor'))
+            except (ValueError, TypeError, binascii.Error):
+                return jsonify({'error': 'Cursore non valido'}), 400
+
+        # Una sottoquery per sorgente, ciascuna limitata e ordinata sul proprio indice
+        sottoquery = []
+        params = []
+        for tipo in tipi:
+            sorgente = TIMELINE_SORGENTI[tipo]
+            chiave = sorgente['chiave']
+            condizioni = [f"{sorgente['asset']} = ?", f"{chiave} IS NOT NULL"]
+            params.append(asset_id)
+            if sorgente.get('filtro'):
+                condizioni.append(sorgente['filtro'])
+            if cursore:
+                chiave_cursore, tipo_cursore, id_cursore = cursore
+                # Ordine (chiave, tipo, id) decrescente: con il tipo costante per sorgente la condizione
+                # si riduce a un intervallo sull'indice
+                if tipo < tipo_cursore:
+                    condizioni.append(f"{chiave} <= ?")
+                    params.append(chiave_cursore)
+                elif tipo == tipo_cursore:
+                    condizioni.append(f"({chiave} < ? OR ({chiave} = ? AND {sorgente['alias']}.id < ?))")
+                    params.extend([chiave_cursore, chiave_cursore, id_cursore])
+                else:
+                    condizioni.append(f"{chiave} < ?")
+                    params.append(chiave_cursore)
+            sottoquery.append(f"""
+                SELECT * FROM (
+                    SELECT {chiave} AS chiave, '{tipo}' AS tipo, {sorgente['select']}
+                    WHERE {' AND '.join(condizioni)}
+                    ORDER BY {chiave} DESC, {sorgente['alias']}.id DESC
+                    LIMIT ?
+                )""")
+            params.append(limite + 1)
+
+        conn = sqlite3.connect(DB_PATH)
+        c = conn.cursor()
+        c.execute(
+            ' UNION ALL '.join(sottoquery) + ' ORDER BY chiave DESC, tipo DESC, id DESC LIMIT ?',
+            params + [limite + 1]
+        )
+        righe = c.fetchall()
+        conn.close()
+
+        eventi = []
+        for chiave, tipo, evento_id, titolo, operatore, stato, descrizione, data_riferimento, sottotipo in righe[:limite]:
+            eventi.append({
+                'tipo': tipo,
+                'id': evento_id,
+                'data': chiave,
+                'titolo': titolo,
+                'operatore': operatore,
+                'stato': stato,
+                'descrizione': descrizione,
+                'data_riferimento': data_riferimento,
+                'sottotipo': sottotipo
+            })
+
+        next_cursor = None
+        if len(righe) > limite:
+            ultimo = eventi[-1]
+            next_cursor = codifica_cursore_timeline(ultimo['data'], ultimo['tipo'], ultimo['id'])
+
+        risposta = {'asset_id': asset_id, 'eventi': eventi, 'next_cursor': next_cursor}
+
+        # Dati anagrafici dell'asset solo sulla prima pagina (lookup sulla chiave primaria di gestman.db)
+        if not cursore:
+            conn_assets = sqlite3.connect(os.path.join(os.path.dirname(__file__), 'gestman.db'))
+            c_assets = conn_assets.cursor()
+            c_assets.execute('SELECT id_aziendale, tipo, civico_numero, dati FROM assets WHERE id_aziendale = ?', (asset_id,))
+            asset_row = c_assets.fetchone()
+            conn_assets.close()
+            if asset_row:
+                try:
+                    dati = json.loads(asset_row[3]) if asset_row[3] else {}
+                except (TypeError, ValueError):
+                    dati = {}
+                risposta['asset'] = {'id_aziendale': asset_row[0], 'tipo': asset_row[1],
+                                     'civico': asset_row[2], 'dati': dati}
+            else:
+                risposta['asset'] = None
+
+        return jsonify(risposta)
+
+    except Exception as e:
+        print(f"[ERROR] get_timeline_asset: {e}")
+        traceback.print_exc()
+        return jsonify({'error': str(e)}), 500
+
+# --- SINCRONIZZAZIONE OFFLINE (PWA) ---
+# Il service worker accoda completamenti e compilazioni quando manca la rete e li
+# invia in blocco a POST /sync, ognuno con la chiave di idempotenza già inviata nel
+# primo tentativo (registro in idempotenza.py). Le chiavi già applicate restituiscono la
+# risposta memorizzata, così un invio ripetuto (risposta persa, doppio tap, riavvio del
+# telefono) non duplica nulla.
+
+SYNC_MAX_OPERAZIONI = 500
+SYNC_TIPI = ('completa-scadenza', 'completa-gruppo', 'form-submission')
+
+def applica_operazione_sync(c, tipo, payload):
+    """
+    Applica una singola operazione della coda offline con il cursore della transazione.
+    Restituisce (risposta, azioni da eseguire dopo il commit).
+    """
+    if tipo == 'completa-scadenza':
+        esegui_completa_scadenza(c, payload)
+        return {'ok': True, 'message': 'Manutenzione completata con successo'}, []
+
+    if tipo == 'completa-gruppo':
+        voci_processate = esegui_completa_gruppo(c, payload)
+        return {
+            'success': True,
+            'message': f'Gruppo completato con successo - processate {voci_processate} tipologie di manutenzione'
+        }, []
+
+    submission_id, alert_issues = salva_submission(c, payload)
+    azioni = [(send_non_conformity_alerts, (alert_issues, payload))] if alert_issues else []
+    return {
+        'message': 'Form compilato con successo',
+        'submission_id': submission_id,
+        'alerts_generated': len(alert_issues) if alert_issues else 0
+    }, azioni
+
+@bp.route('/sync', methods=['POST'])
+def sincronizza_operazioni():
+    """
+    Applica in un'unica transazione le operazioni accodate offline dalla PWA.
+    Payload: {'operazioni': [{'idempotency_key', 'tipo', 'payload'}]} con tipo in
+    completa-scadenza, completa-gruppo, form-submission (payload identico all'endpoint originale).
+    Le chiavi già viste (anche dal primo tentativo sull'endpoint originale, header Idempotency-Key)
+    restituiscono la risposta memorizzata con duplicata=true; un'operazione
+    con dati non validi (anche scadenza o voce eliminate nel frattempo, data o frequenza non
+    utilizzabili) viene annullata da sola (savepoint) e registrata con stato 400, così il client
+    può toglierla dalla coda senza bloccare le successive. Solo un errore dell'infrastruttura
+    (database bloccato o non scrivibile) annulla l'intero invio (500).
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        operazioni = data.get('operazioni')
+
+        if not isinstance(operazioni, list) or not operazioni:
+            return jsonify({'error': 'Parametro mancante: operazioni'}), 400
+        if len(operazioni) > SYNC_MAX_OPERAZIONI:
+            return jsonify({'error': f'Massimo {SYNC_MAX_OPERAZIONI} operazioni per invio'}), 400
+
+        for indice, op in enumerate(operazioni):
+            if not isinstance(op, dict):
+                return jsonify({'error': f'Operazione {indice} non valida'}), 400
+            if not chiave_valida(op.get('idempotency_key')):
+                return jsonify({'error': f'idempotency_key mancante o non valida (operazione {indice})'}), 400
+            if op.get('tipo') not in SYNC_TIPI:
+                return jsonify({'error': f'tipo non valido (operazione {indice}): usare {", ".join(SYNC_TIPI)}'}), 400
+            if not isinstance(op.get('payload'), dict):
+                return jsonify({'error': f'payload mancante (operazione {indice})'}), 400
+
+        conn = sqlite3.connect(DB_PATH)
+        c = conn.cursor()
+        # Lock di scrittura subito: due invii concorrenti della stessa coda non possono applicarla due volte
+        c.execute('BEGIN IMMEDIATE')
+
+        try:
+            gia_applicate = carica_operazioni_sincronizzate(c, {op['idempotency_key'] for op in operazioni})
+            risultati = []
+            registro = []
+            azioni_post_commit = []
+            applicate = duplicate = errori = 0
+
+            for op in operazioni:
+                chiave, tipo, payload = op['idempotency_key'], op['tipo'], op['payload']
+
+                if chiave in gia_applicate:
+                    stato_http, risposta = gia_applicate[chiave]
+                    risultati.append({'idempotency_key': chiave, 'tipo': tipo, 'status': stato_http,
+                                      'duplicata': True, 'risposta': risposta})
+                    duplicate += 1
+                    continue
+
+                c.execute('SAVEPOINT sync_op')
+                try:
+                    risposta, azioni = applica_operazione_sync(c, tipo, payload)
+                    c.execute('RELEASE SAVEPOINT sync_op')
+                    stato_http = 200
+                    azioni_post_commit.extend(azioni)
+                    applicate += 1
+                except (OperazioneNonValida, sqlite3.IntegrityError) as e:
+                    # Dati non validi, righe sparite o vincoli violati: l'operazione non riuscirà mai,
+                    # quindi è rifiutata da sola e brucia la chiave. Solo gli errori dell'infrastruttura
+                    # (database bloccato, disco pieno...) annullano l'invio (500) e restano in coda
+                    c.execute('ROLLBACK TO SAVEPOINT sync_op')
+                    c.execute('RELEASE SAVEPOINT sync_op')
+                    stato_http = 400
+                    risposta = {'error': str(e)}
+                    errori += 1
+
+                gia_applicate[chiave] = (stato_http, risposta)
+                registro.append((chiave, tipo, stato_http, risposta, payload.get('operatore')))
+                risultati.append({'idempotency_key': chiave, 'tipo': tipo, 'status': stato_http,
+                                  'duplicata': False, 'risposta': risposta})
+
+            registra_operazioni_sincronizzate(c, registro)
+
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+        # Alert di non conformità dei form solo a transazione confermata (Telegram è già in coda)
+        for funzione, argomenti in azioni_post_commit:
+            try:
+                funzione(*argomenti)
+            except Exception as e:
+                print(f"[WARNING] Notifica post-sincronizzazione non inviata: {e}")
+
+        print(f"[DEBUG] Sync offline: {applicate} applicate, {duplicate} duplicate, {errori} con errori")
+
+        return jsonify({
+            'success': True,
+            'applicate': applicate,
+            'duplicate': duplicate,
+            'errori': errori,
+            'risultati': risultati
+        })
+
+    except Exception as e:
+        print(f"[ERROR] sincronizza_operazioni: {e}")
+        traceback.print_exc()
+        return jsonify({'error': str(e)}), 500
+
+# --- INDICE CALENDARIO RESIDENTE ---
+# Modello di lettura opzionale tenuto in memoria da ogni worker: le scadenze (con nome voce
+# e preavviso già risolti) in record compatti con __slots__, ordinati per data, con indici
+# secondari per civico e per asset. /scadenze, /scadenze-raggruppate e /scadenze-prossime
+# rispondono da qui; a ogni richiesta si legge solo il registro delle modifiche
+# (scadenze_log_modifiche, alimentato dai trigger) e si ricaricano le sole righe cambiate.
+# Un cambio di voci/tipologie (contatore 'voci') o un buco nel registro forzano il ricaricamento.
+#
+# Memoria: circa 550 byte per scadenza (record, chiave di ordinamento, voci negli indici);
+# le stringhe ripetute (civico, asset, tipo, stato, nomi voce) sono condivise con sys.intern.
+# Oltre INDICE_CALENDARIO_MAX_RIGHE righe l'indice si disattiva e si torna alle query SQLite,
+# quindi la memoria per worker resta sotto ~110 MB. GESTMAN_INDICE_CALENDARIO=0 lo disabilita.
+
+INDICE_CALENDARIO_ATTIVO = os.getenv('GESTMAN_INDICE_CALENDARIO', '1') != '0'
+INDICE_CALENDARIO_MAX_RIGHE = 200000
+# Oltre questo numero di righe modificate conviene ricaricare tutto
+INDICE_CALENDARIO_MAX_DELTA = 5000
+# Voci conservate nel registro modifiche: un worker fermo da più modifiche ricarica da zero
+INDICE_CALENDARIO_LOG_MAX = 50000
+
+# Giorno giuliano della mezzanotte del giorno d'ordinale 0 (come julianday() di SQLite)
+JULIANDAY_ORDINALE_ZERO = 1721424.5
+
+def init_indice_calendario_db(c):
+    """Registro delle scadenze modificate, letto dagli indici residenti dei worker"""
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS scadenze_log_modifiche (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        scadenza_id INTEGER NOT NULL
+    )
+    ''')
+    for evento, riga in (('INSERT', 'NEW'), ('UPDATE', 'NEW'), ('DELETE', 'OLD')):
+        c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_log_scadenze_{evento.lower()}
+        AFTER {evento} ON scadenze_calendario
+        BEGIN
+            INSERT INTO scadenze_log_modifiche (scadenza_id) VALUES ({riga}.id);
+            DELETE FROM scadenze_log_modifiche
+            WHERE seq <= (SELECT MAX(seq) FROM scadenze_log_modifiche) - {INDICE_CALENDARIO_LOG_MAX};
+        END
+        ''')
+
+class ScadenzaResidente:
+    """Riga di scadenze_calendario con voce/tipologia risolte; giorni_rimanenti è calcolato alla lettura"""
+    __slots__ = ('id', 'civico', 'asset', 'asset_tipo', 'data_scadenza', 'stato',
+                 'data_completamento', 'operatore_completamento', 'note_completamento',
+                 'data_prossima_scadenza', 'frequenza_tipo', 'giorni_preavviso',
+                 'checklist_voce_id', 'manutenzione_id', 'nome_manutenzione', 'descrizione',
+                 'giorni_preavviso_final', 'julianday', 'data_scadenza_formatted', 'chiave')
+
+    def __init__(self, row):
+        (self.id, civico, asset, asset_tipo, self.data_scadenza, stato,
+         self.data_completamento, self.operatore_completamento, self.note_completamento,
+         self.data_prossima_scadenza, frequenza_tipo, self.giorni_preavviso,
+         self.checklist_voce_id, self.manutenzione_id, nome_manutenzione, descrizione,
+         self.giorni_preavviso_final, self.julianday, self.data_scadenza_formatted) = row
+        self.civico = intern_testo(civico)
+        self.asset = intern_testo(asset)
+        self.asset_tipo = intern_testo(asset_tipo)
+        self.stato = intern_testo(stato)
+        self.frequenza_tipo = intern_testo(frequenza_tipo)
+        self.nome_manutenzione = intern_testo(nome_manutenzione)
+        self.descrizione = intern_testo(descrizione)
+        # Stesso ordine delle query SQL: data, poi asset (per i gruppi), poi id
+        self.chiave = (self.data_scadenza or '', self.asset or '', self.id)
+
+def intern_testo(valore):
+    return sys.intern(valore) if isinstance(valore, str) else valore
+
+SQL_SCADENZE_RESIDENTI = """
+    SELECT s.id, s.civico, s.asset, s.asset_tipo, s.data_scadenza, s.stato,
+           s.data_completamento, s.operatore_completamento, s.note_completamento,
+           s.data_prossima_scadenza, s.frequenza_tipo, s.giorni_preavviso,
+           s.checklist_voce_id, s.manutenzione_id,
+           COALESCE(c.nome_voce, m.nome_manutenzione),
+           COALESCE(c.descrizione, m.descrizione),
+           COALESCE(s.giorni_preavviso, m.giorni_preavviso),
+           julianday(s.data_scadenza), strftime('%d/%m/%Y', s.data_scadenza)
+    FROM scadenze_calendario s
+    LEFT JOIN manutenzione_programmata_checklist c ON s.checklist_voce_id = c.id
+    LEFT JOIN manutenzione_tipologie m ON s.manutenzione_id = m.id
+"""
+
+class ListaScadenze:
+    """Lista di record ordinata per chiave, con inserimento/rimozione per bisezione"""
+    __slots__ = ('chiavi', 'record')
+
+    def __init__(self):
+        self.chiavi = []
+        self.record = []
+
+    def aggiungi(self, rec):
+        i = bisect.bisect_left(self.chiavi, rec.chiave)
+        self.chiavi.insert(i, rec.chiave)
+        self.record.insert(i, rec)
+
+    def rimuovi(self, rec):
+        i = bisect.bisect_left(self.chiavi, rec.chiave)
+        if i < len(self.chiavi) and self.chiavi[i] == rec.chiave:
+            del self.chiavi[i]
+            del self.record[i]
+
+class IndiceCalendario:
+    """Stato dell'indice residente del worker corrente"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.caricato = False
+        self.versione_voci = None
+        self.ultimo_seq = 0
+        self.per_id = {}
+        self.ordinate = ListaScadenze()
+        self.per_civico = {}
+        self.per_asset = {}
+
+    def _aggiungi(self, rec):
+        self.per_id[rec.id] = rec
+        self.ordinate.aggiungi(rec)
+        self.per_civico.setdefault(rec.civico, ListaScadenze()).aggiungi(rec)
+        self.per_asset.setdefault(rec.asset, ListaScadenze()).aggiungi(rec)
+
+    def _rimuovi(self, scadenza_id):
+        rec = self.per_id.pop(scadenza_id, None)
+        if rec is None:
+            return
+        self.ordinate.rimuovi(rec)
+        for indice, valore in ((self.per_civico, rec.civico), (self.per_asset, rec.asset)):
+            lista = indice.get(valore)
+            if lista is not None:
+                lista.rimuovi(rec)
+                if not lista.record:
+                    del indice[valore]
+
+    def _ricarica(self, c, versione_voci, ultimo_seq):
+        c.execute('SELECT COUNT(*) FROM scadenze_calendario')
+        if c.fetchone()[0] > INDICE_CALENDARIO_MAX_RIGHE:
+            self.caricato = False
+            print(f"[DEBUG] Indice calendario disattivato: più di {INDICE_CALENDARIO_MAX_RIGHE} scadenze")
+            return False
+        c.execute(SQL_SCADENZE_RESIDENTI)
+        record = sorted((ScadenzaResidente(row) for row in c.fetchall()), key=lambda r: r.chiave)
+        self.per_id = {rec.id: rec for rec in record}
+        self.ordinate = ListaScadenze()
+        self.ordinate.chiavi = [rec.chiave for rec in record]
+        self.ordinate.record = record
+        self.per_civico = {}
+        self.per_asset = {}
+        for rec in record:
+            for indice, valore in ((self.per_civico, rec.civico), (self.per_asset, rec.asset)):
+                lista = indice.get(valore)
+                if lista is None:
+                    lista = indice[valore] = ListaScadenze()
+                lista.chiavi.append(rec.chiave)
+                lista.record.append(rec)
+        self.versione_voci = versione_voci
+        self.ultimo_seq = ultimo_seq
+        self.caricato = True
+        print(f"[DEBUG] Indice calendario caricato: {len(record)} scadenze")
+        return True
+
+    def aggiorna(self, c):
+        """Allinea l'indice al database; False se l'indice non è utilizzabile"""
+        c.execute(f"""
+            SELECT {SQL_VERSIONE_VOCI},
+                   (SELECT MAX(seq) FROM scadenze_log_modifiche),
+                   (SELECT MIN(seq) FROM scadenze_log_modifiche)
+        """)
+        versione_voci, max_seq, min_seq = c.fetchone()
+        max_seq = max_seq or 0
+
+        if (not self.caricato or versione_voci != self.versione_voci
+                or (min_seq is not None and self.ultimo_seq + 1 < min_seq)):
+            return self._ricarica(c, versione_voci, max_seq)
+
+        if max_seq == self.ultimo_seq:
+            return True
+
+        c.execute('SELECT DISTINCT scadenza_id FROM scadenze_log_modifiche WHERE seq > ? AND seq <= ?',
+                  (self.ultimo_seq, max_seq))
+        ids = [row[0] for row in c.fetchall()]
+        if len(ids) > INDICE_CALENDARIO_MAX_DELTA:
+            return self._ricarica(c, versione_voci, max_seq)
+
+        for i in range(0, len(ids), SQLITE_MAX_PARAMS):
+            blocco = ids[i:i + SQLITE_MAX_PARAMS]
+            c.execute(f"{SQL_SCADENZE_RESIDENTI} WHERE s.id IN ({','.join('?' * len(blocco))})", blocco)
+            righe = c.fetchall()
+            for scadenza_id in blocco:
+                self._rimuovi(scadenza_id)
+            for row in righe:
+                self._aggiungi(ScadenzaResidente(row))
+        if len(self.per_id) > INDICE_CALENDARIO_MAX_RIGHE:
+            self.caricato = False
+            return False
+        self.ultimo_seq = max_seq
+        return True
+
+    def righe(self, c, colonne, civico=None, asset=None, asset_tipo=None, stato=None, data_max=None, solo_con_voce=False):
+        """
+        Righe (tuple nell'ordine di colonne) che soddisfano i filtri, in ordine di data.
+        'giorni_rimanenti' è calcolato rispetto a oggi come nella vista v_scadenze_calendario.
+        Restituisce None se l'indice non è disponibile.
+        """
+        with self.lock:
+            if not self.aggiorna(c):
+                return None
+            if civico:
+                lista = self.per_civico.get(civico)
+            elif asset:
+                lista = self.per_asset.get(asset)
+            else:
+                lista = self.ordinate
+            if lista is None:
+                return []
+
+            julianday_oggi = datetime.date.today().toordinal() + JULIANDAY_ORDINALE_ZERO
+            risultato = []
+            for rec in lista.record:
+                if data_max is not None:
+                    # Come "data_scadenza <= ?" in SQL: le date nulle (in testa) sono escluse
+                    if rec.data_scadenza is None:
+                        continue
+                    if rec.data_scadenza > data_max:
+                        break
+                if (civico and rec.civico != civico) or (asset and rec.asset != asset):
+                    continue
+                if (asset_tipo and rec.asset_tipo != asset_tipo) or (stato and rec.stato != stato):
+                    continue
+                if solo_con_voce and rec.checklist_voce_id is None and rec.manutenzione_id is None:
+                    continue
+                giorni = int(rec.julianday - julianday_oggi) if rec.julianday is not None else None
+                risultato.append(tuple(giorni if col == 'giorni_rimanenti' else getattr(rec, col)
+                                       for col in colonne))
+            return risultato
+
+_indice_calendario = IndiceCalendario()
+
+def righe_indice_calendario(c, colonne, **filtri):
+    """Righe dall'indice residente del worker, oppure None per usare la query SQLite"""
+    if not INDICE_CALENDARIO_ATTIVO:
+        return None
+    try:
+        return _indice_calendario.righe(c, colonne, **filtri)
+    except Exception as e:
+        print(f"[ERROR] Indice calendario non disponibile: {e}")
+        _indice_calendario.caricato = False
+        return None
+
+# --- INIZIALIZZAZIONE ---
+init_calendario_db()
+
+# --- ENDPOINT DEBUG ---
+@bp.route('/debug/tipologie', methods=['GET'])
+def debug_tipologie():
+    """Endpoint di debug per controllare le tipologie presenti"""
+    try:
+        conn = sqlite3.connect(DB_PATH)
+        c = conn.cursor()
+        
+        c.execute("SELECT asset_tipo, nome_manutenzione, id FROM manutenzione_tipologie ORDER BY asset_tipo, nome_manutenzione")
+        tipologie = c.fetchall()
+        conn.close()
+        
+        return jsonify({
+            'count': len(tipologie),
+            'tipologie': [{'id': t[2], 'asset_tipo': t[0], 'nome_manutenzione': t[1]} for t in tipologie]
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# --- ENDPOINT SCADENZE IN ARRIVO ---
+COLONNE_SCADENZE_PROSSIME = ('id', 'civico', 'asset', 'asset_tipo', 'data_scadenza', 'nome_manutenzione',
+                             'descrizione', 'giorni_preavviso_final', 'stato', 'frequenza_tipo',
+                             'giorni_rimanenti', 'data_scadenza_formatted')
+
+@bp.route('/scadenze-prossime', methods=['GET'])
+def get_scadenze_prossime():
+    """Ottieni scadenze in arrivo nei prossimi giorni (sia vecchio che nuovo formato)"""
+    try:
+        giorni_anticipo = request.args.get('giorni', 30, type=int)
+        
+        conn = sqlite3.connect(DB_PATH)
+        c = conn.cursor()
+        
+        data_limite = data_canonica(datetime.date.today() + datetime.timedelta(days=giorni_anticipo))
+        
+        # Dall'indice residente se disponibile, altrimenti query SQLite
+        scadenze = righe_indice_calendario(c, COLONNE_SCADENZE_PROSSIME, stato='programmata',
+                                           data_max=data_limite, solo_con_voce=True)
+        if scadenze is None:
+            # Query aggiornata per gestire sia nuovo che vecchio formato
+            c.execute("""
+                SELECT s.id, s.civico, s.asset, s.asset_tipo, s.data_scadenza,
+                       COALESCE(c.nome_voce, m.nome_manutenzione) as nome_manutenzione,
+                       COALESCE(c.descrizione, m.descrizione) as descrizione,
+                       COALESCE(s.giorni_preavviso, m.giorni_preavviso) as giorni_preavviso,
+                       s.stato, s.frequenza_tipo, s.giorni_rimanenti, s.data_scadenza_formatted
+                FROM v_scadenze_calendario s
+                LEFT JOIN manutenzione_programmata_checklist c ON s.checklist_voce_id = c.id
+                LEFT JOIN manutenzione_tipologie m ON s.manutenzione_id = m.id
+                WHERE s.stato = 'programmata' 
+                  AND s.data_scadenza <= ?
+                  AND (s.checklist_voce_id IS NOT NULL OR s.manutenzione_id IS NOT NULL)
+                ORDER BY s.data_scadenza ASC
+            """, (data_limite,))
+        
+            scadenze = c.fetchall()
+        conn.close()
+        
+        print(f"[DEBUG] Scadenze prossime trovate: {len(scadenze)}")
+        for scadenza in scadenze:
+            print(f"[DEBUG] Scadenza: ID={scadenza[0]}, Asset={scadenza[2]}, Nome={scadenza[5]}")
+        
+        scadenze_list = []
+        for row in scadenze:
+            try:
+                giorni_rimanenti = row[10]
                 giorni_preavviso = row[7] if row[7] is not None else 7  # Default a 7 giorni
                 
                 scadenze_list.append({
@@ -1812,7 +3972,7 @@ def get_scadenze_prossime():
                     'civico': row[1],
                     'asset': row[2],
                     'asset_tipo': row[3],
-                    'data_scadenza': data_scadenza.strftime('%d/%m/%Y'),
+                    'data_scadenza': row[11],
                     'nome_manutenzione': row[5] or 'Manutenzione Programmata',
                     'descrizione': row[6] or '',
                     'giorni_preavviso': giorni_preavviso,
@@ -1906,8 +4066,8 @@ def test_alert_scadenze():
             SELECT s.id, s.civico, s.asset, s.asset_tipo, s.data_scadenza,
                    COALESCE(cl.nome_voce, m.nome_manutenzione) as nome_manutenzione,
                    COALESCE(s.giorni_preavviso, m.giorni_preavviso, 7) as giorni_preavviso,
-                   s.stato, s.frequenza_tipo
-            FROM scadenze_calendario s
+                   s.stato, s.frequenza_tipo, s.giorni_rimanenti, s.data_scadenza_formatted
+            FROM v_scadenze_calendario s
             LEFT JOIN manutenzione_programmata_checklist cl ON s.checklist_voce_id = cl.id
             LEFT JOIN manutenzione_tipologie m ON s.manutenzione_id = m.id
             WHERE s.stato = 'programmata'
@@ -1919,19 +4079,15 @@ def test_alert_scadenze():
         scadenze_info = []
         
         for scadenza in scadenze:
-            scadenza_id, civico, asset, asset_tipo, data_scadenza_str, nome_manutenzione, giorni_preavviso, stato, frequenza_tipo = scadenza
+            scadenza_id, civico, asset, asset_tipo, data_scadenza_str, nome_manutenzione, giorni_preavviso, stato, frequenza_tipo, giorni_rimanenti, data_scadenza_formatted = scadenza
             
             try:
-                data_scadenza = datetime.datetime.fromisoformat(data_scadenza_str)
-                giorni_rimanenti = (data_scadenza - now).days
                 
                 # Verifica se esistono alert per questa scadenza
                 c.execute("""
-                    SELECT COUNT(*) FROM alert 
-                    WHERE tipo = 'scadenza' 
-                    AND civico = ? AND asset = ? 
-                    AND titolo LIKE ?
-                """, (civico, asset, f'%{nome_manutenzione}%'))
+                    SELECT COUNT(*) FROM alert
+                    WHERE origine_chiave = ?
+                """, (chiave_origine_alert(scadenza_id, data_scadenza_str),))
                 
                 alert_esistenti = c.fetchone()[0]
                 
@@ -1954,7 +4110,7 @@ def test_alert_scadenze():
                     'civico': civico,
                     'asset': asset,
                     'nome_manutenzione': nome_manutenzione,
-                    'data_scadenza': data_scadenza.strftime('%d/%m/%Y'),
+                    'data_scadenza': data_scadenza_formatted,
                     'giorni_rimanenti': giorni_rimanenti,
                     'giorni_preavviso': giorni_preavviso,
                     'dovrebbe_avere_alert': dovrebbe_avere_alert,
@@ -1996,46 +4152,32 @@ def get_form_gruppo():
         
         print(f"[DEBUG] Richiesta form gruppo per civico='{civico}', asset='{asset}', data_scadenza='{data_scadenza}'")
         
-        # Converte la data dal formato italiano (dd/mm/yyyy) al formato ISO se necessario
-        data_scadenza_iso = data_scadenza
-        data_scadenza_iso_alt = data_scadenza  # Formato alternativo
-        
-        if '/' in data_scadenza:
-            try:
-                # Converte da "05/09/2025" a "2025-09-05T00:00:00"
-                day, month, year = data_scadenza.split('/')
-                data_scadenza_iso = f"{year}-{month.zfill(2)}-{day.zfill(2)}T00:00:00"
-                data_scadenza_iso_alt = f"{year}-{month.zfill(2)}-{day.zfill(2)}"  # Senza ora
-                print(f"[DEBUG] Data convertita da '{data_scadenza}' a '{data_scadenza_iso}' o '{data_scadenza_iso_alt}'")
-            except ValueError:
-                print(f"[DEBUG] Errore nella conversione della data: {data_scadenza}")
-        
-        # Prima verifichiamo cosa c'è nella tabella per questi parametri
-        c.execute("""
-            SELECT s.civico, s.asset, s.data_scadenza, COUNT(*) as num_scadenze
-            FROM scadenze_calendario s
-            WHERE s.civico = ? AND s.asset = ?
-            GROUP BY s.civico, s.asset, s.data_scadenza
-            ORDER BY s.data_scadenza
-        """, (civico, asset))
-        
-        debug_rows = c.fetchall()
-        print(f"[DEBUG] Scadenze trovate per civico={civico}, asset={asset}:")
-        for row in debug_rows:
-            print(f"  - {row}")
+        # Converte la data (dd/mm/yyyy o ISO) nel formato canonico YYYY-MM-DD
+        try:
+            data_scadenza_iso = data_canonica(data_scadenza)
+        except ValueError:
+            conn.close()
+            return jsonify({'error': f'Formato data non valido: {data_scadenza}'}), 400
         
-        # Ottieni tutte le scadenze del gruppo usando ENTRAMBI i formati di data
-        c.execute("""
+        # Ottieni tutte le scadenze del gruppo (indice idx_scadenze_gruppo) e la versione delle voci
+        c.execute(f"""
             SELECT s.id, s.civico, s.asset, s.asset_tipo, s.data_scadenza, 
-                   s.manutenzione_id, s.checklist_voce_id, s.frequenza_tipo, 
-                   c.nome_voce, c.descrizione
+                   s.manutenzione_id, s.checklist_voce_id, s.frequenza_tipo,
+                   {SQL_VERSIONE_VOCI}
             FROM scadenze_calendario s
-            JOIN manutenzione_programmata_checklist c ON s.checklist_voce_id = c.id
-            WHERE s.civico = ? AND s.asset = ? AND (s.data_scadenza = ? OR s.data_scadenza = ?)
-            ORDER BY c.nome_voce
-        """, (civico, asset, data_scadenza_iso, data_scadenza_iso_alt))
+            WHERE s.civico = ? AND s.asset = ? AND s.data_scadenza = ?
+        """, (civico, asset, data_scadenza_iso))
+        righe = c.fetchall()
         
-        scadenze_rows = c.fetchall()
+        # Nomi e descrizioni delle voci dalla cache dei form compilati
+        form = form_compilato(c, righe[0][3], [r[6] for r in righe], [], righe[0][8]) if righe else {'voci': {}}
+        conn.close()
+        
+        # Solo le scadenze con una voce checklist esistente, ordinate per nome voce
+        scadenze_rows = sorted(
+            (r[:8] + form['voci'][r[6]] for r in righe if r[6] in form['voci']),
+            key=lambda r: r[8]
+        )
         if not scadenze_rows:
             return jsonify({'error': 'Gruppo di scadenze non trovato'}), 404
         
@@ -2061,8 +4203,6 @@ def get_form_gruppo():
             
             scadenze_gruppo.append(scadenza_data)
         
-        conn.close()
-        
         # Dati comuni del gruppo
         primo_elemento = scadenze_gruppo[0]
         
@@ -2085,6 +4225,68 @@ def get_form_gruppo():
         traceback.print_exc()
         return jsonify({'error': f'Errore nel recupero del form gruppo: {str(e)}'}), 500
 
+def esegui_completa_gruppo(c, data):
+    """
+    Completa un gruppo di scadenze usando il cursore del chiamante (senza commit).
+    Restituisce il numero di tipologie di manutenzione processate.
+    Solleva OperazioneNonValida se i dati non sono validi o una voce non può essere aggiornata
+    (voce checklist eliminata, data o frequenza non valide).
+    """
+    scadenze = data.get('scadenze', [])
+    operatore = data.get('operatore', '')
+
+    if not scadenze or not operatore:
+        raise OperazioneNonValida('Parametri mancanti: scadenze e operatore sono obbligatori')
+    if not isinstance(scadenze, list) or not all(isinstance(scad, dict) for scad in scadenze):
+        raise OperazioneNonValida('scadenze deve essere una lista di oggetti')
+
+    # Raggruppa per checklist_voce_id per evitare duplicati
+    scadenze_per_voce = {}
+
+    # Prima raccogli informazioni su tutte le scadenze del gruppo per evitare duplicati
+    for scad_data in scadenze:
+        scadenza_id = scad_data.get('scadenza_id')
+        if not scadenza_id:
+            continue
+        if not str(scadenza_id).isdigit():
+            raise OperazioneNonValida(f'Scadenza {scadenza_id} non trovata')
+            
+        # Ottieni dettagli della scadenza
+        c.execute("""
+            SELECT checklist_voce_id, civico, asset, asset_tipo, data_scadenza, 
+                   frequenza_tipo, giorni_preavviso
+            FROM scadenze_calendario 
+            WHERE id = ?
+        """, (scadenza_id,))
+        
+        row = c.fetchone()
+        if row:
+            checklist_voce_id, civico, asset, asset_tipo, data_scadenza, frequenza_tipo, giorni_preavviso = row
+            
+            # Raggruppa per tipo di voce - solo la prima scadenza di ogni tipo viene processata
+            if checklist_voce_id not in scadenze_per_voce:
+                scadenze_per_voce[checklist_voce_id] = {
+                    'scadenza_id': scadenza_id,
+                    'civico': civico,
+                    'asset': asset,
+                    'asset_tipo': asset_tipo,
+                    'data_scadenza': data_scadenza,
+                    'frequenza_tipo': frequenza_tipo,
+                    'giorni_preavviso': giorni_preavviso,
+                    'esito': scad_data.get('esito', 'eseguito')
+                }
+    
+    # Ora processa tutte le scadenze del gruppo stesso civico/asset/data
+    if scadenze_per_voce:
+        primo_elemento = next(iter(scadenze_per_voce.values()))
+        print(f"[DEBUG] Completamento di tutte le scadenze per {primo_elemento['civico']}/{primo_elemento['asset']} del {primo_elemento['data_scadenza']}")
+        
+    # Processa ogni tipo di voce per aggiornare le date e salvare nello storico
+    for checklist_voce_id, scad_info in scadenze_per_voce.items():
+        crea_nuova_scadenza_ricorrente(scad_info, operatore, c)
+
+    return len(scadenze_per_voce)
+
 @bp.route('/completa-gruppo', methods=['POST'])
 def completa_gruppo():
     """Completa un gruppo di scadenze"""
@@ -2096,7 +4298,6 @@ def completa_gruppo():
         
         scadenze = data.get('scadenze', [])
         operatore = data.get('operatore', '')
-        note_generali = data.get('note', '')
         
         if not scadenze or not operatore:
             return jsonify({'error': 'Parametri mancanti: scadenze e operatore sono obbligatori'}), 400
@@ -2104,74 +4305,38 @@ def completa_gruppo():
         print(f"[DEBUG] Completamento gruppo di {len(scadenze)} scadenze per operatore: {operatore}")
         print(f"[DEBUG] Dati ricevuti: {data}")
         
-        # Raggruppa per checklist_voce_id per evitare duplicati
-        scadenze_per_voce = {}
-        
+        try:
+            chiave = chiave_da_richiesta()
+        except OperazioneNonValida as e:
+            return jsonify({'error': str(e)}), 400
+
         conn = sqlite3.connect(DB_PATH)
         c = conn.cursor()
-        
-        # Prima raccogli informazioni su tutte le scadenze del gruppo per evitare duplicati
-        for scad_data in scadenze:
-            scadenza_id = scad_data.get('scadenza_id')
-            if not scadenza_id:
-                continue
-                
-            # Ottieni dettagli della scadenza
-            c.execute("""
-                SELECT checklist_voce_id, civico, asset, asset_tipo, data_scadenza, 
-                       frequenza_tipo, giorni_preavviso
-                FROM scadenze_calendario 
-                WHERE id = ?
-            """, (scadenza_id,))
-            
-            row = c.fetchone()
-            if row:
-                checklist_voce_id, civico, asset, asset_tipo, data_scadenza, frequenza_tipo, giorni_preavviso = row
-                
-                # Raggruppa per tipo di voce - solo la prima scadenza di ogni tipo viene processata
-                if checklist_voce_id not in scadenze_per_voce:
-                    scadenze_per_voce[checklist_voce_id] = {
-                        'scadenza_id': scadenza_id,
-                        'civico': civico,
-                        'asset': asset,
-                        'asset_tipo': asset_tipo,
-                        'data_scadenza': data_scadenza,
-                        'frequenza_tipo': frequenza_tipo,
-                        'giorni_preavviso': giorni_preavviso,
-                        'esito': scad_data.get('esito', 'eseguito')
-                    }
-        
-        # Ora processa tutte le scadenze del gruppo stesso civico/asset/data
-        if scadenze_per_voce:
-            primo_elemento = next(iter(scadenze_per_voce.values()))
-            civico = primo_elemento['civico']
-            asset = primo_elemento['asset']
-            data_scadenza = primo_elemento['data_scadenza']
-            
-            print(f"[DEBUG] Completamento di tutte le scadenze per {civico}/{asset} del {data_scadenza}")
-            
-        # Processa ogni tipo di voce per aggiornare le date e salvare nello storico
-        for checklist_voce_id, scad_info in scadenze_per_voce.items():
-            # Usa la logica esistente per creare la prossima scadenza
-            single_payload = {
-                'scadenza_id': scad_info['scadenza_id'],  # Questo è solo per il log, la scadenza è già completata
-                'operatore': operatore,
-                'note': note_generali,
-                'checklist': [{'codice': f'scadenza_{scad_info["scadenza_id"]}', 'esito': scad_info['esito'], 'note': ''}]
-            }
-            
-            # Crea direttamente la nuova scadenza ricorrente
-            result = crea_nuova_scadenza_ricorrente(scad_info, operatore, c)
-            if not result.get('success'):
-                return jsonify({'error': f'Errore nella creazione della scadenza ricorrente per voce {checklist_voce_id}: {result.get("error")}'}), 500
+
+        # Reinvio dalla coda offline di un gruppo già completato: stessa risposta, nessuna modifica
+        gia_applicata = apri_operazione(conn, chiave)
+        if gia_applicata:
+            conn.close()
+            stato_http, risposta = gia_applicata
+            return jsonify(risposta), stato_http
+
+        try:
+            voci_processate = esegui_completa_gruppo(c, data)
+        except OperazioneNonValida as e:
+            conn.close()
+            return jsonify({'error': str(e)}), 400
+
+        risposta = {
+            'success': True,
+            'message': f'Gruppo completato con successo - processate {voci_processate} tipologie di manutenzione'
+        }
+        if chiave:
+            registra_operazioni_sincronizzate(c, [(chiave, 'completa-gruppo', 200, risposta, operatore)])
         
         conn.commit()
         conn.close()
         
-        return jsonify({
-            'success': True,
-            'message': f'Gruppo completato con successo - processate {len(scadenze_per_voce)} tipologie di manutenzione'
-        })
+        return jsonify(risposta)
         
     except Exception as e:
         if 'conn' in locals():
@@ -2180,6 +4345,173 @@ def completa_gruppo():
         traceback.print_exc()
         return jsonify({'error': f'Errore nel completamento del gruppo: {str(e)}'}), 500
 
+# Limite di parametri per singola query SQLite (SQLITE_MAX_VARIABLE_NUMBER storico = 999)
+SQLITE_MAX_PARAMS = 900
+
+def carica_scadenze_per_id(cursor, scadenza_ids):
+    """Carica in blocco le scadenze (con nome voce) indicizzate per id"""
+    scadenze = {}
+    ids = list(scadenza_ids)
+    for i in range(0, len(ids), SQLITE_MAX_PARAMS):
+        blocco = ids[i:i + SQLITE_MAX_PARAMS]
+        placeholders = ','.join('?' * len(blocco))
+        cursor.execute(f"""
+            SELECT s.id, s.checklist_voce_id, s.civico, s.asset, s.asset_tipo, s.data_scadenza,
+                   s.frequenza_tipo, s.giorni_preavviso, mpc.nome_voce
+            FROM scadenze_calendario s
+            LEFT JOIN manutenzione_programmata_checklist mpc ON s.checklist_voce_id = mpc.id
+            WHERE s.id IN ({placeholders})
+        """, blocco)
+        for row in cursor.fetchall():
+            scadenze[row[0]] = {
+                'scadenza_id': row[0],
+                'checklist_voce_id': row[1],
+                'civico': row[2],
+                'asset': row[3],
+                'asset_tipo': row[4],
+                'data_scadenza': row[5],
+                'frequenza_tipo': row[6],
+                'giorni_preavviso': row[7],
+                'nome_voce': row[8]
+            }
+    return scadenze
+
+@bp.route('/completa-gruppi', methods=['POST'])
+def completa_gruppi():
+    """
+    Completa più gruppi di scadenze in un'unica transazione.
+    Payload: {'operatore': ..., 'gruppi': [{'scadenze': [{'scadenza_id', 'esito'}], 'operatore'?, 'note'?}]}
+    Ogni gruppo segue la logica di /completa-gruppo; il risultato è restituito per singolo gruppo.
+    """
+    try:
+        data = request.get_json()
+
+        if not data:
+            return jsonify({'error': 'Dati non ricevuti'}), 400
+
+        gruppi = data.get('gruppi', [])
+        operatore_default = data.get('operatore', '')
+
+        if not gruppi or not isinstance(gruppi, list):
+            return jsonify({'error': 'Parametro mancante: gruppi'}), 400
+
+        conn = sqlite3.connect(DB_PATH)
+        c = conn.cursor()
+
+        # 1. Risolve i metadati di tutte le scadenze con una sola query (a blocchi)
+        tutti_ids = set()
+        for gruppo in gruppi:
+            for scad_data in (gruppo or {}).get('scadenze', []):
+                if str(scad_data.get('scadenza_id', '')).isdigit():
+                    tutti_ids.add(int(scad_data['scadenza_id']))
+
+        scadenze_db = carica_scadenze_per_id(c, tutti_ids)
+
+        # 2. Prepara le righe di storico e gli aggiornamenti per ogni gruppo
+        now = datetime.datetime.now().isoformat()
+        righe_storico = []
+        righe_update = []
+        risultati = []
+        ids_processati = set()
+
+        for indice, gruppo in enumerate(gruppi):
+            gruppo = gruppo or {}
+            operatore = gruppo.get('operatore') or operatore_default
+            note = gruppo.get('note', '')
+            scadenze = gruppo.get('scadenze', [])
+
+            if not scadenze or not operatore:
+                risultati.append({'indice': indice, 'ok': False,
+                                  'error': 'Parametri mancanti: scadenze e operatore sono obbligatori'})
+                continue
+
+            # Raggruppa per checklist_voce_id: solo la prima scadenza di ogni voce viene processata
+            scadenze_per_voce = {}
+            errore = None
+            for scad_data in scadenze:
+                scadenza_id = scad_data.get('scadenza_id')
+                if not scadenza_id:
+                    continue
+                if not str(scadenza_id).isdigit():
+                    errore = f'Scadenza {scadenza_id} non trovata'
+                    break
+                scadenza_id = int(scadenza_id)
+                scad_info = scadenze_db.get(scadenza_id)
+                if not scad_info:
+                    errore = f'Scadenza {scadenza_id} non trovata'
+                    break
+                if scadenza_id in ids_processati:
+                    errore = f'Scadenza {scadenza_id} presente in più gruppi'
+                    break
+                if not scad_info['nome_voce']:
+                    errore = f'Voce checklist non trovata per la scadenza {scadenza_id}'
+                    break
+                if scad_info['checklist_voce_id'] not in scadenze_per_voce:
+                    scadenze_per_voce[scad_info['checklist_voce_id']] = (scad_info, scad_data.get('esito', 'eseguito'))
+
+            if errore:
+                risultati.append({'indice': indice, 'ok': False, 'error': errore})
+                continue
+
+            nuove_date = []
+            for scad_info, esito in scadenze_per_voce.values():
+                prossima_data = calcola_prossima_data(
+                    parse_data_scadenza(scad_info['data_scadenza']), scad_info['frequenza_tipo']
+                ).isoformat()
+                righe_storico.append((
+                    scad_info['civico'], scad_info['asset'], scad_info['asset_tipo'],
+                    scad_info['checklist_voce_id'], scad_info['nome_voce'],
+                    scad_info['data_scadenza'], now, operatore, note, esito, now
+                ))
+                righe_update.append((prossima_data, now, scad_info['scadenza_id']))
+                ids_processati.add(scad_info['scadenza_id'])
+                nuove_date.append({'scadenza_id': scad_info['scadenza_id'], 'data_scadenza': prossima_data})
+
+            risultati.append({
+                'indice': indice,
+                'ok': True,
+                'voci_completate': len(scadenze_per_voce),
+                'nuove_scadenze': nuove_date
+            })
+
+        # 3. Scrive tutto in un'unica transazione breve
+        c.executemany("""
+            INSERT INTO scadenze_storico_esecuzioni
+            (civico, asset, asset_tipo, checklist_voce_id, nome_voce,
+             data_scadenza_originale, data_esecuzione, operatore_esecuzione,
+             note_esecuzione, esito, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, righe_storico)
+
+        c.executemany("""
+            UPDATE scadenze_calendario
+            SET data_scadenza = ?,
+                stato = 'programmata',
+                updated_at = ?
+            WHERE id = ?
+        """, righe_update)
+
+        conn.commit()
+        conn.close()
+
+        completati = sum(1 for r in risultati if r['ok'])
+        print(f"[DEBUG] Completamento batch: {completati}/{len(gruppi)} gruppi, {len(righe_update)} voci aggiornate")
+
+        return jsonify({
+            'success': True,
+            'gruppi_completati': completati,
+            'gruppi_con_errori': len(gruppi) - completati,
+            'voci_completate': len(righe_update),
+            'risultati': risultati
+        })
+
+    except Exception as e:
+        if 'conn' in locals():
+            conn.close()
+        print(f"[DEBUG][ERRORE COMPLETA GRUPPI] {str(e)}")
+        traceback.print_exc()
+        return jsonify({'error': f'Errore nel completamento dei gruppi: {str(e)}'}), 500
+
 def completa_scadenza_internal(data):
     """Funzione interna per completare una singola scadenza (riutilizzabile)"""
     try:
@@ -2247,35 +4579,10 @@ def completa_scadenza_internal(data):
             civico, asset, asset_tipo, data_scadenza_str, checklist_voce_id, frequenza_tipo, giorni_preavviso, nome_manutenzione, descrizione = scadenza_completata
             
             # Calcola la prossima data di scadenza
-            try:
-                if 'T' in data_scadenza_str:
-                    data_attuale = datetime.datetime.fromisoformat(data_scadenza_str).date()
-                else:
-                    data_attuale = datetime.datetime.strptime(data_scadenza_str, '%Y-%m-%d').date()
-            except ValueError:
-                data_attuale = datetime.date.today()
-                print(f"[WARNING] Formato data non riconosciuto: {data_scadenza_str}, usando data odierna")
+            data_attuale = parse_data_scadenza(data_scadenza_str)
             
             # Calcola prossima data basata sulla frequenza
-            if frequenza_tipo == "settimanale":
-                prossima_data = data_attuale + datetime.timedelta(weeks=1)
-            elif frequenza_tipo == "bisettimanale":
-                prossima_data = data_attuale + datetime.timedelta(weeks=2)
-            elif frequenza_tipo == "mensile":
-                if data_attuale.month == 12:
-                    prossima_data = data_attuale.replace(year=data_attuale.year + 1, month=1)
-                else:
-                    prossima_data = data_attuale.replace(month=data_attuale.month + 1)
-            elif frequenza_tipo == "annuale":
-                prossima_data = data_attuale.replace(year=data_attuale.year + 1)
-            elif frequenza_tipo == "biennale":
-                prossima_data = data_attuale.replace(year=data_attuale.year + 2)
-            else:
-                # Default mensile
-                if data_attuale.month == 12:
-                    prossima_data = data_attuale.replace(year=data_attuale.year + 1, month=1)
-                else:
-                    prossima_data = data_attuale.replace(month=data_attuale.month + 1)
+            prossima_data = calcola_prossima_data(data_attuale, frequenza_tipo)
             
             # Crea la nuova scadenza ricorrente
             c.execute("""
@@ -2312,114 +4619,85 @@ def completa_scadenza_internal(data):
         return {'success': False, 'error': str(e)}
 
 def crea_nuova_scadenza_ricorrente(scad_info, operatore, cursor):
-    """Aggiorna la data della scadenza esistente e salva l'esecuzione nello storico"""
-    try:
-        civico = scad_info['civico']
-        asset = scad_info['asset'] 
-        asset_tipo = scad_info['asset_tipo']
-        data_scadenza_str = scad_info['data_scadenza']
-        frequenza_tipo = scad_info['frequenza_tipo']
-        giorni_preavviso = scad_info['giorni_preavviso']
-        scadenza_id = scad_info['scadenza_id']
-        esito = scad_info.get('esito', 'eseguito')
-        
-        # Ottieni l'ID e il nome della voce checklist
-        cursor.execute("""
-            SELECT checklist_voce_id FROM scadenze_calendario 
-            WHERE id = ? LIMIT 1
-        """, (scadenza_id,))
-        
-        row = cursor.fetchone()
-        if not row:
-            return {'success': False, 'error': 'Scadenza non trovata'}
-            
-        checklist_voce_id = row[0]
-        
-        # Ottieni il nome della voce per lo storico
-        cursor.execute("""
-            SELECT nome_voce FROM manutenzione_programmata_checklist 
-            WHERE id = ? LIMIT 1
-        """, (checklist_voce_id,))
-        
-        voce_row = cursor.fetchone()
-        if not voce_row:
-            return {'success': False, 'error': 'Voce checklist non trovata'}
-            
-        nome_voce = voce_row[0]
-        
-        # Calcola la prossima data di scadenza
-        try:
-            if 'T' in data_scadenza_str:
-                data_attuale = datetime.datetime.fromisoformat(data_scadenza_str).date()
-            else:
-                data_attuale = datetime.datetime.strptime(data_scadenza_str, '%Y-%m-%d').date()
-        except ValueError:
-            data_attuale = datetime.date.today()
-            print(f"[WARNING] Formato data non riconosciuto: {data_scadenza_str}, usando data odierna")
-        
-        # Calcola prossima data basata sulla frequenza
-        if frequenza_tipo == "settimanale":
-            prossima_data = data_attuale + datetime.timedelta(weeks=1)
-        elif frequenza_tipo == "bisettimanale":
-            prossima_data = data_attuale + datetime.timedelta(weeks=2)
-        elif frequenza_tipo == "mensile":
-            if data_attuale.month == 12:
-                prossima_data = data_attuale.replace(year=data_attuale.year + 1, month=1)
-            else:
-                prossima_data = data_attuale.replace(month=data_attuale.month + 1)
-        elif frequenza_tipo == "annuale":
-            prossima_data = data_attuale.replace(year=data_attuale.year + 1)
-        elif frequenza_tipo == "biennale":
-            prossima_data = data_attuale.replace(year=data_attuale.year + 2)
-        else:
-            # Default mensile
-            if data_attuale.month == 12:
-                prossima_data = data_attuale.replace(year=data_attuale.year + 1, month=1)
-            else:
-                prossima_data = data_attuale.replace(month=data_attuale.month + 1)
-        
-        # 1. SALVA L'ESECUZIONE NELLO STORICO
-        cursor.execute("""
-            INSERT INTO scadenze_storico_esecuzioni 
-            (civico, asset, asset_tipo, checklist_voce_id, nome_voce, 
-             data_scadenza_originale, data_esecuzione, operatore_esecuzione, 
-             note_esecuzione, esito, created_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
-            civico,
-            asset,
-            asset_tipo,
-            checklist_voce_id,
-            nome_voce,
-            data_scadenza_str,
-            datetime.datetime.now().isoformat(),
-            operatore,
-            '',  # Note esecuzione (potremmo passarle come parametro)
-            esito,
-            datetime.datetime.now().isoformat()
-        ))
-        
-        # 2. AGGIORNA LA DATA DELLA SCADENZA ESISTENTE (non creare nuova)
-        cursor.execute("""
-            UPDATE scadenze_calendario 
-            SET data_scadenza = ?,
-                stato = 'programmata',
-                updated_at = ?
-            WHERE id = ?
-        """, (
-            prossima_data.isoformat(),
-            datetime.datetime.now().isoformat(),
-            scadenza_id
-        ))
-        
-        print(f"[DEBUG] Scadenza {scadenza_id} aggiornata: {data_attuale} -> {prossima_data} - voce: {nome_voce}")
-        print(f"[DEBUG] Esecuzione salvata nello storico per {asset} - operatore: {operatore}")
+    """
+    Aggiorna la data della scadenza esistente e salva l'esecuzione nello storico.
+    Solleva OperazioneNonValida se scadenza o voce non esistono più o data/frequenza non sono
+    valide; gli errori del database arrivano al chiamante, che annulla la transazione.
+    """
+    civico = scad_info['civico']
+    asset = scad_info['asset'] 
+    asset_tipo = scad_info['asset_tipo']
+    data_scadenza_str = scad_info['data_scadenza']
+    frequenza_tipo = scad_info['frequenza_tipo']
+    giorni_preavviso = scad_info['giorni_preavviso']
+    scadenza_id = scad_info['scadenza_id']
+    esito = scad_info.get('esito', 'eseguito')
+    
+    # Ottieni l'ID e il nome della voce checklist
+    cursor.execute("""
+        SELECT checklist_voce_id FROM scadenze_calendario 
+        WHERE id = ? LIMIT 1
+    """, (scadenza_id,))
+    
+    row = cursor.fetchone()
+    if not row:
+        raise OperazioneNonValida(f'Scadenza {scadenza_id} non trovata')
         
-        return {'success': True}
+    checklist_voce_id = row[0]
+    
+    # Ottieni il nome della voce per lo storico
+    cursor.execute("""
+        SELECT nome_voce FROM manutenzione_programmata_checklist 
+        WHERE id = ? LIMIT 1
+    """, (checklist_voce_id,))
+    
+    voce_row = cursor.fetchone()
+    if not voce_row:
+        raise OperazioneNonValida(f'Voce checklist {checklist_voce_id} non trovata')
         
-    except Exception as e:
-        print(f"[DEBUG] Errore aggiornamento scadenza ricorrente: {e}")
-        return {'success': False, 'error': str(e)}
+    nome_voce = voce_row[0]
+
+    # Calcola la prossima data di scadenza
+    prossima_data = prossima_data_ricorrenza(data_scadenza_str, frequenza_tipo)
+
+    # 1. SALVA L'ESECUZIONE NELLO STORICO
+    cursor.execute("""
+        INSERT INTO scadenze_storico_esecuzioni 
+        (civico, asset, asset_tipo, checklist_voce_id, nome_voce, 
+         data_scadenza_originale, data_esecuzione, operatore_esecuzione, 
+         note_esecuzione, esito, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, (
+        civico,
+        asset,
+        asset_tipo,
+        checklist_voce_id,
+        nome_voce,
+        data_scadenza_str,
+        datetime.datetime.now().isoformat(),
+        operatore,
+        '',  # Note esecuzione (potremmo passarle come parametro)
+        esito,
+        datetime.datetime.now().isoformat()
+    ))
+    
+    # 2. AGGIORNA LA DATA DELLA SCADENZA ESISTENTE (non creare nuova)
+    cursor.execute("""
+        UPDATE scadenze_calendario 
+        SET data_scadenza = ?,
+            stato = 'programmata',
+            updated_at = ?
+        WHERE id = ?
+    """, (
+        prossima_data.isoformat(),
+        datetime.datetime.now().isoformat(),
+        scadenza_id
+    ))
+    
+    print(f"[DEBUG] Scadenza {scadenza_id} aggiornata: {data_scadenza_str} -> {prossima_data} - voce: {nome_voce}")
+    print(f"[DEBUG] Esecuzione salvata nello storico per {asset} - operatore: {operatore}")
+    
+    return {'success': True}
 
 # --- INIZIALIZZAZIONE ---
 if __name__ == '__main__':
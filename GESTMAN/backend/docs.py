@@ -20,11 +20,19 @@ from reportlab.lib.utils import ImageReader
 # Temporaneamente disabilitato per problemi ambiente virtuale 
 # import pandas as pd
 
+# Import per l'aggiornamento dei messaggi Telegram al cambio di stato degli alert
+try:
+    from telegram_manager import aggiorna_stato_alert_telegram
+except ImportError:
+    aggiorna_stato_alert_telegram = None
+
 bp = Blueprint('docs', __name__)
 
 # Percorsi database
 GESTMAN_DB = os.path.join(os.path.dirname(__file__), 'gestman.db')
 COMPILAZIONI_DB = os.path.join(os.path.dirname(__file__), 'compilazioni.db')
+# Partizioni annuali dello storico esecuzioni archiviate (vedi calendario.archivia_storico)
+ARCHIVIO_DB = os.path.join(os.path.dirname(__file__), 'compilazioni_archivio.db')
 
 def get_gestman_connection():
     """Connessione al database gestman.db"""
@@ -38,6 +46,22 @@ def get_compilazioni_connection():
     conn.row_factory = sqlite3.Row
     return conn
 
+def partizioni_archivio_storico(c, date_from=None, date_to=None, includi_tutto=False):
+    """
+    Tabelle d'archivio dello storico esecuzioni da leggere per l'intervallo di date richiesto:
+    basta uno dei due estremi (un solo dateTo negli anni archiviati legge le partizioni fino a quell'anno)
+    """
+    if not includi_tutto and not date_from and not date_to:
+        return []
+    try:
+        c.execute("SELECT anno, tabella FROM storico_archivio ORDER BY anno")
+    except sqlite3.OperationalError:
+        # Archivio mai inizializzato
+        return []
+    anno_da = (date_from or '0000')[:4]
+    anno_a = (date_to or '9999')[:4]
+    return [row[1] for row in c.fetchall() if includi_tutto or anno_da <= row[0] <= anno_a]
+
 def get_filter_options(section):
     """Genera opzioni di filtro per una sezione specifica"""
     try:
@@ -47,11 +71,14 @@ def get_filter_options(section):
             
             filters = {}
             
+            # I valori dello storico esecuzioni vengono dai rollup mensili (comprendono anche l'archivio)
+            # invece di una scansione completa di scadenze_storico_esecuzioni
+
             # Template (da form_templates + nome_voce da storico)
             c.execute("SELECT DISTINCT t.nome FROM form_templates t JOIN form_submissions s ON t.id = s.template_id ORDER BY t.nome")
             templates = [row[0] for row in c.fetchall()]
             
-            c.execute("SELECT DISTINCT nome_voce FROM scadenze_storico_esecuzioni WHERE nome_voce IS NOT NULL ORDER BY nome_voce")
+            c.execute("SELECT DISTINCT nome_voce FROM storico_rollup_mensile ORDER BY nome_voce")
             templates.extend([row[0] for row in c.fetchall()])
             filters['template_nome'] = sorted(list(set(templates)))
             
@@ -59,7 +86,7 @@ def get_filter_options(section):
             c.execute("SELECT DISTINCT operatore FROM form_submissions WHERE operatore IS NOT NULL ORDER BY operatore")
             operatori = [row[0] for row in c.fetchall()]
             
-            c.execute("SELECT DISTINCT operatore_esecuzione FROM scadenze_storico_esecuzioni WHERE operatore_esecuzione IS NOT NULL ORDER BY operatore_esecuzione")
+            c.execute("SELECT DISTINCT operatore FROM storico_rollup_mensile ORDER BY operatore")
             operatori.extend([row[0] for row in c.fetchall()])
             filters['operatore'] = sorted(list(set(operatori)))
             
@@ -67,7 +94,7 @@ def get_filter_options(section):
             c.execute("SELECT DISTINCT civico_numero FROM form_submissions WHERE civico_numero IS NOT NULL ORDER BY civico_numero")
             civici = [row[0] for row in c.fetchall()]
             
-            c.execute("SELECT DISTINCT civico FROM scadenze_storico_esecuzioni WHERE civico IS NOT NULL ORDER BY civico")
+            c.execute("SELECT DISTINCT civico FROM storico_rollup_mensile ORDER BY civico")
             civici.extend([row[0] for row in c.fetchall()])
             filters['civico_numero'] = sorted(list(set(civici)))
             
@@ -75,12 +102,12 @@ def get_filter_options(section):
             c.execute("SELECT DISTINCT asset_id FROM form_submissions WHERE asset_id IS NOT NULL ORDER BY asset_id")
             assets = [row[0] for row in c.fetchall()]
             
-            c.execute("SELECT DISTINCT asset FROM scadenze_storico_esecuzioni WHERE asset IS NOT NULL ORDER BY asset")
+            c.execute("SELECT DISTINCT asset FROM storico_rollup_mensile ORDER BY asset")
             assets.extend([row[0] for row in c.fetchall()])
             filters['asset'] = sorted(list(set(assets)))
             
             # Esito (solo da storico esecuzioni)
-            c.execute("SELECT DISTINCT esito FROM scadenze_storico_esecuzioni WHERE esito IS NOT NULL ORDER BY esito")
+            c.execute("SELECT DISTINCT esito FROM storico_rollup_mensile ORDER BY esito")
             filters['esito'] = [row[0] for row in c.fetchall()]
             
             conn.close()
@@ -346,18 +373,19 @@ def get_compilazioni_docs():
                        se.esito,
                        se.nome_voce,
                        'scadenza_esecuzione' as record_type
-                FROM scadenze_storico_esecuzioni se
+                FROM {tabella} se
             '''
             params_esecuzioni = []
             
             # Applica filtri per storico esecuzioni
             where_conditions = []
             if filters.get('dateFrom'):
-                where_conditions.append("date(se.data_esecuzione) >= ?")
+                # Confronto diretto sulla stringa ISO per poter usare l'indice su data_esecuzione
+                where_conditions.append("se.data_esecuzione >= ?")
                 params_esecuzioni.append(filters['dateFrom'])
             
             if filters.get('dateTo'):
-                where_conditions.append("date(se.data_esecuzione) <= ?")
+                where_conditions.append("se.data_esecuzione < date(?, '+1 day')")
                 params_esecuzioni.append(filters['dateTo'])
             
             if filters.get('civico'):
@@ -385,11 +413,24 @@ def get_compilazioni_docs():
             if where_conditions:
                 query_esecuzioni += " WHERE " + " AND ".join(where_conditions)
             
-            query_esecuzioni += " ORDER BY se.data_esecuzione DESC"
+            # Di default solo la partizione calda; le partizioni annuali d'archivio vengono lette
+            # se richiesto esplicitamente o se il filtro date ricade negli anni archiviati
+            tabelle = ['main.scadenze_storico_esecuzioni']
+            partizioni = partizioni_archivio_storico(c, filters.get('dateFrom'), filters.get('dateTo'),
+                                                     request.args.get('includi_archivio') in ('1', 'true'))
+            if partizioni:
+                c.execute("ATTACH DATABASE ? AS archivio", (ARCHIVIO_DB,))
+                tabelle.extend(f"archivio.{tabella}" for tabella in partizioni)
+            
+            query_esecuzioni = " UNION ALL ".join(query_esecuzioni.format(tabella=t) for t in tabelle)
+            query_esecuzioni += " ORDER BY data_evento DESC"
             
-            c.execute(query_esecuzioni, params_esecuzioni)
+            c.execute(query_esecuzioni, params_esecuzioni * len(tabelle))
             esecuzioni_results = [dict(row) for row in c.fetchall()]
             all_results.extend(esecuzioni_results)
+            
+            if partizioni:
+                c.execute("DETACH DATABASE archivio")
         
         # Ordina tutti i risultati per data (più recenti prima)
         all_results.sort(key=lambda x: x.get('data_evento') or x.get('created_at'), reverse=True)
@@ -461,6 +502,58 @@ def get_compilazioni_docs():
         print(f"[ERROR] get_compilazioni_docs: {e}")
         return jsonify({'error': str(e)}), 500
 
+@bp.route('/compilazioni/riepilogo', methods=['GET'])
+def get_riepilogo_esecuzioni():
+    """Conteggi delle esecuzioni dai rollup mensili (storico completo, archivio compreso)"""
+    try:
+        raggruppamenti = {
+            'mese': 'mese',
+            'voce': 'nome_voce',
+            'asset': 'asset',
+            'operatore': 'operatore',
+            'civico': 'civico',
+            'esito': 'esito'
+        }
+        raggruppa = [r.strip() for r in request.args.get('raggruppa', 'mese').split(',') if r.strip()]
+        for r in raggruppa:
+            if r not in raggruppamenti:
+                return jsonify({'error': f'Raggruppamento non valido: {r}'}), 400
+        colonne = [raggruppamenti[r] for r in raggruppa]
+        
+        where_conditions = []
+        params = []
+        # I rollup sono mensili: i filtri data lavorano sul mese (YYYY-MM)
+        if request.args.get('dateFrom'):
+            where_conditions.append("mese >= ?")
+            params.append(request.args.get('dateFrom')[:7])
+        if request.args.get('dateTo'):
+            where_conditions.append("mese <= ?")
+            params.append(request.args.get('dateTo')[:7])
+        for campo in ('civico', 'asset', 'operatore', 'esito'):
+            if request.args.get(campo):
+                where_conditions.append(f"{campo} = ?")
+                params.append(request.args.get(campo))
+        
+        query = f"SELECT {', '.join(colonne)}, SUM(esecuzioni) as esecuzioni FROM storico_rollup_mensile"
+        if where_conditions:
+            query += " WHERE " + " AND ".join(where_conditions)
+        query += f" GROUP BY {', '.join(colonne)} ORDER BY {', '.join(colonne)}"
+        
+        conn = get_compilazioni_connection()
+        c = conn.cursor()
+        c.execute(query, params)
+        data = [dict(row) for row in c.fetchall()]
+        conn.close()
+        
+        return jsonify({
+            'data': data,
+            'total': sum(row['esecuzioni'] for row in data)
+        }), 200
+        
+    except Exception as e:
+        print(f"[ERROR] get_riepilogo_esecuzioni: {e}")
+        return jsonify({'error': str(e)}), 500
+
 @bp.route('/scadenze', methods=['GET'])
 def get_scadenze_docs():
     """Ottieni documentazione scadenze e manutenzioni"""
@@ -960,6 +1053,9 @@ def update_alert(record_id, data):
     if c.rowcount == 0:
         conn.close()
         return jsonify({'error': 'Record non trovato'}), 404
+
+    if 'stato' in data and aggiorna_stato_alert_telegram:
+        aggiorna_stato_alert_telegram(record_id, data['stato'], data.get('operatore'), cursor=c)
     
     conn.commit()
     conn.close()
@@ -979,14 +1075,27 @@ def update_scadenza(record_id, data):
     
     for field in updateable_fields:
         if field in data:
+            valore = data[field]
+            # Le date del calendario sono salvate sempre come YYYY-MM-DD
+            if field == 'data_scadenza' and valore:
+                valore = str(valore).strip()
+                try:
+                    if '/' in valore:
+                        valore = datetime.strptime(valore, '%d/%m/%Y').strftime('%Y-%m-%d')
+                    else:
+                        valore = datetime.strptime(valore[:10], '%Y-%m-%d').strftime('%Y-%m-%d')
+                except ValueError:
+                    conn.close()
+                    return jsonify({'error': f'Formato data non valido: {data[field]}'}), 400
             set_clauses.append(f"{field} = ?")
-            params.append(data[field])
-    
+            params.append(valore)
+
     if not set_clauses:
+        conn.close()
         return jsonify({'error': 'Nessun campo da aggiornare'}), 400
-    
+
     params.append(record_id)
-    
+
     query = f"UPDATE scadenze_calendario SET {', '.join(set_clauses)} WHERE id = ?"
     c.execute(query, params)
     
@@ -13,6 +13,7 @@ import mimetypes
 import shutil
 from datetime import datetime
 from werkzeug.utils import secure_filename
+from idempotenza import OperazioneNonValida, chiave_da_richiesta, apri_operazione, registra_operazioni_sincronizzate
 
 bp = Blueprint('dynamic_forms', __name__)
 DB_PATH = os.path.join(os.path.dirname(__file__), 'compilazioni.db')
@@ -455,6 +456,49 @@ def delete_field(field_id):
 
 # === FORM SUBMISSIONS ENDPOINTS ===
 
+SUBMISSION_CAMPI_OBBLIGATORI = ['template_id', 'civico_numero', 'asset_id', 'operatore', 'data_intervento', 'form_data']
+
+def salva_submission(cursor, data):
+    """
+    Salva una compilazione form con il cursore del chiamante (senza commit).
+    Restituisce (submission_id, alert_issues); gli alert vanno inviati dopo il commit.
+    Solleva OperazioneNonValida se mancano campi obbligatori.
+    """
+    for field in SUBMISSION_CAMPI_OBBLIGATORI:
+        if field not in data:
+            raise OperazioneNonValida(f'Campo {field} richiesto')
+
+    now = datetime.now().isoformat()
+    
+    # Salva la submission
+    cursor.execute('''
+        INSERT INTO form_submissions 
+        (template_id, civico_numero, asset_id, operatore, data_intervento, form_data, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', (
+        data['template_id'],
+        data['civico_numero'],
+        data['asset_id'],
+        data['operatore'],
+        data['data_intervento'],
+        json.dumps(data['form_data']),
+        now
+    ))
+    
+    submission_id = cursor.lastrowid
+    
+    # Controlla campi select per alert di non conformità
+    print(f"[DEBUG] Checking alerts for template_id: {data['template_id']}")
+    print(f"[DEBUG] Form data: {data['form_data']}")
+    print(f"[DEBUG] Submission data completa: {data}")  # Debug completo
+    
+    alert_issues = check_select_fields_for_alerts(
+        cursor, data['template_id'], data['form_data'], data
+    )
+    
+    print(f"[DEBUG] Alert issues found: {alert_issues}")
+    return submission_id, alert_issues
+
 @bp.route('/submissions', methods=['POST'])
 def submit_form():
     """Salva una compilazione form e controlla alert per non conformità"""
@@ -463,43 +507,33 @@ def submit_form():
         if not data:
             return jsonify({'error': 'Dati richiesti'}), 400
         
-        required_fields = ['template_id', 'civico_numero', 'asset_id', 'operatore', 'data_intervento', 'form_data']
-        for field in required_fields:
+        for field in SUBMISSION_CAMPI_OBBLIGATORI:
             if field not in data:
                 return jsonify({'error': f'Campo {field} richiesto'}), 400
+
+        try:
+            chiave = chiave_da_richiesta()
+        except OperazioneNonValida as e:
+            return jsonify({'error': str(e)}), 400
         
         conn = get_db_connection()
         c = conn.cursor()
+
+        # Reinvio dalla coda offline di una compilazione già salvata: stessa risposta, nessun duplicato
+        gia_applicata = apri_operazione(conn, chiave)
+        if gia_applicata:
+            conn.close()
+            stato_http, risposta = gia_applicata
+            return jsonify(risposta), stato_http
         
-        now = datetime.now().isoformat()
-        
-        # Salva la submission
-        c.execute('''
-            INSERT INTO form_submissions 
-            (template_id, civico_numero, asset_id, operatore, data_intervento, form_data, created_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            data['template_id'],
-            data['civico_numero'],
-            data['asset_id'],
-            data['operatore'],
-            data['data_intervento'],
-            json.dumps(data['form_data']),
-            now
-        ))
-        
-        submission_id = c.lastrowid
-        
-        # Controlla campi select per alert di non conformità
-        print(f"[DEBUG] Checking alerts for template_id: {data['template_id']}")
-        print(f"[DEBUG] Form data: {data['form_data']}")
-        print(f"[DEBUG] Submission data completa: {data}")  # Debug completo
-        
-        alert_issues = check_select_fields_for_alerts(
-            c, data['template_id'], data['form_data'], data
-        )
-        
-        print(f"[DEBUG] Alert issues found: {alert_issues}")
+        submission_id, alert_issues = salva_submission(c, data)
+        risposta = {
+            'message': 'Form compilato con successo',
+            'submission_id': submission_id,
+            'alerts_generated': len(alert_issues) if alert_issues else 0
+        }
+        if chiave:
+            registra_operazioni_sincronizzate(c, [(chiave, 'form-submission', 201, risposta, data.get('operatore'))])
         
         conn.commit()
         conn.close()
@@ -512,11 +546,7 @@ def submit_form():
         else:
             print("[DEBUG] No alert issues found")
         
-        return jsonify({
-            'message': 'Form compilato con successo',
-            'submission_id': submission_id,
-            'alerts_generated': len(alert_issues) if alert_issues else 0
-        }), 201
+        return jsonify(risposta), 201
         
     except Exception as e:
         print(f"[ERROR] submit_form: {e}")
@@ -675,12 +705,10 @@ def send_non_conformity_alerts(alert_issues, submission_data):
         ))
         
         alert_id = c.lastrowid
-        conn.commit()
-        conn.close()
         
         print(f"[DEBUG] Alert creato con ID: {alert_id} in compilazioni.db")
         
-        # Ora invia il messaggio Telegram automaticamente
+        # Accoda il messaggio Telegram nella stessa transazione dell'alert
         try:
             import telegram_manager
             
@@ -742,14 +770,16 @@ def send_non_conformity_alerts(alert_issues, submission_data):
             }
             
             print(f"[DEBUG] Alert data per Telegram: {alert_data}")
-            print(f"[DEBUG] Inviando messaggio Telegram per alert ID: {alert_id}")
-            telegram_sent = telegram_manager.send_alert_to_telegram(alert_data)
-            print(f"[DEBUG] Messaggio Telegram inviato: {telegram_sent}")
+            telegram_accodato = telegram_manager.send_alert_to_telegram(alert_data, cursor=c, alert_id=alert_id)
+            print(f"[DEBUG] Messaggio Telegram accodato: {telegram_accodato}")
             
         except Exception as telegram_error:
-            print(f"[ERROR] Errore invio Telegram: {telegram_error}")
+            print(f"[ERROR] Errore accodamento Telegram: {telegram_error}")
             # Non fallire se il Telegram non funziona, l'alert è comunque creato
         
+        conn.commit()
+        conn.close()
+        
         return True
         
     except Exception as e:
@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+Finto server Bot API di Telegram per prove e benchmark senza api.telegram.org.
+
+Implementa getMe, sendMessage, editMessageText e getUpdates (long polling) con latenza,
+errori e risposte 429 (con retry_after) configurabili. Il backend lo usa impostando l'URL
+base del bot:
+
+    python fake_telegram_api.py --porta 8081 --latenza-ms 80 --prob-429 0.02
+    GESTMAN_TELEGRAM_API_URL=http://127.0.0.1:8081 python server.py
+
+Statistiche delle chiamate ricevute: GET /statistiche (azzerate con POST /reset).
+Messaggi in arrivo per getUpdates: POST /aggiornamenti {"chat_id": ..., "text": "/oggi"}.
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+TELEGRAM_MAX_CARATTERI = 4096
+
+
+class StatoFakeTelegram:
+    """Opzioni di simulazione, messaggi inviati e contatori condivisi tra i thread del server"""
+
+    def __init__(self, token=None, latenza_ms=0, jitter_ms=0, prob_errore=0.0, prob_429=0.0,
+                 retry_after=1, limiti=False, chat_bloccate=()):
+        self.token = token
+        self.latenza_ms = latenza_ms
+        self.jitter_ms = jitter_ms
+        self.prob_errore = prob_errore
+        self.prob_429 = prob_429
+        self.retry_after = retry_after
+        self.limiti = limiti
+        self.chat_bloccate = set(str(chat) for chat in chat_bloccate)
+        self.lock = threading.Lock()
+        self.arrivo = threading.Condition(self.lock)
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.prossimo_message_id = 1
+            self.messaggi = {}          # (chat_id, message_id) -> testo
+            self.ultimo_invio_chat = {}  # chat_id -> epoch, per --limiti
+            self.invii_recenti = []      # epoch degli ultimi invii, per --limiti
+            self.contatori = {}
+            self.aggiornamenti = []      # update in attesa di getUpdates
+            self.prossimo_update_id = 1
+
+    def conta(self, chiave):
+        with self.lock:
+            self.contatori[chiave] = self.contatori.get(chiave, 0) + 1
+
+    def statistiche(self):
+        with self.lock:
+            return {'contatori': dict(self.contatori), 'messaggi': len(self.messaggi)}
+
+    def viola_limiti(self, chat_id):
+        """Limiti reali di Telegram (30 msg/s globali, 1 msg/s per chat): secondi da attendere o 0"""
+        adesso = time.time()
+        with self.lock:
+            self.invii_recenti = [t for t in self.invii_recenti if adesso - t < 1.0]
+            if len(self.invii_recenti) >= 30:
+                return 1
+            ultimo = self.ultimo_invio_chat.get(chat_id)
+            # Piccola tolleranza come l'API reale, che ammette brevi raffiche
+            if ultimo is not None and adesso - ultimo < 0.9:
+                return 1
+            self.invii_recenti.append(adesso)
+            self.ultimo_invio_chat[chat_id] = adesso
+            return 0
+
+    def nuovo_aggiornamento(self, chat_id, testo):
+        """Simula un messaggio scritto al bot da chat_id"""
+        with self.arrivo:
+            update_id = self.prossimo_update_id
+            self.prossimo_update_id += 1
+            self.aggiornamenti.append({'update_id': update_id, 'message': {
+                'message_id': update_id, 'date': int(time.time()),
+                'chat': {'id': int(chat_id) if str(chat_id).lstrip('-').isdigit() else chat_id, 'type': 'private'},
+                'text': testo
+            }})
+            self.arrivo.notify_all()
+            return update_id
+
+    def leggi_aggiornamenti(self, offset, timeout):
+        """Come getUpdates: scarta gli update sotto offset e aspetta fino a timeout se non ce ne sono"""
+        scadenza = time.time() + timeout
+        with self.arrivo:
+            while True:
+                self.aggiornamenti = [a for a in self.aggiornamenti if a['update_id'] >= offset]
+                attesa = scadenza - time.time()
+                if self.aggiornamenti or attesa <= 0:
+                    return list(self.aggiornamenti)
+                self.arrivo.wait(attesa)
+
+    def nuovo_messaggio(self, chat_id, testo):
+        with self.lock:
+            message_id = self.prossimo_message_id
+            self.prossimo_message_id += 1
+            self.messaggi[(chat_id, message_id)] = testo
+            return message_id
+
+
+def crea_handler(stato):
+    class FakeTelegramHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'  # keep-alive come l'API reale
+
+        def log_message(self, formato, *args):
+            pass
+
+        def rispondi(self, codice, corpo):
+            dati = json.dumps(corpo).encode('utf-8')
+            self.send_response(codice)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(dati)))
+            self.end_headers()
+            self.wfile.write(dati)
+
+        def errore(self, codice, descrizione, parametri=None):
+            stato.conta(f"http_{codice}")
+            corpo = {'ok': False, 'error_code': codice, 'description': descrizione}
+            if parametri:
+                corpo['parameters'] = parametri
+            self.rispondi(codice, corpo)
+
+        def leggi_parametri(self):
+            url = urlparse(self.path)
+            parametri = {chiave: valori[-1] for chiave, valori in parse_qs(url.query).items()}
+            lunghezza = int(self.headers.get('Content-Length') or 0)
+            if lunghezza:
+                corpo = self.rfile.read(lunghezza).decode('utf-8')
+                if 'json' in (self.headers.get('Content-Type') or ''):
+                    parametri.update(json.loads(corpo or '{}'))
+                else:
+                    parametri.update({chiave: valori[-1] for chiave, valori in parse_qs(corpo).items()})
+            return url.path, parametri
+
+        def do_GET(self):
+            self.gestisci()
+
+        def do_POST(self):
+            self.gestisci()
+
+        def gestisci(self):
+            try:
+                percorso, parametri = self.leggi_parametri()
+            except ValueError:
+                return self.errore(400, 'Bad Request: invalid JSON')
+
+            if percorso == '/statistiche':
+                return self.rispondi(200, stato.statistiche())
+            if percorso == '/reset':
+                stato.reset()
+                return self.rispondi(200, {'ok': True})
+            if percorso == '/aggiornamenti':
+                update_id = stato.nuovo_aggiornamento(parametri.get('chat_id'), parametri.get('text') or '')
+                return self.rispondi(200, {'ok': True, 'update_id': update_id})
+
+            # /bot<token>/<metodo>
+            parti = percorso.strip('/').split('/')
+            if len(parti) != 2 or not parti[0].startswith('bot'):
+                return self.errore(404, 'Not Found')
+            token, metodo = parti[0][3:], parti[1]
+            stato.conta(metodo)
+
+            latenza = stato.latenza_ms + random.uniform(0, stato.jitter_ms)
+            if latenza:
+                time.sleep(latenza / 1000.0)
+
+            if not token or (stato.token and token != stato.token):
+                return self.errore(401, 'Unauthorized')
+            if stato.prob_errore and random.random() < stato.prob_errore:
+                return self.errore(502, 'Bad Gateway')
+
+            if metodo == 'getMe':
+                return self.rispondi(200, {'ok': True, 'result': {
+                    'id': 1, 'is_bot': True, 'first_name': 'GESTMAN Fake', 'username': 'gestman_fake_bot'
+                }})
+            if metodo == 'sendMessage':
+                return self.send_message(parametri)
+            if metodo == 'editMessageText':
+                return self.edit_message_text(parametri)
+            if metodo == 'getUpdates':
+                try:
+                    offset = int(parametri.get('offset') or 0)
+                    timeout = min(float(parametri.get('timeout') or 0), 50)
+                except (TypeError, ValueError):
+                    return self.errore(400, 'Bad Request: invalid offset or timeout')
+                return self.rispondi(200, {'ok': True, 'result': stato.leggi_aggiornamenti(offset, timeout)})
+            return self.errore(404, 'Not Found: method not found')
+
+        def controlla_chat(self, parametri):
+            chat_id = str(parametri.get('chat_id') or '')
+            if not chat_id:
+                self.errore(400, 'Bad Request: chat_id is empty')
+                return None
+            if chat_id in stato.chat_bloccate:
+                self.errore(403, 'Forbidden: bot was blocked by the user')
+                return None
+            testo = parametri.get('text') or ''
+            if not testo.strip():
+                self.errore(400, 'Bad Request: message text is empty')
+                return None
+            if len(testo) > TELEGRAM_MAX_CARATTERI:
+                self.errore(400, 'Bad Request: message is too long')
+                return None
+            return chat_id
+
+        def limite_429(self, chat_id):
+            attesa = stato.viola_limiti(chat_id) if stato.limiti else 0
+            if not attesa and stato.prob_429 and random.random() < stato.prob_429:
+                attesa = stato.retry_after
+            if attesa:
+                self.errore(429, f'Too Many Requests: retry after {attesa}', {'retry_after': attesa})
+                return True
+            return False
+
+        def send_message(self, parametri):
+            chat_id = self.controlla_chat(parametri)
+            if chat_id is None or self.limite_429(chat_id):
+                return
+            message_id = stato.nuovo_messaggio(chat_id, parametri['text'])
+            stato.conta('inviati')
+            self.rispondi(200, {'ok': True, 'result': {
+                'message_id': message_id, 'date': int(time.time()),
+                'chat': {'id': int(chat_id) if chat_id.lstrip('-').isdigit() else chat_id},
+                'text': parametri['text']
+            }})
+
+        def edit_message_text(self, parametri):
+            chat_id = self.controlla_chat(parametri)
+            if chat_id is None or self.limite_429(chat_id):
+                return
+            try:
+                message_id = int(parametri.get('message_id'))
+            except (TypeError, ValueError):
+                return self.errore(400, 'Bad Request: message identifier is not specified')
+            with stato.lock:
+                attuale = stato.messaggi.get((chat_id, message_id))
+                if attuale is not None and attuale != parametri['text']:
+                    stato.messaggi[(chat_id, message_id)] = parametri['text']
+            if attuale is None:
+                return self.errore(400, 'Bad Request: message to edit not found')
+            if attuale == parametri['text']:
+                return self.errore(400, 'Bad Request: message is not modified')
+            stato.conta('modificati')
+            self.rispondi(200, {'ok': True, 'result': {
+                'message_id': message_id, 'date': int(time.time()),
+                'chat': {'id': int(chat_id) if chat_id.lstrip('-').isdigit() else chat_id},
+                'text': parametri['text']
+            }})
+
+    return FakeTelegramHandler
+
+
+def avvia_server(porta=0, host='127.0.0.1', **opzioni):
+    """
+    Avvia il server in un thread e restituisce (server, stato); l'URL base è
+    f"http://{host}:{server.server_address[1]}". Con porta=0 sceglie una porta libera.
+    """
+    stato = StatoFakeTelegram(**opzioni)
+    server = ThreadingHTTPServer((host, porta), crea_handler(stato))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='fake-telegram', daemon=True).start()
+    return server, stato
+
+
+def aggiungi_opzioni(parser):
+    """Opzioni di simulazione, condivise con benchmark_telegram.py"""
+    parser.add_argument('--token', help='Token accettato (predefinito: qualsiasi)')
+    parser.add_argument('--latenza-ms', type=float, default=0, help='Latenza fissa per chiamata')
+    parser.add_argument('--jitter-ms', type=float, default=0, help='Latenza aggiuntiva casuale (0..jitter)')
+    parser.add_argument('--prob-errore', type=float, default=0.0, help='Probabilità di errore 502')
+    parser.add_argument('--prob-429', type=float, default=0.0, help='Probabilità di 429 con retry_after')
+    parser.add_argument('--retry-after', type=int, default=1, help='retry_after dei 429 casuali (secondi)')
+    parser.add_argument('--limiti', action='store_true', help='Applica i limiti reali (30/s globali, 1/s per chat) con 429')
+    parser.add_argument('--chat-bloccate', default='', help='chat_id che rispondono 403, separati da virgola')
+
+
+def opzioni_da_args(args):
+    return {
+        'token': args.token,
+        'latenza_ms': args.latenza_ms,
+        'jitter_ms': args.jitter_ms,
+        'prob_errore': args.prob_errore,
+        'prob_429': args.prob_429,
+        'retry_after': args.retry_after,
+        'limiti': args.limiti,
+        'chat_bloccate': [chat.strip() for chat in args.chat_bloccate.split(',') if chat.strip()],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Finto server Bot API di Telegram')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--porta', type=int, default=8081)
+    aggiungi_opzioni(parser)
+    args = parser.parse_args()
+
+    server, _ = avvia_server(args.porta, args.host, **opzioni_da_args(args))
+    print(f"[FAKE TELEGRAM] In ascolto su http://{args.host}:{server.server_address[1]}")
+    print(f"[FAKE TELEGRAM] Avvia il backend con GESTMAN_TELEGRAM_API_URL=http://{args.host}:{server.server_address[1]}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+# Registro delle chiavi di idempotenza condiviso dagli endpoint che la PWA può accodare offline
+# (completa-scadenza, completa-gruppo, submissions) e da POST /api/calendario/sync.
+# Il service worker genera la chiave prima del primo tentativo e la invia nell'header
+# Idempotency-Key: se la risposta si perde dopo il commit, il reinvio dalla coda con la
+# stessa chiave restituisce la risposta memorizzata invece di applicare l'operazione due volte.
+import json
+import datetime
+from flask import request
+
+HEADER_CHIAVE = 'Idempotency-Key'
+CHIAVE_MAX_LUNGHEZZA = 128
+SYNC_CONSERVAZIONE_GIORNI = 60
+
+class OperazioneNonValida(ValueError):
+    """Dati dell'operazione non validi: il rifiuto (400) è definitivo e viene memorizzato con la chiave"""
+
+def chiave_valida(chiave):
+    return isinstance(chiave, str) and 0 < len(chiave) <= CHIAVE_MAX_LUNGHEZZA
+
+def chiave_da_richiesta():
+    """Chiave dell'header Idempotency-Key (None se assente); solleva OperazioneNonValida se malformata"""
+    chiave = request.headers.get(HEADER_CHIAVE)
+    if chiave is None:
+        return None
+    if not chiave_valida(chiave):
+        raise OperazioneNonValida(f'{HEADER_CHIAVE} non valida')
+    return chiave
+
+def init_sync_db(c):
+    """Registro delle chiavi di idempotenza con la risposta restituita al client"""
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS sync_operazioni (
+            chiave TEXT PRIMARY KEY,
+            tipo TEXT NOT NULL,
+            stato_http INTEGER NOT NULL,
+            risposta TEXT NOT NULL,
+            operatore TEXT,
+            creato_il TEXT NOT NULL
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_sync_operazioni_creato ON sync_operazioni(creato_il)')
+
+def carica_operazioni_sincronizzate(c, chiavi, max_parametri=900):
+    """Risposte già memorizzate per le chiavi indicate (a blocchi): {chiave: (stato_http, risposta)}"""
+    note = {}
+    chiavi = list(chiavi)
+    for i in range(0, len(chiavi), max_parametri):
+        blocco = chiavi[i:i + max_parametri]
+        placeholders = ','.join('?' * len(blocco))
+        c.execute(f'SELECT chiave, stato_http, risposta FROM sync_operazioni WHERE chiave IN ({placeholders})', blocco)
+        for chiave, stato_http, risposta in c.fetchall():
+            note[chiave] = (stato_http, json.loads(risposta))
+    return note
+
+def registra_operazioni_sincronizzate(c, registro):
+    """Memorizza le risposte [(chiave, tipo, stato_http, risposta, operatore)] e pulisce le chiavi scadute"""
+    now = datetime.datetime.now()
+    c.executemany('''
+        INSERT INTO sync_operazioni (chiave, tipo, stato_http, risposta, operatore, creato_il)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', [(chiave, tipo, stato_http, json.dumps(risposta), operatore, now.isoformat())
+          for chiave, tipo, stato_http, risposta, operatore in registro])
+
+    # Le code offline vengono svuotate in pochi giorni: le chiavi più vecchie non servono più
+    limite = (now - datetime.timedelta(days=SYNC_CONSERVAZIONE_GIORNI)).isoformat()
+    c.execute('DELETE FROM sync_operazioni WHERE creato_il < ?', (limite,))
+
+def apri_operazione(conn, chiave):
+    """
+    Con una chiave prende subito il lock di scrittura e restituisce la risposta già memorizzata
+    (stato_http, risposta) se l'operazione è già stata applicata, altrimenti None.
+    Il chiamante esegue l'operazione nella stessa transazione e la registra prima del commit.
+    """
+    if not chiave:
+        return None
+    c = conn.cursor()
+    c.execute('BEGIN IMMEDIATE')
+    return carica_operazioni_sincronizzate(c, [chiave]).get(chiave)
@@ -5,9 +5,18 @@ import os
 import datetime
 import requests
 import json
+import re
+import html
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 
 bp = Blueprint('telegram', __name__)
-DB_PATH = os.path.join(os.path.dirname(__file__), 'gestman.db')
+# Cartella di gestman.db e compilazioni.db, letta all'import (le tabelle sono create subito):
+# GESTMAN_TELEGRAM_DB_DIR permette a benchmark e prove di lavorare su database temporanei
+DB_DIR = os.getenv('GESTMAN_TELEGRAM_DB_DIR') or os.path.dirname(__file__)
+DB_PATH = os.path.join(DB_DIR, 'gestman.db')
 
 # --- CREAZIONE TABELLE TELEGRAM ---
 def init_telegram_db():
@@ -39,6 +48,13 @@ def init_telegram_db():
     )
     ''')
     
+    # Finestre di riepilogo per tipo alert, es. "scadenze:5,non_conformita:0" (vedi RIEPILOGO)
+    try:
+        c.execute("ALTER TABLE telegram_chats ADD COLUMN digest_finestre TEXT DEFAULT ''")
+    except sqlite3.OperationalError:
+        # La colonna esiste già
+        pass
+    
     # Regole di assegnazione alert
     c.execute('''
     CREATE TABLE IF NOT EXISTS telegram_assignment_rules (
@@ -53,7 +69,44 @@ def init_telegram_db():
     )
     ''')
     
-    # Log invii
+    # Versione della configurazione chat: ogni modifica a telegram_chats la incrementa
+    # e i processi ricompilano la tabella di routing (vedi TABELLA DI ROUTING)
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS telegram_routing_versione (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        versione INTEGER NOT NULL
+    )
+    ''')
+    c.execute("INSERT OR IGNORE INTO telegram_routing_versione (id, versione) VALUES (1, 0)")
+    for evento in ('INSERT', 'UPDATE', 'DELETE'):
+        c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_telegram_chats_{evento.lower()}
+        AFTER {evento} ON telegram_chats
+        BEGIN
+            UPDATE telegram_routing_versione SET versione = versione + 1 WHERE id = 1;
+        END
+        ''')
+
+    # Versione della configurazione del bot: ogni modifica a telegram_config la incrementa e
+    # ogni processo (web, worker dedicato) rilegge il token alla chiamata successiva
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS telegram_config_versione (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        versione INTEGER NOT NULL
+    )
+    ''')
+    c.execute("INSERT OR IGNORE INTO telegram_config_versione (id, versione) VALUES (1, 0)")
+    for evento in ('INSERT', 'UPDATE', 'DELETE'):
+        c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_telegram_config_{evento.lower()}
+        AFTER {evento} ON telegram_config
+        BEGIN
+            UPDATE telegram_config_versione SET versione = versione + 1 WHERE id = 1;
+        END
+        ''')
+    
+    # Log invii (formato storico: testo completo per destinatario; non più scritto,
+    # i dati sono spostati in telegram_messaggi / telegram_recapiti e la tabella resta vuota)
     c.execute('''
     CREATE TABLE IF NOT EXISTS telegram_logs (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -66,8 +119,169 @@ def init_telegram_db():
     )
     ''')
     
+    # Log invii: un record per messaggio (tipo e anteprima calcolati alla scrittura)
+    # e una riga per destinatario
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS telegram_messaggi (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        outbox_id INTEGER UNIQUE,
+        alert_id INTEGER,
+        message_type TEXT NOT NULL,
+        testo TEXT NOT NULL,
+        anteprima TEXT NOT NULL,
+        creato_il TEXT NOT NULL
+    )
+    ''')
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS telegram_recapiti (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        messaggio_id INTEGER NOT NULL,
+        chat_id TEXT NOT NULL,
+        status TEXT NOT NULL,
+        sent_at TEXT NOT NULL
+    )
+    ''')
+    # Indice di copertura per il widget: ultimi messaggi inviati a una chat
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS idx_telegram_recapiti_chat
+        ON telegram_recapiti(chat_id, status, sent_at DESC, messaggio_id)
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_telegram_recapiti_messaggio ON telegram_recapiti(messaggio_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_telegram_messaggi_creato ON telegram_messaggi(creato_il)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_telegram_chats_name ON telegram_chats(name, active)')
+    
+    # Log oltre il periodo di conservazione: solo i dati essenziali, senza testo completo
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS telegram_log_archivio (
+        messaggio_id INTEGER PRIMARY KEY,
+        alert_id INTEGER,
+        message_type TEXT,
+        anteprima TEXT,
+        destinatari TEXT,
+        creato_il TEXT
+    )
+    ''')
+    
+    migra_telegram_logs(c)
+    
+    conn.commit()
+    conn.close()
+
+TELEGRAM_LOG_CONSERVAZIONE_GIORNI = 180
+TELEGRAM_ANTEPRIMA_CARATTERI = 100
+
+def testo_pulito(testo):
+    """Testo del messaggio senza tag HTML, per la visualizzazione"""
+    return html.unescape(re.sub(r'<[^>]+>', '', testo or ''))
+
+def anteprima_messaggio(testo):
+    pulito = testo_pulito(testo)
+    if len(pulito) > TELEGRAM_ANTEPRIMA_CARATTERI:
+        pulito = pulito[:TELEGRAM_ANTEPRIMA_CARATTERI - 3] + '...'
+    return pulito
+
+def tipo_messaggio(tipo_evento, payload):
+    """message_type del log a partire dall'evento della coda"""
+    if tipo_evento == 'notifica_ticket':
+        return 'ticket'
+    tipo = tipo_alert_canonico(payload.get('tipo'))
+    if tipo == 'tickets':
+        return 'ticket'
+    if tipo == 'scadenze':
+        return 'scadenza'
+    if tipo == 'non_conformita':
+        return 'non_conformita'
+    return 'alert'
+
+def tipo_messaggio_da_testo(testo):
+    """Tipo dedotto dal testo, solo per i log storici che non hanno l'evento di origine"""
+    if '🎫' in testo:
+        return 'ticket'
+    if '⏰' in testo or 'Scadenz' in testo:
+        return 'scadenza'
+    if '🚨' in testo:
+        return 'non_conformita'
+    return 'alert'
+
+def migra_telegram_logs(c):
+    """
+    Sposta una tantum i log storici in telegram_messaggi / telegram_recapiti e svuota telegram_logs
+    nella stessa transazione, così le righe HTML per destinatario non restano duplicate.
+    """
+    c.execute("SELECT 1 FROM telegram_messaggi LIMIT 1")
+    if c.fetchone():
+        # Già migrati da una versione precedente che lasciava gli originali: basta eliminarli
+        c.execute("DELETE FROM telegram_logs")
+        if c.rowcount:
+            print(f"[TELEGRAM] Eliminati {c.rowcount} log storici già migrati")
+        return
+    c.execute("SELECT alert_id, chat_id, message, status, sent_at FROM telegram_logs ORDER BY id")
+    righe = c.fetchall()
+    for alert_id, chat_id, message, status, sent_at in righe:
+        message = message or ''
+        c.execute("""
+            INSERT INTO telegram_messaggi (alert_id, message_type, testo, anteprima, creato_il)
+            VALUES (?, ?, ?, ?, ?)
+        """, (alert_id, tipo_messaggio_da_testo(message), message, anteprima_messaggio(message), sent_at or ''))
+        c.execute("INSERT INTO telegram_recapiti (messaggio_id, chat_id, status, sent_at) VALUES (?, ?, ?, ?)",
+                  (c.lastrowid, chat_id or '', status or 'sent', sent_at or ''))
+    c.execute("DELETE FROM telegram_logs")
+    if righe:
+        print(f"[TELEGRAM] Migrati {len(righe)} log storici in telegram_messaggi")
+
+def registra_log_inviati(inviati):
+    """
+    Scrive nel log i recapiti riusciti: inviati = [(outbox_id, alert_id, tipo_evento, payload, testo, chat_id, sent_at)].
+    Il messaggio è registrato una volta sola per evento, con un recapito per chat.
+    """
+    conn = sqlite3.connect(DB_PATH)
+    c = conn.cursor()
+    messaggi = {}
+    for outbox_id, alert_id, tipo_evento, payload, testo, chat_id, sent_at in inviati:
+        if outbox_id not in messaggi:
+            messaggi[outbox_id] = (outbox_id, alert_id, tipo_messaggio(tipo_evento, json.loads(payload)),
+                                   testo, anteprima_messaggio(testo), sent_at)
+    c.executemany("""
+        INSERT OR IGNORE INTO telegram_messaggi (outbox_id, alert_id, message_type, testo, anteprima, creato_il)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, list(messaggi.values()))
+    segnaposti = ','.join('?' * len(messaggi))
+    c.execute(f"SELECT outbox_id, id FROM telegram_messaggi WHERE outbox_id IN ({segnaposti})", tuple(messaggi))
+    ids = dict(c.fetchall())
+    c.executemany("INSERT INTO telegram_recapiti (messaggio_id, chat_id, status, sent_at) VALUES (?, ?, 'sent', ?)",
+                  [(ids[riga[0]], riga[5], riga[6]) for riga in inviati])
+    conn.commit()
+    conn.close()
+
+def registra_log_modificati(modificati):
+    """Aggiorna nel log il testo dei messaggi modificati: modificati = {outbox_id: testo}"""
+    conn = sqlite3.connect(DB_PATH)
+    conn.executemany("UPDATE telegram_messaggi SET testo = ?, anteprima = ? WHERE outbox_id = ?",
+                     [(testo, anteprima_messaggio(testo), outbox_id) for outbox_id, testo in modificati.items()])
+    conn.commit()
+    conn.close()
+
+def archivia_log_telegram(giorni=TELEGRAM_LOG_CONSERVAZIONE_GIORNI):
+    """Sposta in telegram_log_archivio i messaggi più vecchi del periodo di conservazione"""
+    limite = (datetime.datetime.now() - datetime.timedelta(days=giorni)).isoformat()
+    conn = sqlite3.connect(DB_PATH)
+    c = conn.cursor()
+    c.execute("""
+        INSERT OR REPLACE INTO telegram_log_archivio (messaggio_id, alert_id, message_type, anteprima, destinatari, creato_il)
+        SELECT m.id, m.alert_id, m.message_type, m.anteprima,
+               (SELECT group_concat(r.chat_id) FROM telegram_recapiti r WHERE r.messaggio_id = m.id),
+               m.creato_il
+        FROM telegram_messaggi m
+        WHERE m.creato_il < ?
+    """, (limite,))
+    archiviati = c.rowcount
+    c.execute("DELETE FROM telegram_recapiti WHERE messaggio_id IN (SELECT id FROM telegram_messaggi WHERE creato_il < ?)", (limite,))
+    c.execute("DELETE FROM telegram_messaggi WHERE creato_il < ?", (limite,))
     conn.commit()
     conn.close()
+    if archiviati:
+        print(f"[TELEGRAM] Archiviati {archiviati} messaggi più vecchi di {giorni} giorni")
+    return archiviati
 
 # --- API CONFIGURAZIONE BOT ---
 @bp.route('/config', methods=['GET', 'POST'])
@@ -100,8 +314,7 @@ def telegram_config():
                 return jsonify({'error': 'Bot token richiesto'}), 400
             
             # Test bot token
-            test_url = f"https://api.telegram.org/bot{bot_token}/getMe"
-            response = requests.get(test_url, timeout=10)
+            response = client_telegram.chiama('getMe', bot_token, http='get')
             
             if response.status_code != 200:
                 return jsonify({'error': 'Token bot non valido'}), 400
@@ -122,6 +335,7 @@ def telegram_config():
             """, (bot_token, bot_name, 1, datetime.datetime.now().isoformat()))
             conn.commit()
             conn.close()
+            client_telegram.invalida_config()
             
             return jsonify({
                 'success': True,
@@ -141,7 +355,7 @@ def telegram_chats():
         try:
             conn = sqlite3.connect(DB_PATH)
             c = conn.cursor()
-            c.execute("SELECT id, name, chat_id, alert_types, civici_filter, asset_types, active FROM telegram_chats ORDER BY name")
+            c.execute("SELECT id, name, chat_id, alert_types, civici_filter, asset_types, active, digest_finestre FROM telegram_chats ORDER BY name")
             rows = c.fetchall()
             conn.close()
             
@@ -152,7 +366,9 @@ def telegram_chats():
                 'alert_types': r[3].split(',') if r[3] else [],
                 'civici_filter': r[4],
                 'asset_types': r[5].split(',') if r[5] else [],
-                'active': bool(r[6])
+                'active': bool(r[6]),
+                'digest_finestre': finestre_digest_effettive(r[7]),
+                'digest_finestre_configurate': leggi_finestre_digest(r[7])
             } for r in rows]
             return jsonify({'chats': chats})
         except Exception as e:
@@ -173,49 +389,148 @@ def telegram_chats():
             if not alert_types:
                 return jsonify({'error': 'Seleziona almeno un tipo di alert'}), 400
             
+            try:
+                digest_finestre = normalizza_finestre_digest(data.get('digest_finestre', ''))
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            
             conn = sqlite3.connect(DB_PATH)
             c = conn.cursor()
             c.execute("""
-                INSERT INTO telegram_chats (name, chat_id, alert_types, civici_filter, asset_types, active, created_at)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            """, (name, chat_id, alert_types, civici_filter, asset_types, 1, datetime.datetime.now().isoformat()))
+                INSERT INTO telegram_chats (name, chat_id, alert_types, civici_filter, asset_types, active, created_at, digest_finestre)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """, (name, chat_id, alert_types, civici_filter, asset_types, 1, datetime.datetime.now().isoformat(), digest_finestre))
             conn.commit()
             conn.close()
+            indice_routing.ricompila()
             
             return jsonify({'success': True, 'message': 'Chat aggiunta con successo'})
         except Exception as e:
             return jsonify({'error': str(e)}), 500
 
-# --- FUNZIONE INVIO MESSAGGIO ---
-def send_telegram_message(chat_id, message):
-    try:
+# --- CLIENT TELEGRAM ---
+# Tutti gli invii passano da un unico client per processo: una requests.Session con pool di
+# connessioni keep-alive (niente handshake TLS per ogni messaggio) e il bot_token in cache,
+# riletto da telegram_config solo quando cambia telegram_config_versione (incrementata dai
+# trigger a ogni salvataggio, in qualunque processo) o quando Telegram risponde 401.
+
+# URL base della Bot API: per prove e benchmark si può puntare al finto server locale
+# (python fake_telegram_api.py, poi GESTMAN_TELEGRAM_API_URL=http://127.0.0.1:8081)
+TELEGRAM_API_URL = os.getenv('GESTMAN_TELEGRAM_API_URL', 'https://api.telegram.org').rstrip('/')
+TELEGRAM_TIMEOUT_SECONDI = 10
+TELEGRAM_POOL_CONNESSIONI = 10
+
+class ClientTelegram:
+    """Sessione HTTP persistente verso la Bot API con configurazione del bot in cache"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sessione = None
+        self._pid = None
+        self._token = None
+        self._token_versione = None
+
+    def sessione(self):
+        # Una sessione per processo: dopo il fork dei worker gunicorn non si riusano i socket del padre
+        if self._sessione is None or self._pid != os.getpid():
+            with self._lock:
+                if self._sessione is None or self._pid != os.getpid():
+                    sessione = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=TELEGRAM_POOL_CONNESSIONI)
+                    sessione.mount('https://', adapter)
+                    sessione.mount('http://', adapter)
+                    self._sessione = sessione
+                    self._pid = os.getpid()
+        return self._sessione
+
+    def bot_token(self):
+        """Token del bot attivo (None se non configurato): una sola lettura della versione se nulla è cambiato"""
         conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute("SELECT bot_token FROM telegram_config WHERE active = 1 ORDER BY id DESC LIMIT 1")
-        config = c.fetchone()
-        conn.close()
-        
-        if not config or not config[0]:
-            return False, "Bot non configurato"
-        
-        bot_token = config[0]
-        url = f"https://api.telegram.org/bot{bot_token}/sendMessage"
-        
-        payload = {
-            'chat_id': chat_id,
-            'text': message,
-            'parse_mode': 'HTML'
-        }
-        
-        response = requests.post(url, json=payload, timeout=10)
-        
-        if response.status_code == 200 and response.json().get('ok'):
-            return True, "Messaggio inviato"
+        try:
+            c = conn.cursor()
+            c.execute("SELECT versione FROM telegram_config_versione WHERE id = 1")
+            versione = c.fetchone()[0]
+            if versione == self._token_versione:
+                return self._token
+            with self._lock:
+                c.execute("SELECT bot_token FROM telegram_config WHERE active = 1 ORDER BY id DESC LIMIT 1")
+                config = c.fetchone()
+                self._token = config[0] if config and config[0] else None
+                self._token_versione = versione
+                return self._token
+        finally:
+            conn.close()
+
+    def invalida_config(self):
+        self._token_versione = None
+
+    def chiama(self, metodo, bot_token=None, params=None, http='post', timeout=None):
+        """Chiamata grezza alla Bot API; restituisce la response di requests"""
+        bot_token = bot_token or self.bot_token()
+        url = f"{TELEGRAM_API_URL}/bot{bot_token}/{metodo}"
+        timeout = timeout or TELEGRAM_TIMEOUT_SECONDI
+        if http == 'get':
+            response = self.sessione().get(url, params=params, timeout=timeout)
         else:
-            return False, f"Errore API: {response.text}"
-            
-    except Exception as e:
-        return False, f"Errore: {str(e)}"
+            response = self.sessione().post(url, json=params, timeout=timeout)
+        if response.status_code == 401:
+            # Il token in cache non è più valido: alla prossima chiamata si rilegge la configurazione
+            self.invalida_config()
+        return response
+
+    def esito(self, response):
+        """
+        Esito di sendMessage/editMessageText: dict con ok, errore e permanente (True se ritentare
+        non ha senso: chat inesistente, bot bloccato, messaggio non valido); su 429 anche
+        retry_after, i secondi indicati da Telegram prima di riprovare; se riuscito message_id.
+        """
+        if response.status_code == 200 and response.json().get('ok'):
+            risultato = response.json().get('result')
+            return {'ok': True, 'message_id': risultato.get('message_id') if isinstance(risultato, dict) else None}
+        if response.status_code == 429:
+            try:
+                retry_after = response.json().get('parameters', {}).get('retry_after')
+            except ValueError:
+                retry_after = None
+            return {'ok': False, 'errore': f"Errore API: {response.text}", 'permanente': False,
+                    'retry_after': retry_after if retry_after is not None else 1}
+        permanente = response.status_code in (400, 401, 403, 404)
+        return {'ok': False, 'errore': f"Errore API: {response.text}", 'permanente': permanente}
+
+    def send_message(self, chat_id, testo, bot_token=None):
+        """Una chiamata sendMessage (vedi esito)"""
+        bot_token = bot_token or self.bot_token()
+        if not bot_token:
+            return {'ok': False, 'errore': 'Bot non configurato', 'permanente': False}
+        try:
+            response = self.chiama('sendMessage', bot_token, {'chat_id': chat_id, 'text': testo, 'parse_mode': 'HTML'})
+            return self.esito(response)
+        except Exception as e:
+            return {'ok': False, 'errore': f"Errore: {str(e)}", 'permanente': False}
+
+    def edit_message_text(self, chat_id, message_id, testo, bot_token=None):
+        """Una chiamata editMessageText (vedi esito); un testo già uguale conta come riuscito"""
+        bot_token = bot_token or self.bot_token()
+        if not bot_token:
+            return {'ok': False, 'errore': 'Bot non configurato', 'permanente': False}
+        try:
+            response = self.chiama('editMessageText', bot_token, {
+                'chat_id': chat_id, 'message_id': message_id, 'text': testo, 'parse_mode': 'HTML'
+            })
+            if response.status_code == 400 and 'message is not modified' in response.text:
+                return {'ok': True, 'message_id': message_id}
+            return self.esito(response)
+        except Exception as e:
+            return {'ok': False, 'errore': f"Errore: {str(e)}", 'permanente': False}
+
+client_telegram = ClientTelegram()
+
+# --- FUNZIONE INVIO MESSAGGIO ---
+def send_telegram_message(chat_id, message):
+    esito = client_telegram.send_message(chat_id, message)
+    if esito['ok']:
+        return True, "Messaggio inviato"
+    return False, esito['errore']
 
 # --- API TEST INVIO ---
 @bp.route('/test', methods=['POST'])
@@ -245,7 +560,7 @@ def get_chat_details(chat_id):
     try:
         conn = sqlite3.connect(DB_PATH)
         c = conn.cursor()
-        c.execute("SELECT id, name, chat_id, alert_types, civici_filter, asset_types, active FROM telegram_chats WHERE id = ?", (chat_id,))
+        c.execute("SELECT id, name, chat_id, alert_types, civici_filter, asset_types, active, digest_finestre FROM telegram_chats WHERE id = ?", (chat_id,))
         row = c.fetchone()
         conn.close()
         
@@ -259,7 +574,10 @@ def get_chat_details(chat_id):
             'alert_types': row[3].split(',') if row[3] else [],
             'civici_filter': row[4],
             'asset_types': row[5].split(',') if row[5] else [],
-            'active': bool(row[6])
+            'active': bool(row[6]),
+            'digest_finestre': finestre_digest_effettive(row[7]),
+            # Solo le finestre salvate per la chat: quelle assenti seguono il predefinito
+            'digest_finestre_configurate': leggi_finestre_digest(row[7])
         }
         
         return jsonify({'chat': chat})
@@ -289,20 +607,32 @@ def manage_chat(chat_id):
             c = conn.cursor()
             
             # Verifica che la chat esista
-            c.execute("SELECT id FROM telegram_chats WHERE id = ?", (chat_id,))
-            if not c.fetchone():
+            c.execute("SELECT digest_finestre FROM telegram_chats WHERE id = ?", (chat_id,))
+            row = c.fetchone()
+            if not row:
                 conn.close()
                 return jsonify({'error': 'Chat non trovata'}), 404
+
+            # digest_finestre modifica solo i tipi indicati (vuoto = torna al predefinito);
+            # senza digest_finestre nel body la configurazione esistente resta invariata
+            try:
+                digest_finestre = (unisci_finestre_digest(row[0], data['digest_finestre'])
+                                   if 'digest_finestre' in data else None)
+            except ValueError as e:
+                conn.close()
+                return jsonify({'error': str(e)}), 400
             
             # Aggiorna la chat
             c.execute("""
                 UPDATE telegram_chats 
-                SET name = ?, chat_id = ?, alert_types = ?, civici_filter = ?, asset_types = ?, active = ?
+                SET name = ?, chat_id = ?, alert_types = ?, civici_filter = ?, asset_types = ?, active = ?,
+                    digest_finestre = COALESCE(?, digest_finestre)
                 WHERE id = ?
-            """, (name, chat_id_value, alert_types, civici_filter, asset_types, 1 if active else 0, chat_id))
+            """, (name, chat_id_value, alert_types, civici_filter, asset_types, 1 if active else 0, digest_finestre, chat_id))
             
             conn.commit()
             conn.close()
+            indice_routing.ricompila()
             
             return jsonify({'success': True, 'message': 'Chat aggiornata con successo'})
             
@@ -326,6 +656,7 @@ def manage_chat(chat_id):
             c.execute("DELETE FROM telegram_chats WHERE id = ?", (chat_id,))
             conn.commit()
             conn.close()
+            indice_routing.ricompila()
             
             return jsonify({'success': True, 'message': f'Chat "{chat[0]}" eliminata'})
             
@@ -335,286 +666,1638 @@ def manage_chat(chat_id):
 # --- INIZIALIZZAZIONE ---
 init_telegram_db()
 
+# --- CODA DI INVIO (OUTBOX) ---
+# Gli alert non vengono più spediti dentro la richiesta HTTP: i produttori accodano un evento
+# in telegram_outbox (in compilazioni.db, nella stessa transazione della riga alert) e un
+# worker in background lo smista ai destinatari (telegram_consegne, una riga per chat) e
+# consegna i messaggi con tentativi, backoff esponenziale e stato per destinatario.
+# Il worker gira come thread in ogni processo del backend (GESTMAN_TELEGRAM_WORKER=thread,
+# predefinito) oppure come processo dedicato con "python telegram_worker.py"
+# (GESTMAN_TELEGRAM_WORKER=esterno nel backend). Le consegne sono prese in carico con un
+# lease, quindi più worker in parallelo non inviano mai due volte lo stesso messaggio.
+
+OUTBOX_DB_PATH = os.path.join(DB_DIR, 'compilazioni.db')
+OUTBOX_MAX_TENTATIVI = 8
+OUTBOX_BACKOFF_BASE_SECONDI = 5
+OUTBOX_BACKOFF_MAX_SECONDI = 3600
+OUTBOX_LEASE_SECONDI = 120
+OUTBOX_BATCH = 50
+OUTBOX_ATTESA_SECONDI = 1.0
+TELEGRAM_WORKER_MODALITA = os.getenv('GESTMAN_TELEGRAM_WORKER', 'thread')
+
+# Limiti di invio della Bot API, applicati come token bucket condivisi tra processi
+# (tabella telegram_limiti). Ogni bucket è salvato come "theoretical arrival time" (GCRA):
+# il prossimo invio è ammesso da tat - intervallo * (capacità - 1).
+TELEGRAM_LIMITE_GLOBALE_PER_SECONDO = 30
+TELEGRAM_CAPACITA_GLOBALE = 5
+TELEGRAM_INTERVALLO_CHAT_SECONDI = 1.0
+TELEGRAM_INTERVALLO_GRUPPO_SECONDI = 3.0  # 20 messaggi al minuto per gruppo
+TELEGRAM_ORIZZONTE_PRENOTAZIONE_SECONDI = 2.0
+
+# Invii in parallelo del worker: quanti ne servono per saturare il limite globale con una
+# latenza tipica della Bot API; oltre, i thread aspetterebbero solo il proprio slot
+OUTBOX_RTT_STIMATO_SECONDI = 0.3
+OUTBOX_INVII_PARALLELI = max(1, int(TELEGRAM_LIMITE_GLOBALE_PER_SECONDO * OUTBOX_RTT_STIMATO_SECONDI))
+
+def init_telegram_outbox_db():
+    """Crea in compilazioni.db le tabelle della coda Telegram"""
+    conn = sqlite3.connect(OUTBOX_DB_PATH)
+    c = conn.cursor()
+
+    # Un evento per alert/notifica, scritto dal produttore nella sua transazione
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS telegram_outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        alert_id INTEGER,
+        tipo TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        testo TEXT,
+        stato TEXT NOT NULL DEFAULT 'in_coda',
+        tentativi INTEGER NOT NULL DEFAULT 0,
+        ultimo_errore TEXT,
+        creato_il TEXT NOT NULL,
+        smistato_il TEXT
+    )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_telegram_outbox_stato ON telegram_outbox(stato, id)')
+
+    # Una consegna per chat destinataria
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS telegram_consegne (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        outbox_id INTEGER NOT NULL,
+        chat_id TEXT NOT NULL,
+        chat_name TEXT,
+        stato TEXT NOT NULL DEFAULT 'in_coda',
+        tentativi INTEGER NOT NULL DEFAULT 0,
+        prossimo_tentativo TEXT NOT NULL,
+        lease_fino TEXT,
+        ultimo_errore TEXT,
+        inviato_il TEXT
+    )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_telegram_consegne_stato ON telegram_consegne(stato, prossimo_tentativo)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_telegram_consegne_outbox ON telegram_consegne(outbox_id)')
+
+    # Gruppo di riepilogo (tipo alert canonico) delle consegne differite; NULL = invio immediato
+    try:
+        c.execute('ALTER TABLE telegram_consegne ADD COLUMN gruppo_digest TEXT')
+    except sqlite3.OperationalError:
+        # La colonna esiste già
+        pass
+    c.execute('CREATE INDEX IF NOT EXISTS idx_telegram_consegne_digest ON telegram_consegne(chat_id, gruppo_digest, stato)')
+
+    # message_id: messaggio Telegram della consegna (quello inviato, o quello da modificare);
+    # consegna_origine: per le modifiche di stato, la consegna del messaggio originale
+    for colonna in ('message_id INTEGER', 'consegna_origine INTEGER'):
+        try:
+            c.execute(f'ALTER TABLE telegram_consegne ADD COLUMN {colonna}')
+        except sqlite3.OperationalError:
+            # La colonna esiste già
+            pass
+    c.execute('CREATE INDEX IF NOT EXISTS idx_telegram_consegne_origine ON telegram_consegne(consegna_origine, stato)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_telegram_outbox_alert ON telegram_outbox(alert_id)')
+
+    # Dead letter: consegne ed eventi che hanno esaurito i tentativi, in attesa di essere
+    # riprovati o scartati dall'amministratore (riferimento = 'consegna:<id>' o 'evento:<id>')
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS telegram_dead_letter (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        riferimento TEXT NOT NULL UNIQUE,
+        outbox_id INTEGER NOT NULL,
+        consegna_id INTEGER,
+        alert_id INTEGER,
+        tipo TEXT,
+        chat_id TEXT,
+        chat_name TEXT,
+        testo TEXT,
+        tentativi INTEGER,
+        ultimo_errore TEXT,
+        stato TEXT NOT NULL DEFAULT 'in_attesa',
+        creato_il TEXT NOT NULL,
+        riprovato_il TEXT,
+        ripetizioni INTEGER NOT NULL DEFAULT 0
+    )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_telegram_dead_letter_stato ON telegram_dead_letter(stato, id)')
+    # Consegne già fallite prima della dead letter: vi entrano una volta sola
+    c.execute("""
+        INSERT OR IGNORE INTO telegram_dead_letter
+            (riferimento, outbox_id, consegna_id, alert_id, tipo, chat_id, chat_name, testo, tentativi, ultimo_errore, creato_il)
+        SELECT 'consegna:' || d.id, d.outbox_id, d.id, o.alert_id, o.tipo, d.chat_id, d.chat_name, o.testo,
+               d.tentativi, d.ultimo_errore, d.prossimo_tentativo
+        FROM telegram_consegne d JOIN telegram_outbox o ON o.id = d.outbox_id
+        WHERE d.stato = 'errore'
+    """)
+
+    # Stato dei token bucket (chiave 'globale' o 'chat:<chat_id>', tat in secondi epoch)
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS telegram_limiti (
+        chiave TEXT PRIMARY KEY,
+        tat REAL NOT NULL
+    )
+    ''')
+
+    # Poller dei comandi del bot: lease di un solo processo e offset di getUpdates (riga unica)
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS telegram_polling (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        proprietario TEXT,
+        lease_fino REAL NOT NULL DEFAULT 0,
+        offset_aggiornamenti INTEGER NOT NULL DEFAULT 0
+    )
+    ''')
+    c.execute('INSERT OR IGNORE INTO telegram_polling (id) VALUES (1)')
+
+    conn.commit()
+    conn.close()
+
+init_telegram_outbox_db()
+
+def accoda_evento_telegram(tipo, payload, cursor=None, alert_id=None):
+    """
+    Accoda un evento Telegram. Con cursor (connessione a compilazioni.db) l'evento fa parte
+    della transazione del chiamante e viene confermato dal suo commit.
+    """
+    valori = (alert_id, tipo, json.dumps(payload, ensure_ascii=False), datetime.datetime.now().isoformat())
+    sql = "INSERT INTO telegram_outbox (alert_id, tipo, payload, creato_il) VALUES (?, ?, ?, ?)"
+    if cursor is not None:
+        cursor.execute(sql, valori)
+        evento_id = cursor.lastrowid
+    else:
+        conn = sqlite3.connect(OUTBOX_DB_PATH)
+        c = conn.cursor()
+        c.execute(sql, valori)
+        evento_id = c.lastrowid
+        conn.commit()
+        conn.close()
+    avvia_worker_telegram()
+    _sveglia_worker.set()
+    return evento_id
+
 # --- FUNZIONE DI INTEGRAZIONE AUTOMATICA ---
-def send_alert_to_telegram(alert_data):
+def send_alert_to_telegram(alert_data, cursor=None, alert_id=None):
     """
-    Invia automaticamente un alert su Telegram agli utenti configurati
+    Accoda un alert per l'invio Telegram agli utenti configurati (vedi CODA DI INVIO)
     alert_data: dict con 'tipo', 'titolo', 'descrizione', 'civico', 'asset', 'operatore'
+    cursor: cursore su compilazioni.db per accodare nella transazione dell'alert
     """
     try:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        
-        # Verifica se il bot è configurato
-        c.execute("SELECT bot_token FROM telegram_config WHERE active = 1 ORDER BY id DESC LIMIT 1")
-        config = c.fetchone()
-        if not config or not config[0]:
-            print("[TELEGRAM] Bot non configurato, alert non inviato")
-            return False
-        
-        bot_token = config[0]
-        
-        # Trova gli utenti che devono ricevere questo tipo di alert
-        # Pattern flessibile per scadenza/scadenze
-        if alert_data['tipo'] in ['scadenza', 'scadenze']:
-            search_pattern = f"%scaden%"  # Trova sia 'scadenza' che 'scadenze'
-        else:
-            search_pattern = f"%{alert_data['tipo']}%"
-        print(f"[DEBUG TELEGRAM] Cercando utenti con pattern: {search_pattern}")
-        
-        c.execute("""
-            SELECT chat_id, name, alert_types, civici_filter, asset_types 
-            FROM telegram_chats 
-            WHERE active = 1 AND alert_types LIKE ?
-        """, (search_pattern,))
-        
-        users = c.fetchall()
-        print(f"[DEBUG TELEGRAM] Query risultati: {len(users)} utenti trovati")
-        for user in users:
-            print(f"[DEBUG TELEGRAM] User: {user[1]}, Alert Types: '{user[2]}'")
-        
-        conn.close()
+        accoda_evento_telegram('alert', alert_data, cursor=cursor, alert_id=alert_id)
+        print(f"[TELEGRAM] Alert '{alert_data.get('tipo')}' accodato per l'invio")
+        return True
+    except Exception as e:
+        print(f"[TELEGRAM] Errore durante accodamento alert: {str(e)}")
+        return False
+
+# --- FUNZIONE INVIO NOTIFICA TICKET ---
+def send_ticket_notification(alert_id, titolo, descrizione, operatore, civico=None, asset=None, cursor=None):
+    """Accoda la notifica Telegram per un nuovo ticket"""
+    try:
+        accoda_evento_telegram('notifica_ticket', {
+            'alert_id': alert_id, 'titolo': titolo, 'descrizione': descrizione,
+            'operatore': operatore, 'civico': civico, 'asset': asset
+        }, cursor=cursor, alert_id=alert_id)
+        return True
+    except Exception as e:
+        print(f"[TELEGRAM] Errore durante accodamento ticket: {str(e)}")
+        return False
+
+# --- FUNZIONE AGGIORNAMENTO STATO ALERT ---
+def aggiorna_stato_alert_telegram(alert_id, stato, operatore=None, cursor=None):
+    """
+    Accoda l'aggiornamento di stato di un alert (in_carico, chiuso, aperto): il worker modifica
+    con editMessageText i messaggi già inviati per l'alert invece di spedirne di nuovi
+    """
+    try:
+        accoda_evento_telegram('stato_alert', {
+            'alert_id': alert_id, 'stato': stato, 'operatore': operatore,
+            'quando': datetime.datetime.now().isoformat()
+        }, cursor=cursor, alert_id=alert_id)
+        return True
+    except Exception as e:
+        print(f"[TELEGRAM] Errore durante accodamento stato alert: {str(e)}")
+        return False
+
+def formatta_messaggio_alert(alert_data, quando):
+    """Testo HTML dell'alert; quando è l'istante di accodamento"""
+    # Prepara il messaggio
+    if alert_data['tipo'] == 'non_conformita':
+        emoji = "🚨"
+    elif alert_data['tipo'] == 'Tickets':
+        emoji = "🎫"
+    else:
+        emoji = "⏰"
+    
+    # Costruisci il messaggio in base al tipo
+    if alert_data['tipo'] == 'scadenza':
+        # Messaggio speciale per le scadenze con formatting pulito
+        message = f"{emoji} <b>Alert GESTMAN</b>\n\n"
+        message += f"<b>Tipo:</b> Scadenze\n"
         
-        if not users:
-            print(f"[TELEGRAM] Nessun utente configurato per alert tipo '{alert_data['tipo']}'")
-            return False
+        if alert_data.get('civico'):
+            message += f"<b>Civico:</b> {alert_data['civico']}\n"
+        if alert_data.get('asset'):
+            message += f"<b>Asset:</b> {alert_data['asset']}\n"
+        if alert_data.get('operazione'):
+            message += f"<b>Operazione:</b> {alert_data['operazione']}\n"
+        if alert_data.get('note'):
+            message += f"<b>Info:</b> {alert_data['note']}\n"
         
-        # Prepara il messaggio
-        if alert_data['tipo'] == 'non_conformita':
-            emoji = "🚨"
-        elif alert_data['tipo'] == 'Tickets':
-            emoji = "🎫"
-        else:
-            emoji = "⏰"
+        message += f"\n📅 {quando.strftime('%d/%m/%Y %H:%M')}"
+    elif alert_data['tipo'] == 'Tickets':
+        # Messaggio speciale per i tickets
+        message = f"{emoji} <b>Nuovo Ticket GESTMAN</b>\n\n"
         
-        # Costruisci il messaggio in base al tipo
-        if alert_data['tipo'] == 'scadenza':
-            # Messaggio speciale per le scadenze con formatting pulito
-            message = f"{emoji} <b>Alert GESTMAN</b>\n\n"
-            message += f"<b>Tipo:</b> Scadenze\n"
-            
-            if alert_data.get('civico'):
-                message += f"<b>Civico:</b> {alert_data['civico']}\n"
-            if alert_data.get('asset'):
-                message += f"<b>Asset:</b> {alert_data['asset']}\n"
-            if alert_data.get('operazione'):
-                message += f"<b>Operazione:</b> {alert_data['operazione']}\n"
-            if alert_data.get('note'):
-                message += f"<b>Info:</b> {alert_data['note']}\n"
-            
-            message += f"\n📅 {datetime.datetime.now().strftime('%d/%m/%Y %H:%M')}"
-        elif alert_data['tipo'] == 'Tickets':
-            # Messaggio speciale per i tickets
-            message = f"{emoji} <b>Nuovo Ticket GESTMAN</b>\n\n"
-            
-            if alert_data.get('operatore'):
-                message += f"<b>Richiesto da:</b> {alert_data['operatore']}\n"
-            if alert_data.get('civico'):
-                message += f"<b>Civico:</b> {alert_data['civico']}\n"
-            if alert_data.get('asset'):
-                message += f"<b>Asset:</b> {alert_data['asset']}\n"
-            if alert_data.get('descrizione'):
-                message += f"<b>Descrizione:</b> {alert_data['descrizione']}\n"
-            if alert_data.get('note') and alert_data['note'] != alert_data.get('descrizione'):
-                message += f"<b>Note:</b> {alert_data['note']}\n"
-            
-            message += f"\n📅 {datetime.datetime.now().strftime('%d/%m/%Y %H:%M')}"
-            message += f"\n\n💡 <i>Nuovo ticket da gestire nella sezione Alert</i>"
-        else:
-            # Messaggio standard per altri tipi di alert
-            message = f"{emoji} <b>Alert GESTMAN</b>\n\n"
-            message += f"<b>Tipo:</b> {alert_data['tipo'].replace('_', ' ').title()}\n"
-            
-            if alert_data.get('operatore'):
-                message += f"<b>Operatore:</b> {alert_data['operatore']}\n"
-            if alert_data.get('civico'):
-                message += f"<b>Civico:</b> {alert_data['civico']}\n"
-            if alert_data.get('asset'):
-                message += f"<b>Asset:</b> {alert_data['asset']}\n"
+        if alert_data.get('operatore'):
+            message += f"<b>Richiesto da:</b> {alert_data['operatore']}\n"
+        if alert_data.get('civico'):
+            message += f"<b>Civico:</b> {alert_data['civico']}\n"
+        if alert_data.get('asset'):
+            message += f"<b>Asset:</b> {alert_data['asset']}\n"
+        if alert_data.get('descrizione'):
             message += f"<b>Descrizione:</b> {alert_data['descrizione']}\n"
-            if alert_data.get('note'):
-                message += f"<b>Note:</b> {alert_data['note']}\n"
-            message += f"\n📅 {datetime.datetime.now().strftime('%d/%m/%Y %H:%M')}"
+        if alert_data.get('note') and alert_data['note'] != alert_data.get('descrizione'):
+            message += f"<b>Note:</b> {alert_data['note']}\n"
         
-        # DEBUG: Log di tutti i dati ricevuti
-        print(f"[DEBUG TELEGRAM] Alert data ricevuti: {alert_data}")
-        print(f"[DEBUG TELEGRAM] Messaggio costruito: {message}")
+        message += f"\n📅 {quando.strftime('%d/%m/%Y %H:%M')}"
+        message += f"\n\n💡 <i>Nuovo ticket da gestire nella sezione Alert</i>"
+    else:
+        # Messaggio standard per altri tipi di alert
+        message = f"{emoji} <b>Alert GESTMAN</b>\n\n"
+        message += f"<b>Tipo:</b> {alert_data['tipo'].replace('_', ' ').title()}\n"
         
-        sent_count = 0
+        if alert_data.get('operatore'):
+            message += f"<b>Operatore:</b> {alert_data['operatore']}\n"
+        if alert_data.get('civico'):
+            message += f"<b>Civico:</b> {alert_data['civico']}\n"
+        if alert_data.get('asset'):
+            message += f"<b>Asset:</b> {alert_data['asset']}\n"
+        message += f"<b>Descrizione:</b> {alert_data['descrizione']}\n"
+        if alert_data.get('note'):
+            message += f"<b>Note:</b> {alert_data['note']}\n"
+        message += f"\n📅 {quando.strftime('%d/%m/%Y %H:%M')}"
+    return message
+
+def formatta_notifica_ticket(payload, quando):
+    """Testo HTML della notifica di nuovo ticket"""
+    message = f"🎫 <b>NUOVO TICKET</b>\n"
+    message += f"📌 <b>ID:</b> #{payload['alert_id']}\n"
+    message += f"👤 <b>Operatore:</b> {payload['operatore']}\n\n"
+    
+    if payload.get('civico'):
+        message += f"🏠 <b>Civico:</b> {payload['civico']}\n"
+    if payload.get('asset'):
+        message += f"🔧 <b>Asset:</b> {payload['asset']}\n"
         
-        # Invia a ogni utente configurato (applicando filtri)
-        for user in users:
-            chat_id, name, alert_types, civici_filter, asset_types = user
-            
-            print(f"[DEBUG TELEGRAM] Processando utente: {name}")
-            print(f"[DEBUG TELEGRAM] - Chat ID: {chat_id}")
-            print(f"[DEBUG TELEGRAM] - Civici filter: '{civici_filter}'")
-            print(f"[DEBUG TELEGRAM] - Asset types: '{asset_types}'")
-            print(f"[DEBUG TELEGRAM] - Alert civico: '{alert_data.get('civico')}'")
-            print(f"[DEBUG TELEGRAM] - Alert asset: '{alert_data.get('asset')}'")
-            
-            # Controlla filtro civici
-            if civici_filter and alert_data.get('civico'):
-                civici_allowed = [c.strip() for c in civici_filter.split(',')]
-                print(f"[DEBUG TELEGRAM] - Civici allowed: {civici_allowed}")
-                if alert_data['civico'] not in civici_allowed:
-                    print(f"[DEBUG TELEGRAM] - SKIP: Civico {alert_data['civico']} non in lista allowed")
+    message += f"\n📝 <b>Descrizione:</b>\n{payload['descrizione']}\n"
+    message += f"\n📅 <i>{quando.strftime('%d/%m/%Y %H:%M')}</i>"
+    return message
+
+ETICHETTE_STATO_ALERT = {
+    'in_carico': "🟠 <b>Preso in carico</b>",
+    'chiuso': "✅ <b>Chiuso</b>",
+}
+
+def formatta_stato_alert(testo_originale, payload):
+    """Testo del messaggio originale con lo stato corrente in fondo; riaperto = testo originale"""
+    etichetta = ETICHETTE_STATO_ALERT.get(payload.get('stato'))
+    if not etichetta:
+        return testo_originale
+    riga = etichetta
+    if payload.get('operatore'):
+        riga += f" da {html.escape(str(payload['operatore']))}"
+    if payload.get('quando'):
+        riga += f" · {datetime.datetime.fromisoformat(payload['quando']).strftime('%d/%m/%Y %H:%M')}"
+    return f"{testo_originale[:TELEGRAM_MAX_CARATTERI - len(riga) - 2]}\n\n{riga}"
+
+# --- TABELLA DI ROUTING ---
+# I filtri delle chat (tipi alert, civici, tipi asset) vengono compilati in insiemi di chat
+# indicizzati per valore, con le varianti singolare/plurale dei tipi asset già risolte.
+# Instradare un alert diventa qualche lookup e un'intersezione di insiemi. La tabella è
+# ricompilata dal processo che modifica le chat e, negli altri processi, al primo uso dopo
+# che telegram_routing_versione (incrementata dai trigger su telegram_chats) è cambiata.
+
+def tipo_alert_canonico(tipo):
+    """Chiave del tipo alert: minuscolo, con scadenza/scadenze unificati"""
+    tipo = (tipo or '').strip().lower()
+    return 'scadenze' if tipo in ('scadenza', 'scadenze') else tipo
+
+def forme_tipo_asset(tipo_asset):
+    """
+    Tipi asset (minuscolo) accettati da una voce del filtro: la voce stessa e il singolare
+    del plurale italiano (es. "frese" -> "fresa", "torni" -> "torno")
+    """
+    forma = tipo_asset.strip().lower()
+    forme = {forma}
+    if forma.endswith('e'):
+        forme.add(forma[:-1] + 'a')
+    if forma.endswith('i'):
+        forme.add(forma[:-1] + 'o')
+    return forme
+
+class TabellaRouting:
+    """Destinatari Telegram compilati da telegram_chats"""
+
+    def __init__(self, versione, righe):
+        self.versione = versione
+        self.chat = {}              # id riga -> (chat_id, name)
+        self.per_tipo = {}          # tipo canonico -> chat
+        self.senza_tipi = set()     # chat con alert_types vuoto
+        senza_civici, per_civico = set(), {}
+        senza_asset, per_asset = set(), {}
+        self.asset_testuali = {}    # id riga -> voci del filtro asset, per il fallback testuale
+        self.finestre = {}          # chat_id -> finestre di riepilogo configurate
+        self.chat_attive = {}       # chat_id -> (name, civici del filtro), per i comandi del bot
+
+        for riga_id, chat_id, name, alert_types, civici_filter, asset_types, digest_finestre in righe:
+            self.chat[riga_id] = (chat_id, name)
+            self.finestre[chat_id] = leggi_finestre_digest(digest_finestre)
+            tipi = [t for t in (alert_types or '').split(',') if t.strip()]
+            if not tipi:
+                self.senza_tipi.add(riga_id)
+            for tipo in tipi:
+                self.per_tipo.setdefault(tipo_alert_canonico(tipo), set()).add(riga_id)
+
+            civici = [civ.strip() for civ in (civici_filter or '').split(',') if civ.strip()]
+            nome_chat, civici_chat = self.chat_attive.get(chat_id, (name, set()))
+            self.chat_attive[chat_id] = (nome_chat, civici_chat | set(civici))
+            if not civici:
+                senza_civici.add(riga_id)
+            for civico in civici:
+                per_civico.setdefault(civico, set()).add(riga_id)
+
+            voci_asset = [a.strip() for a in (asset_types or '').split(',') if a.strip()]
+            if not voci_asset:
+                senza_asset.add(riga_id)
+            else:
+                self.asset_testuali[riga_id] = [a.lower() for a in voci_asset]
+            for voce in voci_asset:
+                for forma in forme_tipo_asset(voce):
+                    per_asset.setdefault(forma, set()).add(riga_id)
+
+        # Insiemi ammessi già uniti con le chat senza filtro
+        self.senza_civici = frozenset(senza_civici)
+        self.ammessi_civico = {civico: frozenset(ids | senza_civici) for civico, ids in per_civico.items()}
+        self.senza_asset = frozenset(senza_asset)
+        self.ammessi_asset = {forma: frozenset(ids | senza_asset) for forma, ids in per_asset.items()}
+
+    def _risultato(self, ids):
+        # Stesso ordine della tabella telegram_chats
+        return [self.chat[riga_id] for riga_id in sorted(ids)]
+
+    def destinatari_alert(self, alert_data):
+        """Chat (chat_id, name) che devono ricevere l'alert secondo tipi, civici e tipi asset configurati"""
+        ids = self.per_tipo.get(tipo_alert_canonico(alert_data.get('tipo')), frozenset())
+        if ids and alert_data.get('civico'):
+            ids = ids & self.ammessi_civico.get(alert_data['civico'], self.senza_civici)
+        if ids and alert_data.get('asset'):
+            asset_tipo_db = alert_data.get('asset_tipo')
+            if asset_tipo_db:
+                ids = ids & self.ammessi_asset.get(asset_tipo_db.strip().lower(), self.senza_asset)
+            else:
+                # Fallback al vecchio sistema se asset_tipo non è disponibile
+                testo = f"{alert_data.get('titolo') or ''} {alert_data.get('descrizione') or ''}".lower()
+                ids = {riga_id for riga_id in ids
+                       if riga_id in self.senza_asset
+                       or any(voce in testo for voce in self.asset_testuali[riga_id])}
+        return self._risultato(ids)
+
+    def destinatari_notifica_ticket(self):
+        """Chat che hanno "Tickets" nei loro alert_types (o nessun filtro)"""
+        return self._risultato(self.per_tipo.get('tickets', set()) | self.senza_tipi)
+
+    def finestra_digest(self, chat_id, gruppo):
+        """Minuti di riepilogo della chat per il gruppo (0 = invio immediato)"""
+        finestre = self.finestre.get(chat_id, {})
+        return finestre.get(gruppo, DIGEST_FINESTRE_PREDEFINITE.get(gruppo, 0))
+
+class IndiceRouting:
+    """Tabella di routing del processo, ricompilata quando cambia la versione delle chat"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tabella = None
+
+    def compila(self, c):
+        c.execute("SELECT versione FROM telegram_routing_versione WHERE id = 1")
+        versione = c.fetchone()[0]
+        c.execute("""
+            SELECT id, chat_id, name, alert_types, civici_filter, asset_types, digest_finestre
+            FROM telegram_chats WHERE active = 1 ORDER BY id
+        """)
+        tabella = TabellaRouting(versione, c.fetchall())
+        with self._lock:
+            self._tabella = tabella
+        print(f"[TELEGRAM] Tabella di routing compilata (versione {versione}, {len(tabella.chat)} chat)")
+        return tabella
+
+    def corrente(self, c):
+        """Tabella aggiornata: una sola lettura della versione se nulla è cambiato"""
+        tabella = self._tabella
+        if tabella is not None:
+            c.execute("SELECT versione FROM telegram_routing_versione WHERE id = 1")
+            if c.fetchone()[0] == tabella.versione:
+                return tabella
+        return self.compila(c)
+
+    def ricompila(self):
+        conn = sqlite3.connect(DB_PATH)
+        try:
+            return self.compila(conn.cursor())
+        finally:
+            conn.close()
+
+indice_routing = IndiceRouting()
+
+def destinatari_alert(c, alert_data):
+    return indice_routing.corrente(c).destinatari_alert(alert_data)
+
+def destinatari_notifica_ticket(c):
+    return indice_routing.corrente(c).destinatari_notifica_ticket()
+
+# --- RIEPILOGO (DIGEST) ---
+# Per i tipi di alert con una finestra di riepilogo (predefinito: scadenze, 2 minuti) le consegne
+# di una chat non partono subito: aspettano la fine della finestra aperta dal primo alert e
+# vengono unite in un solo messaggio, diviso in parti solo oltre il limite di Telegram.
+# Ticket e non conformità restano immediati salvo diversa configurazione della chat.
+
+DIGEST_FINESTRE_PREDEFINITE = {'scadenze': 2}
+DIGEST_MAX_CONSEGNE = 1000
+TELEGRAM_MAX_CARATTERI = 4096
+
+TITOLI_DIGEST = {
+    'scadenze': "⏰ <b>Riepilogo scadenze GESTMAN</b>",
+    'non_conformita': "🚨 <b>Riepilogo non conformità GESTMAN</b>",
+    'tickets': "🎫 <b>Riepilogo ticket GESTMAN</b>",
+}
+
+def leggi_finestre_digest(valore):
+    """"scadenze:5,tickets:0" -> {'scadenze': 5, 'tickets': 0}"""
+    finestre = {}
+    for voce in (valore or '').split(','):
+        if ':' in voce:
+            gruppo, minuti = voce.split(':', 1)
+            try:
+                finestre[tipo_alert_canonico(gruppo)] = max(int(minuti), 0)
+            except ValueError:
+                continue
+    return finestre
+
+def finestre_digest_effettive(valore):
+    """Finestre della chat completate con i valori predefiniti, per le API"""
+    return {**DIGEST_FINESTRE_PREDEFINITE, **leggi_finestre_digest(valore)}
+
+def normalizza_finestre_digest(valore):
+    """Finestre dal client (dict o stringa) nel formato salvato; ValueError se non valide"""
+    if isinstance(valore, str):
+        valore = {gruppo: minuti for gruppo, minuti in
+                  (voce.split(':', 1) for voce in valore.split(',') if ':' in voce)}
+    if not isinstance(valore, dict):
+        raise ValueError('digest_finestre deve essere un oggetto {tipo: minuti}')
+    voci = []
+    for gruppo, minuti in valore.items():
+        if minuti in (None, ''):
+            continue
+        try:
+            minuti = int(minuti)
+        except (TypeError, ValueError):
+            raise ValueError(f"Finestra di riepilogo non valida per '{gruppo}'")
+        if minuti < 0 or minuti > 1440:
+            raise ValueError(f"Finestra di riepilogo per '{gruppo}' fuori intervallo (0-1440 minuti)")
+        voci.append(f"{tipo_alert_canonico(gruppo)}:{minuti}")
+    return ','.join(voci)
+
+def unisci_finestre_digest(salvate, modifiche):
+    """Applica alle finestre salvate le sole voci inviate dal client; un valore vuoto toglie la voce"""
+    if not isinstance(modifiche, dict):
+        raise ValueError('digest_finestre deve essere un oggetto {tipo: minuti}')
+    finestre = leggi_finestre_digest(salvate)
+    for gruppo, minuti in modifiche.items():
+        finestre.pop(tipo_alert_canonico(gruppo), None)
+    nuove = normalizza_finestre_digest(modifiche)
+    return normalizza_finestre_digest({**finestre, **leggi_finestre_digest(nuove)})
+
+def gruppo_evento(tipo, payload):
+    """Gruppo di riepilogo di un evento della coda (None = sempre immediato)"""
+    if tipo == 'risposta_comando':
+        return None
+    return 'tickets' if tipo == 'notifica_ticket' else tipo_alert_canonico(payload.get('tipo'))
+
+def voce_digest(tipo, payload):
+    """Una voce del riepilogo: riferimenti dell'alert e dettaglio"""
+    riferimenti = []
+    if tipo == 'notifica_ticket' and payload.get('alert_id'):
+        riferimenti.append(f"#{payload['alert_id']}")
+    if payload.get('civico'):
+        riferimenti.append(f"<b>Civico {payload['civico']}</b>")
+    if payload.get('asset'):
+        riferimenti.append(f"Asset {payload['asset']}")
+    voce = "• " + (' · '.join(riferimenti) or "<b>Generale</b>")
+    dettaglio = payload.get('operazione') or payload.get('descrizione')
+    if dettaglio:
+        voce += f"\n   {str(dettaglio)[:300]}"
+    if payload.get('note') and payload['note'] != dettaglio:
+        voce += f"\n   <i>{str(payload['note'])[:300]}</i>"
+    return voce
+
+def componi_digest(gruppo, voci, quando):
+    """
+    Unisce le voci in messaggi entro TELEGRAM_MAX_CARATTERI.
+    Restituisce [(testo, indici delle voci contenute)].
+    """
+    spazio = TELEGRAM_MAX_CARATTERI - 200  # intestazione e data
+    pagine, corrente, lunghezza = [], [], 0
+    for indice, voce in enumerate(voci):
+        if corrente and lunghezza + len(voce) + 2 > spazio:
+            pagine.append(corrente)
+            corrente, lunghezza = [], 0
+        corrente.append(indice)
+        lunghezza += len(voce) + 2
+    if corrente:
+        pagine.append(corrente)
+
+    titolo = TITOLI_DIGEST.get(gruppo, "📋 <b>Riepilogo alert GESTMAN</b>")
+    messaggi = []
+    for numero, pagina in enumerate(pagine, 1):
+        testo = f"{titolo} ({len(voci)} alert)"
+        if len(pagine) > 1:
+            testo += f" · parte {numero}/{len(pagine)}"
+        testo += "\n\n" + "\n\n".join(voci[indice] for indice in pagina)
+        testo += f"\n\n📅 {quando.strftime('%d/%m/%Y %H:%M')}"
+        messaggi.append((testo, pagina))
+    return messaggi
+
+def fine_finestra_digest(c, finestre_aperte, chat_id, gruppo, minuti, adesso):
+    """Fine della finestra di riepilogo aperta per chat e gruppo, o di una nuova che parte ora"""
+    chiave = (chat_id, gruppo)
+    if chiave not in finestre_aperte:
+        c.execute("""
+            SELECT MIN(prossimo_tentativo) FROM telegram_consegne
+            WHERE chat_id = ? AND gruppo_digest = ? AND stato = 'in_coda'
+              AND tentativi = 0 AND prossimo_tentativo > ?
+        """, (chat_id, gruppo, adesso.isoformat()))
+        finestre_aperte[chiave] = c.fetchone()[0] or (adesso + datetime.timedelta(minutes=minuti)).isoformat()
+    return finestre_aperte[chiave]
+
+def leggi_bot_token():
+    return client_telegram.bot_token()
+
+def invia_telegram(bot_token, chat_id, testo):
+    """Invio di una consegna tramite il client condiviso (vedi CLIENT TELEGRAM)"""
+    return client_telegram.send_message(chat_id, testo, bot_token)
+
+def modifica_telegram(bot_token, chat_id, message_id, testo):
+    """Modifica di un messaggio già inviato (consegne di stato_alert)"""
+    return client_telegram.edit_message_text(chat_id, message_id, testo, bot_token)
+
+def smista_outbox(limite=OUTBOX_BATCH):
+    """Trasforma gli eventi in coda in consegne per destinatario; restituisce gli eventi smistati"""
+    conn = sqlite3.connect(OUTBOX_DB_PATH)
+    c = conn.cursor()
+    # Lock di scrittura: un solo worker smista ciascun evento
+    c.execute('BEGIN IMMEDIATE')
+    try:
+        c.execute("SELECT id, tipo, payload, creato_il FROM telegram_outbox WHERE stato = 'in_coda' ORDER BY id LIMIT ?", (limite,))
+        eventi = c.fetchall()
+        if not eventi:
+            conn.rollback()
+            return 0
+
+        bot_configurato = leggi_bot_token() is not None
+        conn_chats = sqlite3.connect(DB_PATH)
+        routing = indice_routing.corrente(conn_chats.cursor())
+        conn_chats.close()
+        ora = datetime.datetime.now()
+        adesso = ora.isoformat()
+        finestre_aperte = {}
+
+        for evento_id, tipo, payload, creato_il in eventi:
+            try:
+                payload = json.loads(payload)
+                quando = datetime.datetime.fromisoformat(creato_il)
+                if not bot_configurato:
+                    print("[TELEGRAM] Bot non configurato, alert non inviato")
+                    c.execute("UPDATE telegram_outbox SET stato = 'ignorato', ultimo_errore = ?, smistato_il = ? WHERE id = ?",
+                              ('Bot non configurato', adesso, evento_id))
                     continue
-            
-            # Controlla filtro tipi asset
-            if asset_types and alert_data.get('asset'):
-                asset_allowed = [a.strip() for a in asset_types.split(',')]
-                print(f"[DEBUG TELEGRAM] - Asset allowed: {asset_allowed}")
-                print(f"[DEBUG TELEGRAM] - Asset: '{alert_data.get('asset')}'")
-                print(f"[DEBUG TELEGRAM] - Asset tipo dal DB: '{alert_data.get('asset_tipo')}'")
-                
-                # Usa il tipo di asset dal database invece del matching testuale
-                asset_tipo_db = alert_data.get('asset_tipo', '')
-                
-                if asset_tipo_db:
-                    # Controlla se il tipo di asset dal DB è nella lista allowed
-                    asset_match = asset_tipo_db in asset_allowed
-                    print(f"[DEBUG TELEGRAM] - Match diretto tipo DB: {asset_match}")
-                    
-                    if not asset_match:
-                        # Fallback: controlla variazioni case-insensitive
-                        asset_tipo_lower = asset_tipo_db.lower()
-                        asset_match = any(allowed.lower() == asset_tipo_lower for allowed in asset_allowed)
-                        print(f"[DEBUG TELEGRAM] - Match case-insensitive: {asset_match}")
-                    
-                    if not asset_match:
-                        # Controlla variazioni singolare/plurale
-                        for allowed in asset_allowed:
-                            allowed_lower = allowed.lower()
-                            
-                            # Test: asset_tipo vs allowed (es. "fresa" vs "frese")
-                            if asset_tipo_lower == allowed_lower:
-                                asset_match = True
-                                break
-                            
-                            # Test: plurale italiano -> singolare (es. "frese" -> "fresa")
-                            if allowed_lower.endswith('se') and asset_tipo_lower == allowed_lower[:-1] + 'a':
-                                asset_match = True
-                                print(f"[DEBUG TELEGRAM] - Match plurale->singolare: '{allowed}' -> '{asset_tipo_db}'")
-                                break
-                            
-                            # Test: singolare -> plurale (es. "fresa" -> "frese")  
-                            if asset_tipo_lower.endswith('a') and allowed_lower == asset_tipo_lower[:-1] + 'e':
-                                asset_match = True
-                                print(f"[DEBUG TELEGRAM] - Match singolare->plurale: '{asset_tipo_db}' -> '{allowed}'")
-                                break
-                            
-                            # Test: plurale maschile (es. "torno" vs "torni")
-                            if allowed_lower.endswith('i') and asset_tipo_lower == allowed_lower[:-1] + 'o':
-                                asset_match = True
-                                print(f"[DEBUG TELEGRAM] - Match plurale maschile->singolare: '{allowed}' -> '{asset_tipo_db}'")
-                                break
-                            
-                            # Test: singolare maschile -> plurale (es. "torno" -> "torni")
-                            if asset_tipo_lower.endswith('o') and allowed_lower == asset_tipo_lower[:-1] + 'i':
-                                asset_match = True
-                                print(f"[DEBUG TELEGRAM] - Match singolare maschile->plurale: '{asset_tipo_db}' -> '{allowed}'")
-                                break
+
+                if tipo == 'stato_alert':
+                    modifiche = smista_stato_alert(c, evento_id, payload['alert_id'], adesso)
+                    if modifiche:
+                        c.execute("UPDATE telegram_outbox SET stato = 'smistato', smistato_il = ? WHERE id = ?",
+                                  (adesso, evento_id))
+                        print(f"[TELEGRAM] Stato alert {payload['alert_id']} ({payload.get('stato')}): {modifiche} messaggi da aggiornare")
+                    else:
+                        c.execute("UPDATE telegram_outbox SET stato = 'ignorato', ultimo_errore = ?, smistato_il = ? WHERE id = ?",
+                                  ('Nessun messaggio da aggiornare', adesso, evento_id))
+                    continue
+
+                if tipo == 'risposta_comando':
+                    # Risposta a un comando del bot: solo alla chat che l'ha inviato
+                    testo = payload['testo']
+                    destinatari = [(payload['chat_id'], payload.get('chat_name'))]
+                elif tipo == 'notifica_ticket':
+                    testo = formatta_notifica_ticket(payload, quando)
+                    destinatari = routing.destinatari_notifica_ticket()
                 else:
-                    # Fallback al vecchio sistema se asset_tipo non è disponibile
-                    print(f"[DEBUG TELEGRAM] - Asset tipo non disponibile, usando fallback testuale")
-                    titolo_lower = alert_data['titolo'].lower()
-                    descrizione_lower = alert_data['descrizione'].lower()
-                    
-                    asset_match = False
-                    for asset_type in asset_allowed:
-                        asset_lower = asset_type.lower()
-                        if asset_lower in titolo_lower or asset_lower in descrizione_lower:
-                            asset_match = True
-                            print(f"[DEBUG TELEGRAM] - Match testuale per '{asset_type}'")
-                            break
-                
-                print(f"[DEBUG TELEGRAM] - Asset match found: {asset_match}")
-                if not asset_match:
-                    print(f"[DEBUG TELEGRAM] - SKIP: Asset type non matching")
+                    testo = formatta_messaggio_alert(payload, quando)
+                    destinatari = routing.destinatari_alert(payload)
+
+                if not destinatari:
+                    print(f"[TELEGRAM] Nessun utente configurato per alert tipo '{payload.get('tipo', tipo)}'")
+                    c.execute("UPDATE telegram_outbox SET stato = 'ignorato', testo = ?, ultimo_errore = ?, smistato_il = ? WHERE id = ?",
+                              (testo, 'Nessun destinatario', adesso, evento_id))
                     continue
-            
-            print(f"[DEBUG TELEGRAM] - Invio messaggio a {name}...")
-            
-            # Invia il messaggio
-            success, result = send_telegram_message(chat_id, message)
-            if success:
-                sent_count += 1
-                print(f"[TELEGRAM] Alert inviato a {name} ({chat_id})")
-                
-                # Log dell'invio
-                conn = sqlite3.connect(DB_PATH)
-                c = conn.cursor()
+
+                gruppo = gruppo_evento(tipo, payload)
+                consegne = []
+                for chat_id, name in destinatari:
+                    minuti = routing.finestra_digest(chat_id, gruppo) if gruppo else 0
+                    if minuti > 0:
+                        fine = fine_finestra_digest(c, finestre_aperte, chat_id, gruppo, minuti, ora)
+                        consegne.append((evento_id, chat_id, name, fine, gruppo))
+                    else:
+                        consegne.append((evento_id, chat_id, name, adesso, None))
+                c.executemany("""
+                    INSERT INTO telegram_consegne (outbox_id, chat_id, chat_name, prossimo_tentativo, gruppo_digest)
+                    VALUES (?, ?, ?, ?, ?)
+                """, consegne)
+                c.execute("UPDATE telegram_outbox SET stato = 'smistato', testo = ?, smistato_il = ? WHERE id = ?",
+                          (testo, adesso, evento_id))
+                print(f"[TELEGRAM] Evento {evento_id} smistato a {len(destinatari)} chat")
+            except Exception as e:
+                print(f"[TELEGRAM] Errore smistamento evento {evento_id}: {e}")
+                c.execute("SELECT alert_id, tentativi FROM telegram_outbox WHERE id = ?", (evento_id,))
+                alert_id, tentativi = c.fetchone()
+                if tentativi + 1 >= OUTBOX_MAX_TENTATIVI:
+                    registra_dead_letter(c, [(f"evento:{evento_id}", evento_id, None, alert_id, tipo,
+                                              None, None, None, tentativi + 1, str(e), adesso)])
                 c.execute("""
-                    INSERT INTO telegram_logs (chat_id, message, status, sent_at)
-                    VALUES (?, ?, ?, ?)
-                """, (chat_id, message, 'sent', datetime.datetime.now().isoformat()))
-                conn.commit()
-                conn.close()
+                    UPDATE telegram_outbox
+                    SET tentativi = tentativi + 1, ultimo_errore = ?,
+                        stato = CASE WHEN tentativi + 1 >= ? THEN 'errore' ELSE stato END
+                    WHERE id = ?
+                """, (str(e), OUTBOX_MAX_TENTATIVI, evento_id))
+
+        conn.commit()
+        return len(eventi)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+def smista_stato_alert(c, evento_id, alert_id, adesso):
+    """
+    Una consegna di modifica per ogni messaggio dell'alert già inviato o ancora in coda
+    (i riepiloghi restano com'erano); le modifiche precedenti non ancora partite sono sostituite
+    """
+    c.execute("""
+        SELECT d.id, d.chat_id, d.chat_name FROM telegram_consegne d
+        JOIN telegram_outbox o ON o.id = d.outbox_id
+        WHERE o.alert_id = ? AND o.tipo != 'stato_alert' AND d.gruppo_digest IS NULL
+          AND d.stato IN ('inviato', 'in_coda', 'in_invio')
+        ORDER BY d.id
+    """, (alert_id,))
+    originali = c.fetchall()
+    if not originali:
+        return 0
+    c.execute(f"""
+        UPDATE telegram_consegne SET stato = 'sostituito'
+        WHERE stato = 'in_coda' AND consegna_origine IN ({','.join('?' * len(originali))})
+    """, tuple(originale[0] for originale in originali))
+    c.executemany("""
+        INSERT INTO telegram_consegne (outbox_id, chat_id, chat_name, prossimo_tentativo, consegna_origine)
+        VALUES (?, ?, ?, ?, ?)
+    """, [(evento_id, chat_id, chat_name, adesso, consegna_id) for consegna_id, chat_id, chat_name in originali])
+    return len(originali)
+
+def registra_dead_letter(c, voci):
+    """
+    Mette in dead letter consegne o eventi che hanno esaurito i tentativi: voci = [(riferimento,
+    outbox_id, consegna_id, alert_id, tipo, chat_id, chat_name, testo, tentativi, errore, quando)].
+    Una voce già riprovata torna in attesa.
+    """
+    c.executemany("""
+        INSERT INTO telegram_dead_letter
+            (riferimento, outbox_id, consegna_id, alert_id, tipo, chat_id, chat_name, testo, tentativi, ultimo_errore, creato_il)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(riferimento) DO UPDATE SET
+            stato = 'in_attesa', testo = excluded.testo, tentativi = excluded.tentativi,
+            ultimo_errore = excluded.ultimo_errore, creato_il = excluded.creato_il
+    """, voci)
+    for voce in voci:
+        print(f"[TELEGRAM] In dead letter {voce[0]} ({voce[6] or 'evento'}): {voce[9]}")
+
+def bucket_limite(chat_id):
+    """Bucket (chiave, intervallo, capacità) che un invio a chat_id deve rispettare"""
+    # chat_id negativo = gruppo, supergruppo o canale
+    intervallo_chat = TELEGRAM_INTERVALLO_GRUPPO_SECONDI if str(chat_id).startswith('-') else TELEGRAM_INTERVALLO_CHAT_SECONDI
+    return [
+        ('globale', 1.0 / TELEGRAM_LIMITE_GLOBALE_PER_SECONDO, TELEGRAM_CAPACITA_GLOBALE),
+        (f"chat:{chat_id}", intervallo_chat, 1),
+    ]
+
+def prenota_slot(tat, chat_id, adesso):
+    """
+    Primo istante (epoch) in cui si può inviare a chat_id. Se cade entro l'orizzonte di
+    prenotazione consuma i token aggiornando tat (dict chiave -> tat) e restituisce (slot, True).
+    """
+    bucket = bucket_limite(chat_id)
+    slot = adesso
+    for chiave, intervallo, capacita in bucket:
+        slot = max(slot, tat.get(chiave, 0.0) - intervallo * (capacita - 1))
+    if slot > adesso + TELEGRAM_ORIZZONTE_PRENOTAZIONE_SECONDI:
+        return slot, False
+    for chiave, intervallo, capacita in bucket:
+        tat[chiave] = max(tat.get(chiave, 0.0), slot) + intervallo
+    return slot, True
+
+def sostituisci_modifiche_superate(c, adesso):
+    """
+    Una modifica di stato rimessa in coda (429, backoff, lease scaduto) non deve partire dopo
+    una più recente dello stesso messaggio: se ne esiste una, la vecchia è sostituita
+    """
+    c.execute("""
+        UPDATE telegram_consegne SET stato = 'sostituito', lease_fino = NULL
+        WHERE consegna_origine IS NOT NULL
+          AND (stato = 'in_coda' OR (stato = 'in_invio' AND lease_fino < ?))
+          AND EXISTS (SELECT 1 FROM telegram_consegne recente
+                      WHERE recente.consegna_origine = telegram_consegne.consegna_origine
+                        AND recente.id > telegram_consegne.id)
+    """, (adesso.isoformat(),))
+
+def attendi_messaggi_originali(c, immediate, adesso):
+    """
+    Le modifiche di stato partono solo dopo il messaggio originale: se non è ancora stato
+    inviato la modifica aspetta, se è fallito non c'è nulla da modificare. Aspetta anche una
+    modifica dello stesso messaggio ancora in invio, così l'ultima resta l'ultima applicata.
+    """
+    pronte, rimandate, annullate = [], [], []
+    for consegna in immediate:
+        if consegna[8] == 'stato_alert' and consegna[14]:
+            rimandate.append(((adesso + datetime.timedelta(seconds=OUTBOX_ATTESA_SECONDI)).isoformat(), consegna[0]))
+        elif consegna[8] != 'stato_alert' or consegna[10] is not None:
+            pronte.append(consegna)
+        elif consegna[11] in ('in_coda', 'in_invio'):
+            rimandate.append(((adesso + datetime.timedelta(seconds=OUTBOX_ATTESA_SECONDI)).isoformat(), consegna[0]))
+        else:
+            annullate.append((adesso.isoformat(), consegna[0]))
+    c.executemany("UPDATE telegram_consegne SET stato = 'in_coda', lease_fino = NULL, prossimo_tentativo = ? WHERE id = ?",
+                  rimandate)
+    c.executemany("""
+        UPDATE telegram_consegne SET stato = 'ignorato', lease_fino = NULL, prossimo_tentativo = ?,
+               ultimo_errore = 'Messaggio originale non consegnato'
+        WHERE id = ?
+    """, annullate)
+    return pronte
+
+def prepara_invii(immediate, differite, adesso):
+    """
+    Raggruppa le consegne in invii: uno per ogni consegna immediata e, per le differite,
+    i messaggi di riepilogo per chat e gruppo (una sola consegna in attesa parte col suo testo).
+    """
+    invii = []
+    for consegna in immediate:
+        invio = {'consegne': [consegna], 'chat_id': consegna[2], 'chat_name': consegna[3], 'testo': consegna[5]}
+        if consegna[8] == 'stato_alert':
+            # Modifica del messaggio originale invece di un nuovo invio
+            invio['testo'] = formatta_stato_alert(consegna[12], json.loads(consegna[9]))
+            invio['message_id'] = consegna[10]
+        invii.append(invio)
+    gruppi = {}
+    for consegna in differite:
+        gruppi.setdefault((consegna[2], consegna[7]), []).append(consegna)
+    for (chat_id, gruppo), consegne in gruppi.items():
+        if len(consegne) == 1:
+            invii.append({'consegne': consegne, 'chat_id': chat_id, 'chat_name': consegne[0][3], 'testo': consegne[0][5]})
+            continue
+        voci = [voce_digest(consegna[8], json.loads(consegna[9])) for consegna in consegne]
+        for testo, pagina in componi_digest(gruppo, voci, adesso):
+            invii.append({'consegne': [consegne[indice] for indice in pagina], 'chat_id': chat_id,
+                          'chat_name': consegne[0][3], 'testo': testo})
+    return invii
+
+def reclama_consegne(limite=OUTBOX_BATCH):
+    """
+    Prende in carico (lease) le consegne dovute, incluse quelle con lease scaduto, le raggruppa
+    in invii (vedi RIEPILOGO) e prenota per ciascun invio lo slot nei token bucket. Gli invii
+    senza slot entro l'orizzonte restano in coda con prossimo_tentativo spostato al primo slot
+    libero. Restituisce gli invii (dict con consegne, chat_id, chat_name, testo e slot epoch).
+    """
+    conn = sqlite3.connect(OUTBOX_DB_PATH)
+    c = conn.cursor()
+    c.execute('BEGIN IMMEDIATE')
+    try:
+        adesso = datetime.datetime.now()
+        sostituisci_modifiche_superate(c, adesso)
+        # Per le modifiche di stato anche il messaggio originale (message_id, stato, testo ed
+        # evento) e se una modifica precedente dello stesso messaggio è ancora in invio
+        sql = """
+            SELECT d.id, d.outbox_id, d.chat_id, d.chat_name, d.tentativi, o.testo, o.alert_id,
+                   d.gruppo_digest, o.tipo, o.payload,
+                   COALESCE(d.message_id, orig.message_id), orig.stato, oo.testo, orig.outbox_id,
+                   d.consegna_origine IS NOT NULL AND EXISTS (
+                       SELECT 1 FROM telegram_consegne prec
+                       WHERE prec.consegna_origine = d.consegna_origine AND prec.id < d.id
+                         AND prec.stato = 'in_invio')
+            FROM telegram_consegne d
+            JOIN telegram_outbox o ON o.id = d.outbox_id
+            LEFT JOIN telegram_consegne orig ON orig.id = d.consegna_origine
+            LEFT JOIN telegram_outbox oo ON oo.id = orig.outbox_id
+            WHERE ((d.stato = 'in_coda' AND d.prossimo_tentativo <= ?)
+                   OR (d.stato = 'in_invio' AND d.lease_fino < ?))
+              AND d.gruppo_digest IS {} NULL
+            ORDER BY d.prossimo_tentativo, d.id
+            LIMIT ?
+        """
+        c.execute(sql.format(''), (adesso.isoformat(), adesso.isoformat(), limite))
+        immediate = c.fetchall()
+        immediate = attendi_messaggi_originali(c, immediate, adesso)
+        # I riepiloghi vanno presi interi: limite più ampio
+        c.execute(sql.format('NOT'), (adesso.isoformat(), adesso.isoformat(), DIGEST_MAX_CONSEGNE))
+        differite = c.fetchall()
+        if not immediate and not differite:
+            # Conferma le modifiche rimandate o annullate da attendi_messaggi_originali
+            conn.commit()
+            return []
+        invii = prepara_invii(immediate, differite, adesso)
+
+        chiavi = {'globale'} | {f"chat:{invio['chat_id']}" for invio in invii}
+        segnaposti = ','.join('?' * len(chiavi))
+        c.execute(f"SELECT chiave, tat FROM telegram_limiti WHERE chiave IN ({segnaposti})", tuple(chiavi))
+        tat = dict(c.fetchall())
+
+        ora = adesso.timestamp()
+        prenotati = []
+        lease = (adesso + datetime.timedelta(seconds=OUTBOX_LEASE_SECONDI)).isoformat()
+        in_invio = []
+        rimandate = []
+        for invio in invii:
+            slot, prenotato = prenota_slot(tat, invio['chat_id'], ora)
+            if prenotato:
+                invio['slot'] = slot
+                prenotati.append(invio)
+                in_invio.extend((lease, consegna[0]) for consegna in invio['consegne'])
             else:
-                print(f"[TELEGRAM] Errore invio a {name} ({chat_id}): {result}")
-        
-        print(f"[TELEGRAM] Alert inviato a {sent_count} utenti")
-        return sent_count > 0
-        
-    except Exception as e:
-        print(f"[TELEGRAM] Errore durante invio alert: {str(e)}")
-        return False
+                prossimo = datetime.datetime.fromtimestamp(slot).isoformat()
+                rimandate.extend((prossimo, consegna[0]) for consegna in invio['consegne'])
 
-# --- FUNZIONE INVIO NOTIFICA TICKET ---
-def send_ticket_notification(alert_id, titolo, descrizione, operatore, civico=None, asset=None):
-    """Invia notifica Telegram per nuovo ticket"""
+        c.executemany("UPDATE telegram_consegne SET stato = 'in_invio', lease_fino = ? WHERE id = ?", in_invio)
+        c.executemany("UPDATE telegram_consegne SET stato = 'in_coda', lease_fino = NULL, prossimo_tentativo = ? WHERE id = ?",
+                      rimandate)
+        c.executemany("""
+            INSERT INTO telegram_limiti (chiave, tat) VALUES (?, ?)
+            ON CONFLICT(chiave) DO UPDATE SET tat = excluded.tat
+        """, list(tat.items()))
+        conn.commit()
+        if rimandate:
+            print(f"[TELEGRAM] Limite di invio: {len(rimandate)} consegne rimandate")
+        return prenotati
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+def registra_esiti(esiti):
+    """Scrive gli esiti degli invii sulle loro consegne: inviato, nuovo tentativo con backoff o errore definitivo"""
+    adesso = datetime.datetime.now()
+    aggiornamenti = []
+    log_inviati = []
+    log_modificati = {}  # outbox_id del messaggio originale -> testo aggiornato
+    dead_letter = []
+    limiti = []
+    for invio, esito in esiti:
+        chat_id, chat_name = invio['chat_id'], invio['chat_name']
+        descrizione = f"Riepilogo di {len(invio['consegne'])} alert" if len(invio['consegne']) > 1 else "Alert"
+        if esito.get('retry_after') is not None:
+            # 429: Telegram indica quando riprovare; non è un tentativo fallito e la chat resta
+            # bloccata fino ad allora anche per le altre consegne
+            riprova = adesso + datetime.timedelta(seconds=esito['retry_after'])
+            aggiornamenti.extend(('in_coda', consegna[4], riprova.isoformat(), esito['errore'], None, None, consegna[0])
+                                 for consegna in invio['consegne'])
+            limiti.append((f"chat:{chat_id}", riprova.timestamp()))
+            print(f"[TELEGRAM] Limite Telegram per {chat_name} ({chat_id}), nuovo invio tra {esito['retry_after']:.1f}s")
+            continue
+        if esito['ok']:
+            if invio.get('message_id'):
+                descrizione = "Messaggio aggiornato"
+                # Lo storico mostra il messaggio originale con il suo stato attuale
+                log_modificati[invio['consegne'][0][13]] = invio['testo']
+            print(f"[TELEGRAM] {descrizione} inviato a {chat_name} ({chat_id})")
+        for consegna in invio['consegne']:
+            consegna_id, outbox_id, chat_id, chat_name, tentativi, testo, alert_id = consegna[:7]
+            tentativi += 1
+            if esito['ok']:
+                aggiornamenti.append(('inviato', tentativi, adesso.isoformat(), None, adesso.isoformat(),
+                                      esito.get('message_id'), consegna_id))
+                # Risposte ai comandi e modifiche di stato non sono nuovi messaggi nello storico
+                if consegna[8] not in ('risposta_comando', 'stato_alert'):
+                    log_inviati.append((outbox_id, alert_id, consegna[8], consegna[9], testo, chat_id, adesso.isoformat()))
+            elif esito.get('permanente') or tentativi >= OUTBOX_MAX_TENTATIVI:
+                aggiornamenti.append(('errore', tentativi, adesso.isoformat(), esito['errore'], None, None, consegna_id))
+                dead_letter.append((f"consegna:{consegna_id}", outbox_id, consegna_id, alert_id, consegna[8],
+                                    chat_id, chat_name, invio['testo'], tentativi, esito['errore'], adesso.isoformat()))
+                print(f"[TELEGRAM] Errore definitivo invio a {chat_name} ({chat_id}): {esito['errore']}")
+            else:
+                attesa = min(OUTBOX_BACKOFF_BASE_SECONDI * 2 ** (tentativi - 1), OUTBOX_BACKOFF_MAX_SECONDI)
+                prossimo = (adesso + datetime.timedelta(seconds=attesa)).isoformat()
+                aggiornamenti.append(('in_coda', tentativi, prossimo, esito['errore'], None, None, consegna_id))
+                print(f"[TELEGRAM] Errore invio a {chat_name} ({chat_id}), nuovo tentativo tra {attesa}s: {esito['errore']}")
+
+    conn = sqlite3.connect(OUTBOX_DB_PATH)
+    conn.executemany("""
+        UPDATE telegram_consegne
+        SET stato = ?, tentativi = ?, prossimo_tentativo = ?, ultimo_errore = ?, inviato_il = ?,
+            message_id = COALESCE(?, message_id), lease_fino = NULL
+        WHERE id = ?
+    """, aggiornamenti)
+    conn.executemany("""
+        INSERT INTO telegram_limiti (chiave, tat) VALUES (?, ?)
+        ON CONFLICT(chiave) DO UPDATE SET tat = MAX(tat, excluded.tat)
+    """, limiti)
+    if dead_letter:
+        registra_dead_letter(conn.cursor(), dead_letter)
+    conn.commit()
+    conn.close()
+
+    if log_inviati:
+        registra_log_inviati(log_inviati)
+    if log_modificati:
+        registra_log_modificati(log_modificati)
+
+_esecutore_invii = None
+_esecutore_pid = None
+_esecutore_lock = threading.Lock()
+
+def esecutore_invii():
+    """Pool di thread per gli invii, uno per processo (ricreato dopo il fork)"""
+    global _esecutore_invii, _esecutore_pid
+    with _esecutore_lock:
+        if _esecutore_invii is None or _esecutore_pid != os.getpid():
+            _esecutore_invii = ThreadPoolExecutor(max_workers=OUTBOX_INVII_PARALLELI, thread_name_prefix='telegram-invio')
+            _esecutore_pid = os.getpid()
+        return _esecutore_invii
+
+def elabora_outbox():
+    """
+    Un ciclo del worker: smista gli eventi nuovi e consegna un blocco di messaggi dovuti.
+    Gli invii partono in parallelo (al massimo OUTBOX_INVII_PARALLELI), ciascuno al proprio
+    slot del rate limiter; gli esiti vengono scritti tutti insieme alla fine del blocco.
+    """
+    lavorati = smista_outbox()
+    invii = reclama_consegne()
+    if invii:
+        bot_token = leggi_bot_token()
+        bloccate = {}  # chat_id -> epoch fino a cui Telegram ha chiesto di non inviare (429)
+        lock_bloccate = threading.Lock()
+
+        def esegui(invio):
+            attesa = invio['slot'] - time.time()
+            if attesa > 0:
+                time.sleep(attesa)
+            chat_id = invio['chat_id']
+            if not bot_token:
+                return {'ok': False, 'errore': 'Bot non configurato', 'permanente': False}
+            with lock_bloccate:
+                bloccata_fino = bloccate.get(chat_id, 0)
+            if bloccata_fino > time.time():
+                return {'ok': False, 'errore': 'Limite Telegram', 'permanente': False,
+                        'retry_after': bloccata_fino - time.time()}
+            if invio.get('message_id'):
+                esito = modifica_telegram(bot_token, chat_id, invio['message_id'], invio['testo'])
+            else:
+                esito = invia_telegram(bot_token, chat_id, invio['testo'])
+            if esito.get('retry_after') is not None:
+                with lock_bloccate:
+                    bloccate[chat_id] = max(bloccate.get(chat_id, 0), time.time() + esito['retry_after'])
+            return esito
+
+        # In ordine di slot, così i primi thread liberi vanno agli invii più urgenti
+        invii.sort(key=lambda invio: invio['slot'])
+        futuri = [(invio, esecutore_invii().submit(esegui, invio)) for invio in invii]
+        esiti = []
+        for invio, futuro in futuri:
+            try:
+                esiti.append((invio, futuro.result()))
+            except Exception as e:
+                esiti.append((invio, {'ok': False, 'errore': f"Errore: {str(e)}", 'permanente': False}))
+        registra_esiti(esiti)
+    return lavorati + sum(len(invio['consegne']) for invio in invii)
+
+def secondi_alla_prossima_consegna():
+    """Attesa fino alla prima consegna in coda (retry, backoff o slot), al massimo OUTBOX_ATTESA_SECONDI"""
     try:
-        # Crea il messaggio
-        message = f"🎫 <b>NUOVO TICKET</b>\n"
-        message += f"📌 <b>ID:</b> #{alert_id}\n"
-        message += f"👤 <b>Operatore:</b> {operatore}\n\n"
-        
-        if civico:
-            message += f"🏠 <b>Civico:</b> {civico}\n"
-        if asset:
-            message += f"🔧 <b>Asset:</b> {asset}\n"
-            
-        message += f"\n📝 <b>Descrizione:</b>\n{descrizione}\n"
-        message += f"\n📅 <i>{datetime.datetime.now().strftime('%d/%m/%Y %H:%M')}</i>"
-        
-        # Trova le chat che hanno "Tickets" nei loro alert_types
-        conn = sqlite3.connect(DB_PATH)
+        conn = sqlite3.connect(OUTBOX_DB_PATH)
+        prossimo = conn.execute("SELECT MIN(prossimo_tentativo) FROM telegram_consegne WHERE stato = 'in_coda'").fetchone()[0]
+        conn.close()
+    except sqlite3.Error:
+        return OUTBOX_ATTESA_SECONDI
+    if not prossimo:
+        return OUTBOX_ATTESA_SECONDI
+    attesa = (datetime.datetime.fromisoformat(prossimo) - datetime.datetime.now()).total_seconds()
+    return min(max(attesa, 0.05), OUTBOX_ATTESA_SECONDI)
+
+_sveglia_worker = threading.Event()
+_worker_lock = threading.Lock()
+_worker_thread = None
+_comandi_thread = None
+_worker_pid = None
+
+def ciclo_worker_telegram(ferma=None):
+    """Esegue il worker finché ferma (threading.Event) non viene impostato"""
+    ultima_archiviazione = 0.0
+    while ferma is None or not ferma.is_set():
+        try:
+            lavorati = elabora_outbox()
+            # Conservazione dei log: una passata al giorno per processo
+            if time.time() - ultima_archiviazione > 86400:
+                ultima_archiviazione = time.time()
+                archivia_log_telegram()
+        except Exception as e:
+            print(f"[TELEGRAM] Errore worker: {e}")
+            lavorati = 0
+        if not lavorati:
+            _sveglia_worker.wait(secondi_alla_prossima_consegna())
+            _sveglia_worker.clear()
+
+def avvia_worker_telegram():
+    """Avvia il thread worker nel processo corrente (una volta per pid, anche dopo il fork dei worker gunicorn)"""
+    global _worker_thread, _comandi_thread, _worker_pid
+    if TELEGRAM_WORKER_MODALITA != 'thread':
+        return
+    if _worker_pid == os.getpid() and _worker_thread is not None and _worker_thread.is_alive():
+        return
+    with _worker_lock:
+        if _worker_pid == os.getpid() and _worker_thread is not None and _worker_thread.is_alive():
+            return
+        _worker_thread = threading.Thread(target=ciclo_worker_telegram, name='telegram-outbox', daemon=True)
+        _worker_thread.start()
+        if BOT_COMANDI_ATTIVI:
+            # Ogni processo prova a fare da poller; il lease ne lascia attivo uno solo
+            _comandi_thread = threading.Thread(target=ciclo_comandi_telegram, name='telegram-comandi', daemon=True)
+            _comandi_thread.start()
+        _worker_pid = os.getpid()
+
+@bp.before_app_request
+def assicura_worker_telegram():
+    # Al primo accesso di ogni processo riprende anche le consegne rimaste in coda
+    avvia_worker_telegram()
+
+# --- COMANDI DEL BOT ---
+# I tecnici interrogano il bot direttamente in chat: /oggi, /scadenze <civico>, /ticket <id>,
+# /scorte. Gli aggiornamenti arrivano in long polling (getUpdates) da un thread del worker,
+# mai dalle richieste HTTP del backend; il lease in telegram_polling lascia un solo poller
+# attivo tra tutti i processi e conserva l'offset. Le risposte si leggono da un modello in
+# memoria ricalcolato al più ogni BOT_MODELLO_TTL_SECONDI (nessuna query pesante per comando)
+# e partono dalla coda di invio come eventi 'risposta_comando', con gli stessi limiti e
+# tentativi degli alert. Rispondono solo le chat registrate e attive.
+
+BOT_COMANDI_ATTIVI = os.getenv('GESTMAN_TELEGRAM_COMANDI', '1') != '0'
+BOT_POLL_TIMEOUT_SECONDI = 25
+BOT_POLL_LEASE_SECONDI = BOT_POLL_TIMEOUT_SECONDI + 30
+BOT_POLL_PAUSA_SECONDI = 10
+BOT_MODELLO_TTL_SECONDI = 60
+BOT_GIORNI_SCADENZE = 7
+BOT_GIORNI_TICKET_CHIUSI = 7
+BOT_MAX_RIGHE = 30
+
+STATI_TICKET = {
+    'aperto': "🔴 aperto",
+    'in_carico': "🟠 in carico",
+    'chiuso': "✅ chiuso",
+}
+
+def data_leggibile(valore):
+    """'2025-09-05 14:30:00' -> '05/09/2025 14:30' (il valore originale se non è una data)"""
+    try:
+        return datetime.datetime.fromisoformat(str(valore).replace(' ', 'T')).strftime('%d/%m/%Y %H:%M')
+    except ValueError:
+        return str(valore)
+
+class ModelloComandi:
+    """Dati letti dai comandi del bot, ricalcolati in blocco con tre query"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._dati = None
+        self._calcolato = 0.0
+
+    def calcola(self):
+        oggi = datetime.date.today()
+        conn = sqlite3.connect(OUTBOX_DB_PATH)
         c = conn.cursor()
+        try:
+            # Scadenze scadute e dei prossimi giorni (idx_scadenze_stato_data)
+            c.execute("""
+                SELECT s.data_scadenza, s.civico, s.asset, COALESCE(cl.nome_voce, m.nome_manutenzione)
+                FROM scadenze_calendario s
+                LEFT JOIN manutenzione_programmata_checklist cl ON s.checklist_voce_id = cl.id
+                LEFT JOIN manutenzione_tipologie m ON s.manutenzione_id = m.id
+                WHERE s.stato = 'programmata' AND s.data_scadenza <= ?
+                ORDER BY s.data_scadenza, s.civico, s.asset
+            """, ((oggi + datetime.timedelta(days=BOT_GIORNI_SCADENZE)).isoformat(),))
+            scadenze, per_civico = [], {}
+            for data_scadenza, civico, asset, operazione in c.fetchall():
+                try:
+                    giorno = datetime.date.fromisoformat(str(data_scadenza)[:10])
+                except ValueError:
+                    continue
+                voce = (giorno, str(civico or '').strip(), asset, operazione)
+                scadenze.append(voce)
+                per_civico.setdefault(voce[1].lower(), []).append(voce)
+
+            # Ticket aperti o in carico e quelli chiusi di recente
+            limite_chiusi = datetime.datetime.now() - datetime.timedelta(days=BOT_GIORNI_TICKET_CHIUSI)
+            c.execute("""
+                SELECT id, titolo, stato, civico, asset, data_creazione, data_chiusura, operatore
+                FROM alert
+                WHERE tipo = 'Tickets' AND (stato IN ('aperto', 'in_carico') OR data_chiusura >= ?)
+                ORDER BY id
+            """, (limite_chiusi.strftime('%Y-%m-%d %H:%M:%S'),))
+            ticket = {riga[0]: riga for riga in c.fetchall()}
+
+            # Ricambi attivi sotto la scorta minima
+            c.execute("""
+                SELECT asset_tipo, id_ricambio, costruttore, modello, quantita_disponibile, quantita_minima, unita_misura
+                FROM magazzino_ricambi
+                WHERE attivo = 1 AND quantita_disponibile <= quantita_minima
+                ORDER BY asset_tipo, id_ricambio
+            """)
+            scorte = c.fetchall()
+        finally:
+            conn.close()
+        return {
+            'oggi': oggi,
+            'scadenze': scadenze,
+            'per_civico': per_civico,
+            'ticket': ticket,
+            'scorte': scorte,
+            'calcolato_il': datetime.datetime.now(),
+        }
+
+    def corrente(self):
+        """Modello aggiornato; se il ricalcolo fallisce restano i dati precedenti"""
+        with self._lock:
+            if self._dati is None or time.time() - self._calcolato > BOT_MODELLO_TTL_SECONDI:
+                try:
+                    self._dati = self.calcola()
+                except sqlite3.Error as e:
+                    print(f"[TELEGRAM] Errore aggiornamento dati dei comandi: {e}")
+                    if self._dati is None:
+                        raise
+                self._calcolato = time.time()
+            return self._dati
+
+modello_comandi = ModelloComandi()
+
+def testo_risposta(intestazione, righe, dati, vuoto):
+    """Intestazione e righe entro il limite di Telegram, con l'ora dei dati in fondo"""
+    piede = f"\n\n<i>Dati aggiornati alle {dati['calcolato_il'].strftime('%H:%M')}</i>"
+    if not righe:
+        return f"{intestazione}\n\n{vuoto}{piede}"
+    spazio = TELEGRAM_MAX_CARATTERI - len(intestazione) - len(piede) - 50
+    mostrate, lunghezza = [], 0
+    for riga in righe[:BOT_MAX_RIGHE]:
+        if lunghezza + len(riga) + 1 > spazio:
+            break
+        mostrate.append(riga)
+        lunghezza += len(riga) + 1
+    corpo = "\n".join(mostrate)
+    if len(mostrate) < len(righe):
+        corpo += f"\n… e altre {len(righe) - len(mostrate)}"
+    return f"{intestazione}\n\n{corpo}{piede}"
+
+def riga_scadenza(voce, oggi):
+    giorno, civico, asset, operazione = voce
+    simbolo = "🔴" if giorno < oggi else ("🟠" if giorno == oggi else "🟢")
+    riga = f"{simbolo} {giorno.strftime('%d/%m')} · Civico {html.escape(civico)}"
+    if asset:
+        riga += f" · {html.escape(str(asset))}"
+    if operazione:
+        riga += f"\n      {html.escape(str(operazione)[:80])}"
+    return riga
+
+def civico_ammesso(civico, civici):
+    """True se la chat non filtra per civico o il civico è tra i suoi (senza distinguere maiuscole)"""
+    return not civici or str(civico or '').strip().lower() in {civ.lower() for civ in civici}
+
+def comando_oggi(dati, argomento, civici):
+    """Scadenze di oggi e già scadute, limitate ai civici della chat se filtrati"""
+    oggi = dati['oggi']
+    voci = [voce for voce in dati['scadenze'] if voce[0] <= oggi and civico_ammesso(voce[1], civici)]
+    scadute = sum(1 for voce in voci if voce[0] < oggi)
+    intestazione = f"📅 <b>Scadenze di oggi</b> ({len(voci) - scadute})"
+    if scadute:
+        intestazione += f" · <b>{scadute} scadute</b>"
+    return testo_risposta(intestazione, [riga_scadenza(voce, oggi) for voce in voci], dati,
+                          "Nessuna scadenza per oggi ✅")
+
+def comando_scadenze(dati, argomento, civici):
+    """Scadenze del civico: scadute e dei prossimi BOT_GIORNI_SCADENZE giorni (solo civici della chat)"""
+    civico = argomento or (next(iter(civici)) if len(civici) == 1 else '')
+    if not civico:
+        return "Uso: /scadenze &lt;civico&gt;\nEsempio: /scadenze 148"
+    if not civico_ammesso(civico, civici):
+        return (f"Il civico {html.escape(civico)} non è tra quelli di questa chat "
+                f"({html.escape(', '.join(sorted(civici)))})")
+    voci = dati['per_civico'].get(civico.strip().lower(), [])
+    intestazione = f"🗓 <b>Scadenze civico {html.escape(civico)}</b> (prossimi {BOT_GIORNI_SCADENZE} giorni)"
+    return testo_risposta(intestazione, [riga_scadenza(voce, dati['oggi']) for voce in voci], dati,
+                          "Nessuna scadenza in programma ✅")
+
+def ticket_da_database(ticket_id):
+    """Ticket fuori dal modello (chiuso da tempo): lettura per chiave primaria"""
+    conn = sqlite3.connect(OUTBOX_DB_PATH)
+    try:
+        return conn.execute("""
+            SELECT id, titolo, stato, civico, asset, data_creazione, data_chiusura, operatore
+            FROM alert WHERE id = ? AND tipo = 'Tickets'
+        """, (ticket_id,)).fetchone()
+    finally:
+        conn.close()
+
+def comando_ticket(dati, argomento, civici):
+    """Stato di un ticket; senza id l'elenco dei ticket aperti e in carico (solo civici della chat)"""
+    if not argomento:
+        aperti = [riga for riga in dati['ticket'].values()
+                  if riga[2] != 'chiuso' and civico_ammesso(riga[3], civici)]
+        righe = [f"{STATI_TICKET.get(stato, stato)} #{ticket_id} · {html.escape(str(titolo or ''))}"
+                 for ticket_id, titolo, stato, *_ in aperti]
+        return testo_risposta(f"🎫 <b>Ticket aperti</b> ({len(aperti)})", righe, dati, "Nessun ticket aperto ✅")
+
+    try:
+        ticket_id = int(argomento.lstrip('#'))
+    except ValueError:
+        return "Uso: /ticket &lt;id&gt;\nEsempio: /ticket 42"
+    riga = dati['ticket'].get(ticket_id) or ticket_da_database(ticket_id)
+    # I ticket di altri civici non si mostrano (né se ne conferma l'esistenza)
+    if riga is None or not civico_ammesso(riga[3], civici):
+        return f"Ticket #{ticket_id} non trovato"
+    ticket_id, titolo, stato, civico, asset, data_creazione, data_chiusura, operatore = riga
+    righe = [html.escape(str(titolo or ''))]
+    if civico:
+        righe.append(f"🏢 Civico {html.escape(str(civico))}")
+    if asset:
+        righe.append(f"🔧 Asset {html.escape(str(asset))}")
+    if data_creazione:
+        righe.append(f"🕐 Aperto il {data_leggibile(data_creazione)}"
+                     + (f" da {html.escape(str(operatore))}" if operatore else ""))
+    if stato == 'chiuso' and data_chiusura:
+        righe.append(f"✅ Chiuso il {data_leggibile(data_chiusura)}")
+    return testo_risposta(f"🎫 <b>Ticket #{ticket_id}</b> — {STATI_TICKET.get(stato, html.escape(str(stato)))}",
+                          righe, dati, "")
+
+def comando_scorte(dati, argomento, civici):
+    """Ricambi sotto la scorta minima, filtrabili per tipo di asset"""
+    voci = [riga for riga in dati['scorte'] if not argomento or argomento.lower() in str(riga[0] or '').lower()]
+    righe = []
+    for asset_tipo, id_ricambio, costruttore, modello, disponibile, minima, unita in voci:
+        descrizione = ' '.join(str(parte) for parte in (costruttore, modello) if parte)
+        riga = f"• {html.escape(str(asset_tipo))} · <b>{html.escape(str(id_ricambio))}</b>"
+        if descrizione:
+            riga += f" ({html.escape(descrizione)})"
+        riga += f": {disponibile}/{minima} {html.escape(str(unita or 'pz'))}"
+        righe.append(riga)
+    return testo_risposta(f"📦 <b>Ricambi sotto scorta</b> ({len(voci)})", righe, dati,
+                          "Tutte le scorte sono sopra il minimo ✅")
+
+def comando_aiuto(dati, argomento, civici):
+    return ("🤖 <b>Comandi GESTMAN</b>\n\n"
+            "/oggi – scadenze di oggi e scadute\n"
+            f"/scadenze &lt;civico&gt; – scadenze del civico nei prossimi {BOT_GIORNI_SCADENZE} giorni\n"
+            "/ticket &lt;id&gt; – stato di un ticket (senza id: ticket aperti)\n"
+            "/scorte [tipo asset] – ricambi sotto la scorta minima")
+
+COMANDI_BOT = {
+    'oggi': comando_oggi,
+    'scadenze': comando_scadenze,
+    'ticket': comando_ticket,
+    'scorte': comando_scorte,
+    'start': comando_aiuto,
+    'aiuto': comando_aiuto,
+    'help': comando_aiuto,
+}
+
+def rispondi_aggiornamento(aggiornamento, routing, dati):
+    """Risposta (chat_id, chat_name, comando, testo) a un aggiornamento di getUpdates, o None"""
+    messaggio = aggiornamento.get('message') or {}
+    testo = (messaggio.get('text') or '').strip()
+    chat_id = str((messaggio.get('chat') or {}).get('id') or '')
+    if not chat_id or not testo.startswith('/'):
+        return None
+    parti = testo.split()
+    # Nei gruppi i comandi arrivano come /oggi@nome_bot
+    comando = parti[0][1:].split('@', 1)[0].lower()
+    argomento = ' '.join(parti[1:]).strip()
+
+    chat = routing.chat_attive.get(chat_id)
+    if chat is None:
+        # Nessuna risposta alle chat non registrate: il chat_id resta nel log per abilitarla
+        print(f"[TELEGRAM] Comando /{comando} ignorato da chat non registrata {chat_id}")
+        return None
+    chat_name, civici = chat
+    gestore = COMANDI_BOT.get(comando, comando_aiuto)
+    return chat_id, chat_name, comando, gestore(dati, argomento, civici)
+
+def acquisisci_polling(proprietario):
+    """Prende o rinnova il lease del poller; restituisce l'offset di getUpdates, None se è di un altro processo"""
+    conn = sqlite3.connect(OUTBOX_DB_PATH)
+    try:
+        c = conn.cursor()
+        c.execute('BEGIN IMMEDIATE')
+        c.execute("SELECT proprietario, lease_fino, offset_aggiornamenti FROM telegram_polling WHERE id = 1")
+        attuale, lease_fino, offset = c.fetchone()
+        adesso = time.time()
+        if attuale != proprietario and lease_fino > adesso:
+            conn.rollback()
+            return None
+        c.execute("UPDATE telegram_polling SET proprietario = ?, lease_fino = ? WHERE id = 1",
+                  (proprietario, adesso + BOT_POLL_LEASE_SECONDI))
+        conn.commit()
+        if attuale != proprietario:
+            print(f"[TELEGRAM] Poller dei comandi attivo nel processo {os.getpid()}")
+        return offset
+    finally:
+        conn.close()
+
+def registra_aggiornamenti(proprietario, offset, risposte):
+    """Accoda le risposte e avanza l'offset nella stessa transazione; False se il lease è stato perso"""
+    conn = sqlite3.connect(OUTBOX_DB_PATH)
+    try:
+        c = conn.cursor()
+        c.execute('BEGIN IMMEDIATE')
+        c.execute("UPDATE telegram_polling SET offset_aggiornamenti = ? WHERE id = 1 AND proprietario = ?",
+                  (offset, proprietario))
+        if c.rowcount == 0:
+            # Un altro processo ha preso il lease e risponderà lui a questi aggiornamenti
+            conn.rollback()
+            return False
+        for chat_id, chat_name, comando, testo in risposte:
+            accoda_evento_telegram('risposta_comando', {
+                'chat_id': chat_id, 'chat_name': chat_name, 'comando': comando, 'testo': testo
+            }, cursor=c)
+        conn.commit()
+        return True
+    finally:
+        conn.close()
+
+def ciclo_comandi_telegram(ferma=None):
+    """Long polling dei comandi del bot finché ferma (threading.Event) non viene impostato"""
+    ferma = ferma or threading.Event()
+    proprietario = f"{os.getpid()}-{threading.get_ident()}"
+    while not ferma.is_set():
+        try:
+            offset = acquisisci_polling(proprietario)
+            bot_token = leggi_bot_token() if offset is not None else None
+            if not bot_token:
+                ferma.wait(BOT_POLL_PAUSA_SECONDI)
+                continue
+            # Il modello si ricalcola qui, tra un long poll e l'altro, non alla ricezione del comando
+            dati = modello_comandi.corrente()
+            response = client_telegram.chiama('getUpdates', bot_token, {
+                'offset': offset,
+                'timeout': BOT_POLL_TIMEOUT_SECONDI,
+                'allowed_updates': ['message'],
+            }, timeout=BOT_POLL_TIMEOUT_SECONDI + TELEGRAM_TIMEOUT_SECONDI)
+            if response.status_code == 409:
+                print("[TELEGRAM] getUpdates in conflitto: webhook impostato o altro poller sullo stesso bot")
+                ferma.wait(BOT_POLL_PAUSA_SECONDI)
+                continue
+            if response.status_code != 200:
+                print(f"[TELEGRAM] Errore getUpdates HTTP {response.status_code}")
+                ferma.wait(BOT_POLL_PAUSA_SECONDI)
+                continue
+            aggiornamenti = response.json().get('result') or []
+            if not aggiornamenti:
+                continue
+
+            conn_chats = sqlite3.connect(DB_PATH)
+            routing = indice_routing.corrente(conn_chats.cursor())
+            conn_chats.close()
+            risposte = []
+            for aggiornamento in aggiornamenti:
+                try:
+                    risposta = rispondi_aggiornamento(aggiornamento, routing, dati)
+                except Exception as e:
+                    print(f"[TELEGRAM] Errore comando bot (update {aggiornamento.get('update_id')}): {e}")
+                    continue
+                if risposta:
+                    risposte.append(risposta)
+            nuovo_offset = max(aggiornamento['update_id'] for aggiornamento in aggiornamenti) + 1
+            if registra_aggiornamenti(proprietario, nuovo_offset, risposte) and risposte:
+                print(f"[TELEGRAM] {len(risposte)} risposte ai comandi accodate")
+                _sveglia_worker.set()
+        except Exception as e:
+            print(f"[TELEGRAM] Errore poller comandi: {e}")
+            ferma.wait(BOT_POLL_PAUSA_SECONDI)
+
+@bp.route('/outbox', methods=['GET'])
+def get_outbox_status():
+    """
+    Stato della coda Telegram: eventi e consegne per stato, ritardo della più vecchia in coda,
+    consegne dovute e loro ritardo, bucket ancora in attesa (secondi al prossimo slot), consegne
+    trattenute per i riepiloghi, poller dei comandi del bot, ultimi errori
+    """
+    try:
+        conn = sqlite3.connect(OUTBOX_DB_PATH)
+        c = conn.cursor()
+        c.execute("SELECT stato, COUNT(*) FROM telegram_outbox GROUP BY stato")
+        eventi = dict(c.fetchall())
+        c.execute("SELECT stato, COUNT(*) FROM telegram_consegne GROUP BY stato")
+        consegne = dict(c.fetchall())
         c.execute("""
-            SELECT name, chat_id FROM telegram_chats 
-            WHERE active = 1 AND (alert_types LIKE '%Tickets%' OR alert_types = '')
+            SELECT MIN(creato_il) FROM telegram_outbox WHERE stato = 'in_coda'
         """)
-        
-        chats = c.fetchall()
+        evento_piu_vecchio = c.fetchone()[0]
+        c.execute("""
+            SELECT MIN(o.creato_il)
+            FROM telegram_consegne d JOIN telegram_outbox o ON o.id = d.outbox_id
+            WHERE d.stato IN ('in_coda', 'in_invio')
+        """)
+        consegna_piu_vecchia = c.fetchone()[0]
+        c.execute("""
+            SELECT MIN(prossimo_tentativo), COUNT(*) FROM telegram_consegne
+            WHERE stato = 'in_coda' AND prossimo_tentativo <= ?
+        """, (datetime.datetime.now().isoformat(),))
+        prima_dovuta, consegne_dovute = c.fetchone()
+        c.execute("""
+            SELECT COUNT(*), MIN(prossimo_tentativo) FROM telegram_consegne
+            WHERE stato = 'in_coda' AND gruppo_digest IS NOT NULL AND prossimo_tentativo > ?
+        """, (datetime.datetime.now().isoformat(),))
+        in_riepilogo, prossimo_riepilogo = c.fetchone()
+        c.execute("SELECT chiave, tat FROM telegram_limiti WHERE tat > ? ORDER BY tat DESC LIMIT 20", (time.time(),))
+        limiti_attivi = {chiave: round(tat - time.time(), 1) for chiave, tat in c.fetchall()}
+        c.execute("""
+            SELECT d.id, d.outbox_id, d.chat_name, d.chat_id, d.stato, d.tentativi, d.ultimo_errore, d.prossimo_tentativo
+            FROM telegram_consegne d
+            WHERE d.ultimo_errore IS NOT NULL AND d.stato != 'inviato'
+            ORDER BY d.id DESC LIMIT 20
+        """)
+        errori = [{
+            'id': r[0], 'outbox_id': r[1], 'chat_name': r[2], 'chat_id': r[3], 'stato': r[4],
+            'tentativi': r[5], 'errore': r[6], 'prossimo_tentativo': r[7]
+        } for r in c.fetchall()]
+        c.execute("SELECT proprietario, lease_fino, offset_aggiornamenti FROM telegram_polling WHERE id = 1")
+        proprietario, lease_poller, offset_poller = c.fetchone()
+        c.execute("SELECT COUNT(*) FROM telegram_dead_letter WHERE stato = 'in_attesa'")
+        dead_letter = c.fetchone()[0]
         conn.close()
-        
-        sent_count = 0
-        
-        for name, chat_id in chats:
-            success, result = send_telegram_message(chat_id, message)
-            if success:
-                sent_count += 1
-                print(f"[TELEGRAM] Ticket inviato a {name} ({chat_id})")
-                
-                # Log dell'invio
-                conn = sqlite3.connect(DB_PATH)
-                c = conn.cursor()
-                c.execute("""
-                    INSERT INTO telegram_logs (chat_id, message, status, sent_at, alert_id)
-                    VALUES (?, ?, ?, ?, ?)
-                """, (chat_id, message, 'sent', datetime.datetime.now().isoformat(), alert_id))
-                conn.commit()
-                conn.close()
-            else:
-                print(f"[TELEGRAM] Errore invio ticket a {name} ({chat_id}): {result}")
-        
-        print(f"[TELEGRAM] Ticket inviato a {sent_count} utenti")
-        return sent_count > 0
-        
+
+        piu_vecchio = min([t for t in (evento_piu_vecchio, consegna_piu_vecchia) if t], default=None)
+        ritardo = None
+        if piu_vecchio:
+            ritardo = round((datetime.datetime.now() - datetime.datetime.fromisoformat(piu_vecchio)).total_seconds(), 1)
+
+        # Ritardo di consegna: da quanto la consegna dovuta più vecchia aspetta il worker
+        ritardo_consegne = None
+        if prima_dovuta:
+            ritardo_consegne = round((datetime.datetime.now() - datetime.datetime.fromisoformat(prima_dovuta)).total_seconds(), 1)
+
+        return jsonify({
+            'eventi': eventi,
+            'consegne': consegne,
+            'ritardo_secondi': ritardo,
+            'consegne_dovute': consegne_dovute,
+            'ritardo_consegne_secondi': ritardo_consegne,
+            'limiti_attivi': limiti_attivi,
+            'in_riepilogo': in_riepilogo,
+            'prossimo_riepilogo': prossimo_riepilogo,
+            'worker': TELEGRAM_WORKER_MODALITA,
+            'poller_comandi': {
+                'attivo': BOT_COMANDI_ATTIVI and lease_poller > time.time(),
+                'proprietario': proprietario,
+                'offset': offset_poller
+            },
+            'dead_letter': dead_letter,
+            'errori_recenti': errori
+        })
     except Exception as e:
-        print(f"[TELEGRAM] Errore durante invio ticket: {str(e)}")
-        return False
+        print(f"[TELEGRAM] Errore stato outbox: {e}")
+        return jsonify({'error': str(e)}), 500
+
+# --- DEAD LETTER ---
+# Consegne ed eventi che hanno esaurito i tentativi (o con errore definitivo) restano in
+# telegram_dead_letter finché un amministratore non li riprova o li scarta.
+
+def riprova_dead_letter(ids=None):
+    """Rimette in coda le voci in attesa (tutte o quelle indicate); restituisce quante"""
+    conn = sqlite3.connect(OUTBOX_DB_PATH)
+    c = conn.cursor()
+    c.execute('BEGIN IMMEDIATE')
+    try:
+        sql = "SELECT id, outbox_id, consegna_id FROM telegram_dead_letter WHERE stato = 'in_attesa'"
+        if ids is not None:
+            if not ids:
+                conn.rollback()
+                return 0
+            sql += f" AND id IN ({','.join('?' * len(ids))})"
+        c.execute(sql, tuple(ids or ()))
+        voci = c.fetchall()
+        adesso = datetime.datetime.now().isoformat()
+        c.executemany("""
+            UPDATE telegram_consegne
+            SET stato = 'in_coda', tentativi = 0, prossimo_tentativo = ?, ultimo_errore = NULL, lease_fino = NULL
+            WHERE id = ? AND stato = 'errore'
+        """, [(adesso, consegna_id) for _, _, consegna_id in voci if consegna_id is not None])
+        # Il messaggio riprovato deve mostrare lo stato attuale dell'alert: torna in coda anche
+        # l'ultima modifica annullata perché l'originale non era stato consegnato
+        c.executemany("""
+            UPDATE telegram_consegne SET stato = 'in_coda', prossimo_tentativo = ?, ultimo_errore = NULL
+            WHERE id = (SELECT MAX(id) FROM telegram_consegne WHERE consegna_origine = ? AND stato = 'ignorato')
+        """, [(adesso, consegna_id) for _, _, consegna_id in voci if consegna_id is not None])
+        c.executemany("""
+            UPDATE telegram_outbox SET stato = 'in_coda', tentativi = 0, ultimo_errore = NULL
+            WHERE id = ? AND stato = 'errore'
+        """, [(outbox_id,) for _, outbox_id, consegna_id in voci if consegna_id is None])
+        c.executemany("""
+            UPDATE telegram_dead_letter SET stato = 'riprovato', riprovato_il = ?, ripetizioni = ripetizioni + 1
+            WHERE id = ?
+        """, [(adesso, voce[0]) for voce in voci])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    if voci:
+        print(f"[TELEGRAM] {len(voci)} voci della dead letter rimesse in coda")
+        avvia_worker_telegram()
+        _sveglia_worker.set()
+    return len(voci)
+
+@bp.route('/dead-letter', methods=['GET'])
+def get_dead_letter():
+    """Voci della dead letter (predefinito: in attesa; ?stato=tutti per lo storico)"""
+    try:
+        stato = request.args.get('stato', 'in_attesa')
+        conn = sqlite3.connect(OUTBOX_DB_PATH)
+        c = conn.cursor()
+        sql = """
+            SELECT id, riferimento, outbox_id, consegna_id, alert_id, tipo, chat_id, chat_name,
+                   testo, tentativi, ultimo_errore, stato, creato_il, riprovato_il, ripetizioni
+            FROM telegram_dead_letter
+        """
+        if stato == 'tutti':
+            c.execute(sql + " ORDER BY id DESC LIMIT 200")
+        else:
+            c.execute(sql + " WHERE stato = ? ORDER BY id DESC LIMIT 200", (stato,))
+        voci = [{
+            'id': r[0], 'riferimento': r[1], 'outbox_id': r[2], 'consegna_id': r[3], 'alert_id': r[4],
+            'tipo': r[5], 'chat_id': r[6], 'chat_name': r[7], 'anteprima': anteprima_messaggio(r[8]),
+            'tentativi': r[9], 'errore': r[10], 'stato': r[11], 'creato_il': r[12],
+            'riprovato_il': r[13], 'ripetizioni': r[14]
+        } for r in c.fetchall()]
+        c.execute("SELECT stato, COUNT(*) FROM telegram_dead_letter GROUP BY stato")
+        conteggi = dict(c.fetchall())
+        conn.close()
+        return jsonify({'voci': voci, 'conteggi': conteggi})
+    except Exception as e:
+        print(f"[TELEGRAM] Errore lettura dead letter: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@bp.route('/dead-letter/replay', methods=['POST'])
+def replay_dead_letter():
+    """Riprova le voci indicate ({"ids": [...]}) o, senza ids, tutte quelle in attesa"""
+    try:
+        data = request.get_json(silent=True) or {}
+        ids = data.get('ids')
+        if ids is not None and (not isinstance(ids, list) or not all(isinstance(i, int) for i in ids)):
+            return jsonify({'error': 'ids deve essere una lista di interi'}), 400
+        riprovate = riprova_dead_letter(ids)
+        return jsonify({'success': True, 'riprovate': riprovate})
+    except Exception as e:
+        print(f"[TELEGRAM] Errore replay dead letter: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@bp.route('/dead-letter/<int:voce_id>/replay', methods=['POST'])
+def replay_voce_dead_letter(voce_id):
+    try:
+        if not riprova_dead_letter([voce_id]):
+            return jsonify({'error': 'Voce non trovata o non in attesa'}), 404
+        return jsonify({'success': True, 'riprovate': 1})
+    except Exception as e:
+        print(f"[TELEGRAM] Errore replay dead letter: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@bp.route('/dead-letter/<int:voce_id>', methods=['DELETE'])
+def scarta_voce_dead_letter(voce_id):
+    """Scarta una voce: resta nello storico come 'scartato' e non viene più proposta"""
+    try:
+        conn = sqlite3.connect(OUTBOX_DB_PATH)
+        c = conn.cursor()
+        c.execute("UPDATE telegram_dead_letter SET stato = 'scartato' WHERE id = ? AND stato = 'in_attesa'", (voce_id,))
+        if c.rowcount == 0:
+            conn.close()
+            return jsonify({'error': 'Voce non trovata o non in attesa'}), 404
+        conn.commit()
+        conn.close()
+        return jsonify({'success': True})
+    except Exception as e:
+        print(f"[TELEGRAM] Errore scarto dead letter: {e}")
+        return jsonify({'error': str(e)}), 500
 
 @bp.route('/asset-types', methods=['GET'])
 def get_asset_types_for_telegram():
@@ -662,47 +2345,25 @@ def get_user_messages(username):
         
         chat_id = user_chat[0]
         
-        # Recupera gli ultimi messaggi inviati a questo utente
+        # Ultimi recapiti della chat (indice idx_telegram_recapiti_chat) con tipo e anteprima già pronti
         c.execute("""
-            SELECT id, alert_id, message, sent_at, status
-            FROM telegram_logs 
-            WHERE chat_id = ? AND status = 'sent'
-            ORDER BY sent_at DESC
+            SELECT m.id, m.alert_id, m.anteprima, r.sent_at, m.message_type
+            FROM telegram_recapiti r
+            JOIN telegram_messaggi m ON m.id = r.messaggio_id
+            WHERE r.chat_id = ? AND r.status = 'sent'
+            ORDER BY r.sent_at DESC
             LIMIT ?
         """, (chat_id, limit))
         
-        rows = c.fetchall()
+        messages = [{
+            'id': row[0],
+            'alert_id': row[1],
+            'message': row[2],
+            'timestamp': row[3],
+            'type': row[4]
+        } for row in c.fetchall()]
         conn.close()
         
-        messages = []
-        for row in rows:
-            log_id, alert_id, message, sent_at, status = row
-            
-            # Parse del messaggio per estrarre info
-            message_type = 'alert'
-            if '🎫' in message:
-                message_type = 'ticket'
-            elif '⏰' in message or 'Scadenz' in message:
-                message_type = 'scadenza'
-            elif '🚨' in message:
-                message_type = 'non_conformita'
-            
-            # Rimuovi HTML tags per il display nel widget
-            clean_message = message.replace('<b>', '').replace('</b>', '')
-            clean_message = clean_message.replace('<i>', '').replace('</i>', '')
-            
-            # Tronca il messaggio se troppo lungo per il widget
-            if len(clean_message) > 100:
-                clean_message = clean_message[:97] + '...'
-            
-            messages.append({
-                'id': log_id,
-                'alert_id': alert_id,
-                'message': clean_message,
-                'timestamp': sent_at,
-                'type': message_type
-            })
-        
         return jsonify({
             'messages': messages,
             'enabled': True
@@ -710,7 +2371,7 @@ def get_user_messages(username):
         
     except Exception as e:
         print(f"[TELEGRAM] Errore recupero messaggi utente {username}: {e}")
-        return jsonify({'error': str(e)}, 500)
+        return jsonify({'error': str(e)}), 500
 
 @bp.route('/message/<int:message_id>/full', methods=['GET'])
 def get_full_message(message_id):
@@ -720,9 +2381,9 @@ def get_full_message(message_id):
         c = conn.cursor()
         
         c.execute("""
-            SELECT id, alert_id, message, sent_at, status, chat_id
-            FROM telegram_logs 
-            WHERE id = ? AND status = 'sent'
+            SELECT id, alert_id, testo, creato_il, message_type
+            FROM telegram_messaggi
+            WHERE id = ?
         """, (message_id,))
         
         row = c.fetchone()
@@ -731,27 +2392,14 @@ def get_full_message(message_id):
         if not row:
             return jsonify({'error': 'Messaggio non trovato'}), 404
         
-        log_id, alert_id, message, sent_at, status, chat_id = row
-        
-        # Parse del messaggio per estrarre info
-        message_type = 'alert'
-        if '🎫' in message:
-            message_type = 'ticket'
-        elif '⏰' in message or 'Scadenz' in message:
-            message_type = 'scadenza'
-        elif '🚨' in message:
-            message_type = 'non_conformita'
-        
-        # Rimuovi HTML tags per il display
-        clean_message = message.replace('<b>', '').replace('</b>', '')
-        clean_message = clean_message.replace('<i>', '').replace('</i>', '')
+        messaggio_id, alert_id, testo, creato_il, message_type = row
         
         return jsonify({
-            'id': log_id,
+            'id': messaggio_id,
             'alert_id': alert_id,
-            'message': clean_message,  # Messaggio completo senza troncature
-            'full_message': message,   # Messaggio originale con HTML tags
-            'timestamp': sent_at,
+            'message': testo_pulito(testo),  # Messaggio completo senza troncature
+            'full_message': testo,           # Messaggio originale con HTML tags
+            'timestamp': creato_il,
             'type': message_type
         })
         
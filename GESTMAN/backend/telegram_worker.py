@@ -0,0 +1,48 @@
+# coding: utf-8
+"""
+Worker dedicato per la coda Telegram (vedi "CODA DI INVIO" in telegram_manager.py).
+
+Uso:
+    python telegram_worker.py              # gira finché non viene fermato
+    python telegram_worker.py --una-volta  # svuota quanto è dovuto ora ed esce
+
+Con il worker dedicato il backend va avviato con GESTMAN_TELEGRAM_WORKER=esterno,
+così i processi web si limitano ad accodare. Lo stesso processo riceve anche i comandi
+del bot in long polling (disattivabili con GESTMAN_TELEGRAM_COMANDI=0).
+"""
+import os
+import sys
+import signal
+import threading
+
+# Questo processo è il worker: niente thread aggiuntivo all'import del modulo
+os.environ['GESTMAN_TELEGRAM_WORKER'] = 'esterno'
+
+import telegram_manager
+
+
+def main():
+    if '--una-volta' in sys.argv:
+        totale = 0
+        while True:
+            lavorati = telegram_manager.elabora_outbox()
+            if not lavorati:
+                break
+            totale += lavorati
+        print(f"[TELEGRAM WORKER] Elaborati {totale} elementi")
+        return
+
+    ferma = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: ferma.set())
+    signal.signal(signal.SIGINT, lambda *_: ferma.set())
+    if telegram_manager.BOT_COMANDI_ATTIVI:
+        # Comandi del bot in long polling accanto al worker della coda
+        threading.Thread(target=telegram_manager.ciclo_comandi_telegram, args=(ferma,),
+                         name='telegram-comandi', daemon=True).start()
+    print("[TELEGRAM WORKER] Avviato")
+    telegram_manager.ciclo_worker_telegram(ferma)
+    print("[TELEGRAM WORKER] Fermato")
+
+
+if __name__ == '__main__':
+    main()
@@ -147,6 +147,16 @@ autostart=true
 autorestart=true
 redirect_stderr=true
 stdout_logfile=/var/log/gestman.log
+environment=PATH="/home/$USER/gestman-app/backend/venv/bin",GESTMAN_TELEGRAM_WORKER="esterno"
+
+[program:gestman-telegram]
+command=/home/$USER/gestman-app/backend/venv/bin/python telegram_worker.py
+directory=/home/$USER/gestman-app/backend
+user=$USER
+autostart=true
+autorestart=true
+redirect_stderr=true
+stdout_logfile=/var/log/gestman-telegram.log
 environment=PATH="/home/$USER/gestman-app/backend/venv/bin"
 EOF
 
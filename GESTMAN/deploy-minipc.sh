@@ -135,6 +135,16 @@ autostart=true
 autorestart=true
 redirect_stderr=true
 stdout_logfile=/var/log/gestman.log
+environment=GESTMAN_TELEGRAM_WORKER="esterno"
+
+[program:gestman-telegram]
+command=$HOME/gestman-app/backend/venv/bin/python telegram_worker.py
+directory=$HOME/gestman-app/backend
+user=$USER
+autostart=true
+autorestart=true
+redirect_stderr=true
+stdout_logfile=/var/log/gestman-telegram.log
 EOF
 
 # Sicurezza base
@@ -7,6 +7,189 @@ self.addEventListener('activate', (event) => {
   event.waitUntil(self.clients.claim());
 });
 
+// --- CODA OFFLINE (OUTBOX) ---
+// Ogni completamento o compilazione riceve una chiave di idempotenza prima del primo
+// tentativo, inviata nell'header Idempotency-Key. Se manca la rete (o la risposta si perde
+// dopo che il server ha già applicato l'operazione) l'operazione viene salvata in IndexedDB
+// con la stessa chiave e spedita in blocco a /api/calendario/sync appena torna la rete.
+// Il backend ignora le chiavi già applicate, quindi un reinvio non duplica nulla.
+
+const OUTBOX_DB = 'gestman-outbox';
+const OUTBOX_STORE = 'operazioni';
+const OUTBOX_SYNC_TAG = 'gestman-outbox';
+const OUTBOX_MAX_BATCH = 500; // stesso limite di SYNC_MAX_OPERAZIONI nel backend
+const SYNC_PATH = '/api/calendario/sync';
+const HEADER_CHIAVE = 'Idempotency-Key';
+
+// Endpoint accodabili -> tipo di operazione per /sync
+const OPERAZIONI_ACCODABILI = {
+  '/api/calendario/completa-scadenza': 'completa-scadenza',
+  '/api/calendario/completa-gruppo': 'completa-gruppo',
+  '/api/dynamic-forms/submissions': 'form-submission'
+};
+
+const apriOutbox = () => new Promise((resolve, reject) => {
+  const richiesta = indexedDB.open(OUTBOX_DB, 1);
+  richiesta.onupgradeneeded = () => {
+    richiesta.result.createObjectStore(OUTBOX_STORE, { keyPath: 'idempotency_key' });
+  };
+  richiesta.onsuccess = () => resolve(richiesta.result);
+  richiesta.onerror = () => reject(richiesta.error);
+});
+
+const transazioneOutbox = async (modalita, operazione) => {
+  const db = await apriOutbox();
+  try {
+    return await new Promise((resolve, reject) => {
+      const tx = db.transaction(OUTBOX_STORE, modalita);
+      const risultato = operazione(tx.objectStore(OUTBOX_STORE));
+      tx.oncomplete = () => resolve(risultato && 'result' in risultato ? risultato.result : undefined);
+      tx.onerror = () => reject(tx.error);
+    });
+  } finally {
+    db.close();
+  }
+};
+
+const generaChiave = () => (
+  self.crypto && self.crypto.randomUUID
+    ? self.crypto.randomUUID()
+    : `${Date.now()}-${Math.random().toString(16).slice(2)}`
+);
+
+const accoda = async (origin, tipo, payload, chiave) => {
+  const operazione = {
+    idempotency_key: chiave,
+    tipo,
+    payload,
+    origin,
+    creato_il: new Date().toISOString()
+  };
+  await transazioneOutbox('readwrite', (store) => store.put(operazione));
+  // Background Sync dove disponibile; altrimenti si svuota al primo fetch riuscito o su messaggio
+  if (self.registration.sync) {
+    try {
+      await self.registration.sync.register(OUTBOX_SYNC_TAG);
+    } catch (err) {
+      console.log('[SW] Background sync non disponibile:', err);
+    }
+  }
+  return operazione;
+};
+
+const notificaClient = async (messaggio) => {
+  const clients = await self.clients.matchAll({ includeUncontrolled: true });
+  clients.forEach((client) => client.postMessage(messaggio));
+};
+
+let svuotamentoInCorso = null;
+
+const svuotaOutbox = () => {
+  // Un solo svuotamento alla volta: evita invii concorrenti della stessa coda
+  if (!svuotamentoInCorso) {
+    svuotamentoInCorso = eseguiSvuotamento().finally(() => {
+      svuotamentoInCorso = null;
+    });
+  }
+  return svuotamentoInCorso;
+};
+
+const eseguiSvuotamento = async () => {
+  const operazioni = await transazioneOutbox('readonly', (store) => store.getAll());
+  if (!operazioni || operazioni.length === 0) return;
+
+  // Un invio per backend (in sviluppo le API possono stare su un'origine diversa)
+  const perOrigine = {};
+  operazioni
+    .sort((a, b) => a.creato_il.localeCompare(b.creato_il))
+    .forEach((op) => {
+      (perOrigine[op.origin] = perOrigine[op.origin] || []).push(op);
+    });
+
+  let applicate = 0;
+  const scartate = [];
+
+  for (const [origin, coda] of Object.entries(perOrigine)) {
+    for (let i = 0; i < coda.length; i += OUTBOX_MAX_BATCH) {
+      const blocco = coda.slice(i, i + OUTBOX_MAX_BATCH);
+      const response = await fetch(origin + SYNC_PATH, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({
+          operazioni: blocco.map(({ idempotency_key, tipo, payload }) => ({ idempotency_key, tipo, payload }))
+        })
+      });
+      if (!response.ok) {
+        // Errore del server: la coda resta intatta e verrà ritentata
+        throw new Error(`Sync fallita: HTTP ${response.status}`);
+      }
+      const esito = await response.json();
+
+      // Applicate (2xx, anche già applicate al primo tentativo), duplicate e rifiutate (400)
+      // escono dalla coda; le altre restano
+      const riuscita = (r) => r.status >= 200 && r.status < 300;
+      const completate = esito.risultati
+        .filter((r) => riuscita(r) || r.status === 400)
+        .map((r) => r.idempotency_key);
+      esito.risultati
+        .filter((r) => r.status === 400)
+        .forEach((r) => scartate.push({ ...r, operazione: blocco.find((op) => op.idempotency_key === r.idempotency_key) }));
+      applicate += esito.risultati.filter(riuscita).length;
+
+      await transazioneOutbox('readwrite', (store) => {
+        completate.forEach((chiave) => store.delete(chiave));
+      });
+    }
+  }
+
+  console.log(`[SW] Outbox sincronizzata: ${applicate} operazioni, ${scartate.length} rifiutate`);
+  await notificaClient({ tipo: 'outbox-sincronizzata', applicate, scartate });
+};
+
+self.addEventListener('sync', (event) => {
+  if (event.tag === OUTBOX_SYNC_TAG) {
+    event.waitUntil(svuotaOutbox());
+  }
+});
+
+self.addEventListener('message', (event) => {
+  if (event.data && event.data.tipo === 'svuota-outbox') {
+    event.waitUntil(svuotaOutbox().catch((err) => console.log('[SW] Outbox non sincronizzata:', err)));
+  }
+});
+
+const inviaOAccoda = async (request, tipo) => {
+  const url = new URL(request.url);
+  const corpo = await request.clone().text();
+  // La chiave nasce prima del primo tentativo: se il server applica l'operazione ma la
+  // risposta si perde, il reinvio dalla coda usa la stessa chiave e non la ripete
+  const chiave = request.headers.get(HEADER_CHIAVE) || generaChiave();
+  const headers = new Headers(request.headers);
+  headers.set(HEADER_CHIAVE, chiave);
+  try {
+    const response = await fetch(new Request(request, { headers, body: corpo }));
+    // La rete funziona: prova a spedire anche quanto rimasto in coda
+    svuotaOutbox().catch(() => {});
+    return response;
+  } catch (err) {
+    // Nessuna rete: accoda e rispondi come se l'operazione fosse stata presa in carico
+    let payload;
+    try {
+      payload = JSON.parse(corpo);
+    } catch (parseErr) {
+      throw err;
+    }
+    const operazione = await accoda(url.origin, tipo, payload, chiave);
+    return new Response(JSON.stringify({
+      ok: true,
+      success: true,
+      queued: true,
+      idempotency_key: operazione.idempotency_key,
+      message: 'Salvato offline: verrà sincronizzato appena torna la connessione'
+    }), { status: 202, headers: { 'Content-Type': 'application/json' } });
+  }
+};
+
 // Gestisce SPA routing
 self.addEventListener('fetch', (event) => {
   if (event.request.mode === 'navigate') {
@@ -15,5 +198,13 @@ self.addEventListener('fetch', (event) => {
         return caches.match('/') || fetch('/');
       })
     );
+    return;
+  }
+
+  if (event.request.method === 'POST') {
+    const tipo = OPERAZIONI_ACCODABILI[new URL(event.request.url).pathname];
+    if (tipo) {
+      event.respondWith(inviaOAccoda(event.request, tipo));
+    }
   }
-});
\ No newline at end of file
+});
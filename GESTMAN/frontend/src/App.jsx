@@ -39,6 +39,30 @@ function App() {
         .catch((error) => {
           console.log('SW registrazione fallita:', error);
         });
+
+      // Al ritorno della rete chiede al SW di inviare le operazioni salvate offline
+      // (serve dove il Background Sync non è supportato, es. Safari iOS)
+      const svuotaOutbox = () => {
+        if (navigator.serviceWorker.controller) {
+          navigator.serviceWorker.controller.postMessage({ tipo: 'svuota-outbox' });
+        }
+      };
+      const onMessaggioSW = (event) => {
+        if (event.data && event.data.tipo === 'outbox-sincronizzata') {
+          console.log('Operazioni offline sincronizzate:', event.data);
+          if (event.data.scartate && event.data.scartate.length > 0) {
+            alert(`${event.data.scartate.length} operazioni salvate offline sono state rifiutate dal server:\n` +
+              event.data.scartate.map((s) => s.risposta && s.risposta.error).join('\n'));
+          }
+        }
+      };
+      window.addEventListener('online', svuotaOutbox);
+      navigator.serviceWorker.addEventListener('message', onMessaggioSW);
+      svuotaOutbox();
+      return () => {
+        window.removeEventListener('online', svuotaOutbox);
+        navigator.serviceWorker.removeEventListener('message', onMessaggioSW);
+      };
     }
   }, []);
 
@@ -306,7 +330,7 @@ function AppContent({ user, onLogout }) {
               <Route path="/dynamic-compiler" element={<DynamicCompiler username={user.username} />} />
             )}
             {userSections.includes('alert') && (
-              <Route path="/alert" element={<AlertScreen />} />
+              <Route path="/alert" element={<AlertScreen username={user.username} />} />
             )}
             {userSections.includes('rubrica') && (
               <Route path="/rubrica" element={<Rubrica />} />
@@ -10,7 +10,7 @@ const AlertTabs = [
   { key: "Tickets", label: "Tickets" },
 ];
 
-const AlertScreen = () => {
+const AlertScreen = ({ username }) => {
   const [activeTab, setActiveTab] = useState("non_conformita");
   const [alerts, setAlerts] = useState([]);
   const [loading, setLoading] = useState(false);
@@ -60,7 +60,12 @@ const AlertScreen = () => {
       "Vuoi davvero chiudere questo alert?",
       async () => {
         try {
-          await fetch(`${API_URLS.alerts}/${id}/close`, { method: 'PATCH' });
+          // L'operatore compare nel messaggio Telegram aggiornato con il nuovo stato
+          await fetch(`${API_URLS.alerts}/${id}/close`, {
+            method: 'PATCH',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ operatore: username })
+          });
           // Ricarica i dati
           loadAlerts();
         } catch (err) {
@@ -76,7 +81,11 @@ const AlertScreen = () => {
       "Vuoi prendere in carico questo ticket?",
       async () => {
         try {
-          await fetch(`${API_URLS.alerts}/${id}/take`, { method: 'PATCH' });
+          await fetch(`${API_URLS.alerts}/${id}/take`, {
+            method: 'PATCH',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ operatore: username })
+          });
           // Ricarica i dati
           loadAlerts();
         } catch (err) {
@@ -436,6 +436,19 @@ const Docs = ({ username, isAdmin }) => {
               </select>
             </div>
           ))}
+          {activeSection === 'compilazioni' && (
+            // Lo storico esecuzioni più vecchio di 24 mesi sta nelle partizioni d'archivio
+            <div className="filter-group">
+              <label>
+                <input
+                  type="checkbox"
+                  checked={filters.includi_archivio === '1'}
+                  onChange={(e) => handleFilterChange('includi_archivio', e.target.checked ? '1' : '')}
+                />
+                {' '}Includi archivio (oltre 24 mesi)
+              </label>
+            </div>
+          )}
         </div>
         
         <div className="filters-actions">
@@ -221,7 +221,7 @@ const DynamicFormRenderer = ({
         
         // Mostra messaggio di successo temporaneo
         setError('');
-        alert('Form compilato con successo!');
+        alert(result.queued ? result.message : 'Form compilato con successo!');
       } else {
         setError(result.error || 'Errore nel salvataggio');
       }
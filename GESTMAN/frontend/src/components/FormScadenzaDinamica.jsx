@@ -155,7 +155,7 @@ const FormScadenzaDinamica = ({ scadenza, username, onClose, onCompleted }) => {
       const result = await response.json();
 
       if (response.ok) {
-        alert("Manutenzione completata con successo!");
+        alert(result.queued ? result.message : "Manutenzione completata con successo!");
         onCompleted();
       } else {
         alert(result.error || "Errore nel completamento");
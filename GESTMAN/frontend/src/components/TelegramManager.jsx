@@ -9,7 +9,8 @@ const TelegramManager = ({ sidebarOpen }) => {
     chat_id: '', 
     alert_types: [],
     civici_filter: '',
-    asset_types: []
+    asset_types: [],
+    digest_scadenze: ''
   });
   const [editingUser, setEditingUser] = useState(null);
   const [editUser, setEditUser] = useState({
@@ -18,7 +19,8 @@ const TelegramManager = ({ sidebarOpen }) => {
     chat_id: '',
     alert_types: [],
     civici_filter: '',
-    asset_types: []
+    asset_types: [],
+    digest_scadenze: ''
   });
   const [testLoading, setTestLoading] = useState(false);
   const [message, setMessage] = useState('');
@@ -171,7 +173,8 @@ const TelegramManager = ({ sidebarOpen }) => {
         chat_id: newUser.chat_id,
         alert_types: newUser.alert_types.join(','),
         civici_filter: newUser.civici_filter,
-        asset_types: newUser.asset_types.join(',')
+        asset_types: newUser.asset_types.join(','),
+        digest_finestre: newUser.digest_scadenze === '' ? {} : { scadenze: newUser.digest_scadenze }
       };
       
       const res = await fetch('/api/telegram/chats', {
@@ -189,7 +192,8 @@ const TelegramManager = ({ sidebarOpen }) => {
           chat_id: '', 
           alert_types: [],
           civici_filter: '',
-          asset_types: []
+          asset_types: [],
+          digest_scadenze: ''
         });
         loadUsers();
       } else {
@@ -235,7 +239,11 @@ const TelegramManager = ({ sidebarOpen }) => {
           chat_id: data.chat.chat_id,
           alert_types: data.chat.alert_types || [],
           civici_filter: data.chat.civici_filter || '',
-          asset_types: data.chat.asset_types || []
+          asset_types: data.chat.asset_types || [],
+          // Solo il valore salvato: vuoto se la chat usa il predefinito
+          digest_scadenze: data.chat.digest_finestre_configurate && data.chat.digest_finestre_configurate.scadenze !== undefined
+            ? String(data.chat.digest_finestre_configurate.scadenze)
+            : ''
         });
         setEditingUser(userId);
         setError('');
@@ -268,7 +276,9 @@ const TelegramManager = ({ sidebarOpen }) => {
         chat_id: editUser.chat_id,
         alert_types: editUser.alert_types.join(','),
         civici_filter: editUser.civici_filter,
-        asset_types: editUser.asset_types.join(',')
+        asset_types: editUser.asset_types.join(','),
+        // Il backend aggiorna solo la finestra delle scadenze (vuoto = predefinito) e lascia le altre
+        digest_finestre: { scadenze: editUser.digest_scadenze }
       };
       
       const res = await fetch(`/api/telegram/chats/${editUser.id}`, {
@@ -288,7 +298,8 @@ const TelegramManager = ({ sidebarOpen }) => {
           chat_id: '',
           alert_types: [],
           civici_filter: '',
-          asset_types: []
+          asset_types: [],
+          digest_scadenze: ''
         });
         loadUsers();
       } else {
@@ -308,7 +319,8 @@ const TelegramManager = ({ sidebarOpen }) => {
       chat_id: '',
       alert_types: [],
       civici_filter: '',
-      asset_types: []
+      asset_types: [],
+      digest_scadenze: ''
     });
     setError('');
   };
@@ -575,6 +587,24 @@ const TelegramManager = ({ sidebarOpen }) => {
             </div>
           </div>
 
+          <div style={{ marginBottom: 16 }}>
+            <label style={{ display: 'block', marginBottom: 6, fontSize: 14, fontWeight: 500 }}>
+              Riepilogo Scadenze (minuti):
+            </label>
+            <input
+              type="number"
+              min="0"
+              max="1440"
+              value={newUser.digest_scadenze}
+              onChange={(e) => setNewUser(prev => ({ ...prev, digest_scadenze: e.target.value }))}
+              placeholder="2"
+              style={{ width: 120, padding: 8, borderRadius: 4, border: '1px solid #ccc' }}
+            />
+            <small style={{ display: 'block', color: '#666', fontSize: 12 }}>
+              Le scadenze arrivate entro la finestra vengono unite in un unico messaggio. 0 = invio immediato, vuoto = predefinito (2 minuti)
+            </small>
+          </div>
+          
           <div style={{ display: 'grid', gridTemplateColumns: '1fr 1fr', gap: 16, marginBottom: 16 }}>
             <div>
               <label style={{ display: 'block', marginBottom: 6, fontSize: 14, fontWeight: 500 }}>
@@ -718,6 +748,24 @@ const TelegramManager = ({ sidebarOpen }) => {
               </div>
             </div>
 
+            <div style={{ marginBottom: 16 }}>
+              <label style={{ display: 'block', marginBottom: 6, fontSize: 14, fontWeight: 500 }}>
+                Riepilogo Scadenze (minuti):
+              </label>
+              <input
+                type="number"
+                min="0"
+                max="1440"
+                value={editUser.digest_scadenze}
+                onChange={(e) => setEditUser(prev => ({ ...prev, digest_scadenze: e.target.value }))}
+                placeholder="2"
+                style={{ width: 120, padding: 8, borderRadius: 4, border: '1px solid #ccc' }}
+              />
+              <small style={{ display: 'block', color: '#666', fontSize: 12 }}>
+                Le scadenze arrivate entro la finestra vengono unite in un unico messaggio. 0 = invio immediato, vuoto = predefinito (2 minuti)
+              </small>
+            </div>
+            
             <div style={{ display: 'grid', gridTemplateColumns: '1fr 1fr', gap: 16, marginBottom: 16 }}>
               <div>
                 <label style={{ display: 'block', marginBottom: 6, fontSize: 14, fontWeight: 500 }}>